@@ -0,0 +1,157 @@
+#-------------------------------------------------
+# Author:      Suraj Joshi
+# Created:     21-08-2024
+# Copyright:   (c) Suraj Joshi 2024
+#--------------------------------------------------
+import tkinter as tk
+from tkinter import filedialog, messagebox, ttk
+import os
+import numpy as np
+import matplotlib.pyplot as plt
+import pandas as pd
+from fit_backends import get_backend
+from angular import SMIT_BELJERS, collect_angle_series, equilibrium_angle
+from results_db import save_results
+
+# batch_lm pads one-dimensional field windows, the (angle, field) points of this fit need a per-call backend
+ANGLE_FIT_BACKENDS = ["least_squares", "lmfit"]
+
+
+class AngleDependentApp:
+    def __init__(self, master):
+        self.master = master
+        master.title("Angle-Dependent FMR Analysis")
+
+        # Set window size and background color
+        master.geometry("500x720")
+        master.configure(bg="#f0f0f0")
+
+        # Add title label with styling
+        self.title_label = tk.Label(master, text="Angle-Dependent FMR Analysis", font=("Helvetica", 16, "bold"),
+                                    bg="#3F51B5", fg="white", pady=10)
+        self.title_label.pack(fill="x")
+
+        self.label = tk.Label(master, text="Global Smit-Beljers Fit of All Angles\n(angle from the film normal, "
+                                           "in each sample folder name)", font=("Helvetica", 12), bg="#f0f0f0")
+        self.label.pack(pady=10)
+
+        self.select_dir_button = tk.Button(master, text="Select Angle Series Directory", font=("Helvetica", 10, "bold"),
+                                           bg="#4CAF50", fg="white", command=self.select_directory)
+        self.select_dir_button.pack(pady=5)
+
+        self.results_label = tk.Label(master, text="Fit Results Folder:", font=("Helvetica", 12), bg="#f0f0f0")
+        self.results_label.pack(pady=5)
+        self.results_combobox = ttk.Combobox(master, values=["plots", "Skew Lorentzian Fits"], state="readonly")
+        self.results_combobox.set("plots")
+        self.results_combobox.pack(pady=5)
+
+        # Initial values of the global fit, all fields in T
+        self.param_entries = {}
+        for name, text, default in [("M_eff", "Initial M_eff (T):", "1"), ("H_k", "Initial H_k (T):", "0.01"),
+                                    ("H_4perp", "Initial H_4perp (T):", "0"), ("gamma", "Initial gamma (GHz/T):", "29")]:
+            label = tk.Label(master, text=text, font=("Helvetica", 12), bg="#f0f0f0")
+            label.pack(pady=2)
+            entry = tk.Entry(master)
+            entry.insert(0, default)
+            entry.pack(pady=2)
+            self.param_entries[name] = entry
+
+        self.backend_label = tk.Label(master, text="Fit Backend:", font=("Helvetica", 12), bg="#f0f0f0")
+        self.backend_label.pack(pady=5)
+        self.backend_combobox = ttk.Combobox(master, values=ANGLE_FIT_BACKENDS, state="readonly")
+        self.backend_combobox.set("least_squares")
+        self.backend_combobox.pack(pady=5)
+
+        self.run_button = tk.Button(master, text="Run Fitting", font=("Helvetica", 10, "bold"), bg="#4CAF50",
+                                    fg="white", command=self.run_fitting)
+        self.run_button.pack(pady=20)
+
+        # Add the creator's name at the bottom
+        self.creator_label = tk.Label(master, text="Created by Suraj Chandra Joshi", font=("Helvetica", 10, "italic"),
+                                      bg="#f0f0f0", fg="#555555")
+        self.creator_label.pack(side="bottom", pady=10)
+
+        self.directory = None
+
+    def select_directory(self):
+        self.directory = filedialog.askdirectory()
+        if self.directory:
+            messagebox.showinfo("Selected Directory", f"Directory: {self.directory}")
+
+    def run_fitting(self):
+        if not self.directory:
+            messagebox.showwarning("Missing Information", "Please select a directory.")
+            return
+
+        try:
+            initial = {name: float(entry.get()) for name, entry in self.param_entries.items()}
+            self.fit_angles(self.directory, initial, self.results_combobox.get(), self.backend_combobox.get())
+            plt.show()
+        except Exception as e:
+            messagebox.showerror("Error", f"An error occurred: {e}")
+
+    def fit_angles(self, directory, initial, results_folder="plots", backend_name="least_squares"):
+        data = collect_angle_series(directory, results_folder)
+        angles = np.sort(data["Angle (deg)"].unique())
+        if len(data) < len(SMIT_BELJERS.param_names) + 1:
+            raise ValueError(f"Only {len(data)} resonances found in '{results_folder}' folders below {directory}.")
+        print(f"{len(data)} resonances at {len(angles)} angles: {', '.join(f'{angle:g}' for angle in angles)} deg")
+
+        # x: (field angle in rad, H_res in T), y: frequency in GHz, as in the Kittel fit
+        x = np.column_stack([np.radians(data["Angle (deg)"]), 1e-4 * data["H_res"]])
+        y = 1e-9 * data["Frequency (Hz)"].to_numpy()
+
+        backend = get_backend(backend_name)
+        result = backend.fit(SMIT_BELJERS, x, y, initial, bounds={"gamma": (0, None)})
+        if result.best_fit is None:
+            raise RuntimeError(f"Fitting process failed: {result.message}")
+        print(result.report())
+
+        params = result.params
+        gfactor = 2 * np.pi * params["gamma"] / 87.99
+        residual = y - result.eval(x)
+        r2 = 1 - np.sum(residual ** 2) / np.sum((y - y.mean()) ** 2)
+
+        # Data and model f(H) at every angle
+        fig, ax = plt.subplots(figsize=(9, 6))
+        colors = plt.cm.viridis(np.linspace(0, 1, len(angles)))
+        for angle, color in zip(angles, colors):
+            rows = data["Angle (deg)"] == angle
+            H_T = 1e-4 * data.loc[rows, "H_res"]
+            H_fit = np.linspace(H_T.min(), H_T.max(), 200)
+            ax.scatter(H_T, y[rows.to_numpy()], color=color, s=15, label=f"{angle:g} deg")
+            ax.plot(H_fit, result.eval(np.column_stack([np.full(H_fit.size, np.radians(angle)), H_fit])), color=color)
+        ax.set_xlabel("Magnetic Field (T)")
+        ax.set_ylabel("Frequency (GHz)")
+        ax.set_title("Smit-Beljers Fit of the Angle Series")
+        ax.legend(fontsize=8, ncol=2)
+        ax.grid(True)
+        fit_parameters = (f"M_eff = {params['M_eff']:.4f} T\nH_k = {params['H_k']:.4f} T\n"
+                          f"H_4perp = {params['H_4perp']:.4f} T\ngamma = {params['gamma']:.3f} GHz/T\n"
+                          f"g-factor = {gfactor:.4f}\nR2 = {r2:.5f}")
+        ax.text(0.02, 0.98, fit_parameters, transform=ax.transAxes, va="top",
+                bbox=dict(facecolor="white", edgecolor="gray"))
+        fig.savefig(os.path.join(directory, "angle dependent fit.png"))
+
+        # Per-resonance table with the equilibrium magnetization angle, and the material parameters
+        data["Frequency fit (Hz)"] = 1e9 * result.eval(x)
+        data["theta_M (deg)"] = np.degrees(equilibrium_angle(x[:, 0], x[:, 1], params["M_eff"], params["H_k"],
+                                                             params["H_4perp"]))
+        data.to_csv(os.path.join(directory, "angle dependent data.csv"), index=False)
+        material_params = pd.DataFrame({
+            "Parameter": ["M_eff (T)", "H_k (T)", "H_4perp (T)", "gamma (GHz/T)", "g-factor", "R2"],
+            "Value": [params["M_eff"], params["H_k"], params["H_4perp"], params["gamma"], gfactor, r2]
+        })
+        material_params.to_csv(os.path.join(directory, "angle dependent parameters.csv"), index=False)
+        save_results("Angle-Dependent Fit", directory,
+                     dict(initial, results_folder=results_folder, angles=[float(angle) for angle in angles]),
+                     material_params=dict(zip(material_params["Parameter"], material_params["Value"])),
+                     backend=backend_name, fit_time=result.wall_time)
+        print(f"Fitted parameters saved to {os.path.join(directory, 'angle dependent parameters.csv')}")
+        return result
+
+
+if __name__ == "__main__":
+    root = tk.Tk()
+    app = AngleDependentApp(root)
+    root.mainloop()
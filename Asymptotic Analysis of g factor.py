@@ -4,12 +4,14 @@
 # Copyright:   (c) Suraj Joshi 2024
 #--------------------------------------------------
 import tkinter as tk
-from tkinter import filedialog, messagebox
+from tkinter import filedialog, messagebox, ttk
 import os
 import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd
-from lmfit import Model
+from fit_backends import FIT_BACKENDS, get_backend, summarize_results
+from lineshapes import LINESHAPES
+from results_db import save_results
 
 class KittelFittingApp:
     def __init__(self, master):
@@ -62,6 +64,12 @@ class KittelFittingApp:
         self.gamma_entry.insert(0, "29")
         self.gamma_entry.pack(pady=5)
 
+        self.backend_label = tk.Label(master, text="Fit Backend:", font=("Helvetica", 12), bg="#f0f0f0")
+        self.backend_label.pack(pady=5)
+        self.backend_combobox = ttk.Combobox(master, values=list(FIT_BACKENDS), state="readonly")
+        self.backend_combobox.set("lmfit")
+        self.backend_combobox.pack(pady=5)
+
         # Run button
         self.run_button = tk.Button(master, text="Run Fitting", font=("Helvetica", 10, "bold"), bg="#4CAF50", fg="white", command=self.run_fitting)
         self.run_button.pack(pady=20)
@@ -88,6 +96,7 @@ class KittelFittingApp:
         m_eff = float(self.m_eff_entry.get())
         h_k = float(self.h_k_entry.get())
         gamma = float(self.gamma_entry.get())
+        backend_name = self.backend_combobox.get()
 
         if not self.data_file_path:
             messagebox.showwarning("Missing Information", "Please select a CSV file.")
@@ -96,12 +105,11 @@ class KittelFittingApp:
             messagebox.showwarning("Missing Information", "Please select a directory for saving plots.")
             return
 
-        self.perform_fitting(self.data_file_path, self.plot_directory_path, segment_size, m_eff, h_k, gamma)
-
-    def perform_fitting(self, data_file_path, plot_directory_path, segment_size, m_eff, h_k, gamma):
-        def f_kittel(x_T, M_eff, H_k, gamma):
-            return gamma * (((x_T + H_k) * (x_T + M_eff + H_k)) ** 0.5)
+        self.perform_fitting(self.data_file_path, self.plot_directory_path, segment_size, m_eff, h_k, gamma,
+                             backend_name)
 
+    def perform_fitting(self, data_file_path, plot_directory_path, segment_size, m_eff, h_k, gamma,
+                        backend_name="lmfit"):
         df = pd.read_csv(data_file_path)
 
         y_hz = df["Frequency (Hz)"]
@@ -109,44 +117,40 @@ class KittelFittingApp:
         x = df["H_res"]  # in Oe
         x_T = 1e-4 * x  # in T
 
-        kittel_model = Model(f_kittel)
+        kittel_model = LINESHAPES["f_kittel"]
+        backend = get_backend(backend_name)
 
         def piecewise_fit(x_T, y, segment_size):
             g_factors = []
             g_errors = []
             upper_frequencies = []
             fits = []
-            for i in range(segment_size, len(x_T) + 1, segment_size):
-                x_segment = x_T[:i]
-                y_segment = y[:i]
-                params = kittel_model.make_params(M_eff=m_eff, H_k=h_k, gamma=gamma)
-                result = kittel_model.fit(y_segment, params, x_T=x_segment)
-                g_factor = 2 * np.pi * (result.params["gamma"].value) / 87.99  # T/GHz
-                if result.params["gamma"].stderr is not None:
-                    g_error = 2 * np.pi * (result.params["gamma"].stderr) / 87.99  # T/GHz
-                else:
-                    g_error = 0  # or some default value
-                g_factors.append(g_factor)
-                g_errors.append(g_error)
-                upper_frequencies.append(y_segment.iloc[-1])
-                fits.append((x_segment, result.eval(x_T=x_segment)))
-
+            segment_ends = list(range(segment_size, len(x_T) + 1, segment_size))
             # Handle the remaining points
             if len(x_T) % segment_size != 0:
-                x_segment = x_T
-                y_segment = y
-                params = kittel_model.make_params(M_eff=m_eff, H_k=h_k, gamma=gamma)
-                result = kittel_model.fit(y_segment, params, x_T=x_segment)
-                g_factor = 2 * np.pi * (result.params["gamma"].value) / 87.99  # T/GHz
-                if result.params["gamma"].stderr is not None:
-                    g_error = 2 * np.pi * (result.params["gamma"].stderr) / 87.99  # T/GHz
+                segment_ends.append(len(x_T))
+
+            # The segments are independent fits, so the backend gets them all at once
+            x_segments = [x_T[:i] for i in segment_ends]
+            y_segments = [y[:i] for i in segment_ends]
+            params = dict(M_eff=m_eff, H_k=h_k, gamma=gamma)
+            results = backend.fit_many(kittel_model, x_segments, y_segments, params)
+
+            for x_segment, y_segment, result in zip(x_segments, y_segments, results):
+                if result.best_fit is None:
+                    print(f"Error fitting segment up to {y_segment.iloc[-1]:.2f} GHz: {result.message}")
+                    continue
+                g_factor = 2 * np.pi * (result.params["gamma"]) / 87.99  # T/GHz
+                if result.stderr["gamma"] is not None:
+                    g_error = 2 * np.pi * (result.stderr["gamma"]) / 87.99  # T/GHz
                 else:
                     g_error = 0  # or some default value
                 g_factors.append(g_factor)
                 g_errors.append(g_error)
                 upper_frequencies.append(y_segment.iloc[-1])
-                fits.append((x_segment, result.eval(x_T=x_segment)))
+                fits.append((x_segment, result.eval(x_segment)))
 
+            print(summarize_results(results))
             return upper_frequencies, g_factors, g_errors, fits
 
         upper_frequencies, g_factors, g_errors, fits = piecewise_fit(x_T, y, segment_size)
@@ -173,6 +177,11 @@ class KittelFittingApp:
 
         plt.tight_layout()
         plt.savefig(os.path.join(plot_directory_path, "Kittel_fit_asymptotic.png"))
+        save_results("Asymptotic g-factor", os.path.dirname(os.path.abspath(data_file_path)),
+                     dict(segment_size=segment_size, M_eff=m_eff, H_k=h_k, gamma=gamma),
+                     material_params={"g-factor (asymptotic)": g_factors[-1],
+                                      "g-factor error (asymptotic)": g_errors[-1]},
+                     backend=backend_name)
         plt.show()
 
         messagebox.showinfo("Success", "Fitting completed and plot saved!")
@@ -8,10 +8,11 @@ from tkinter import filedialog, messagebox
 from tkinter import ttk  # Import ttk module
 import subprocess
 import os
-import glob
-import re
 import pandas as pd
 import numpy as np
+from sweep_cube import frequency_columns
+from sweep_store import load_sweep, compact_float_format
+from background import BACKGROUND_MODELS, subtract_background
 
 class DataProcessorGUI:
     def __init__(self, master):
@@ -19,7 +20,7 @@ class DataProcessorGUI:
         master.title("Background Removal Data Processor")
 
         # Set the window size
-        master.geometry("700x300")
+        master.geometry("700x400")
 
         # Change background color
         master.configure(bg="#f0f0f0")
@@ -47,6 +48,20 @@ class DataProcessorGUI:
         self.step_size_entry.pack(side="left", padx=5)
         self.step_size_entry.insert(0, "1000000000")  # Default value
 
+        # Background model selection
+        background_frame = tk.Frame(master, bg="#f0f0f0")
+        background_frame.pack(pady=10)
+        background_label = tk.Label(background_frame, text="Background Model:", font=("Helvetica", 12), bg="#f0f0f0")
+        background_label.pack(side="left", padx=5)
+        self.background_combobox = ttk.Combobox(background_frame, values=list(BACKGROUND_MODELS), state="readonly")
+        self.background_combobox.set("median")
+        self.background_combobox.pack(side="left", padx=5)
+        order_label = tk.Label(background_frame, text="Drift Order:", font=("Helvetica", 12), bg="#f0f0f0")
+        order_label.pack(side="left", padx=5)
+        self.order_entry = tk.Entry(background_frame, width=5)
+        self.order_entry.pack(side="left", padx=5)
+        self.order_entry.insert(0, "1")
+
         # Run button
         run_button = tk.Button(master, text="Run", font=("Helvetica", 12, "bold"), bg="#4CAF50", fg="white", command=self.process_data)
         run_button.pack(pady=20)
@@ -65,31 +80,31 @@ class DataProcessorGUI:
     def process_data(self):
         directory_path = self.path_entry.get()
         step_size = int(self.step_size_entry.get())
+        background_model = self.background_combobox.get()
+        drift_order = int(self.order_entry.get())
 
         if not directory_path:
             messagebox.showerror("Error", "Please select a directory path.")
             return
 
         try:
-            self.process_files(directory_path, step_size)
+            self.process_files(directory_path, step_size, background_model, drift_order)
             messagebox.showinfo("Success", f"Extracted data saved to {os.path.join(directory_path, 'background removal')}")
         except Exception as e:
             messagebox.showerror("Error", str(e))
 
-    def process_files(self, directory_path, step_size):
-        file_paths = glob.glob(os.path.join(directory_path, "*.txt"))
-        file_paths_sorted = sorted(file_paths, key=lambda x: int(re.search(r"(\d+)", x).group()))
-        file_series = pd.Series(file_paths_sorted)
-
-        # Extract frequency values from the first file (assuming they are the same for all files)
-        first_file_path = file_series.iloc[0]
-        data = np.loadtxt(first_file_path)
-        freq_values = data[:, 0]
+    def process_files(self, directory_path, step_size, background_model="median", drift_order=1):
+        # Read every trace once into a field x frequency array sorted by field (the frequency axis is
+        # checked to be the same for all files), or the sweep's compact store, and remove the
+        # background from the whole array at once, in float64
+        fields, freq_values, s21, times = load_sweep(directory_path, dtype=np.float64)
+        s21_pure = subtract_background(s21, fields, times, background_model, drift_order)
 
         # Create an array of evenly spaced frequency values with the specified step size
         min_freq = min(freq_values)
         max_freq = max(freq_values)
         index_freq_values = np.arange(min_freq, max_freq + step_size, step_size)
+        columns = frequency_columns(freq_values, index_freq_values)
 
         # Initialize an empty dictionary to store filtered data
         filtered_freq_data = {}
@@ -99,26 +114,13 @@ class DataProcessorGUI:
             os.makedirs(path)
 
         # Iterate through each frequency value
-        for i, freq_value in enumerate(index_freq_values):
-            x = []  # Magnetic field values
-            y = []  # DS21 values
-
-            for file_path in file_series:
-                data = np.loadtxt(file_path)
-                noise = np.loadtxt(first_file_path)
-                y_value = data[np.where(data[:, 0] == freq_value), 1] - noise[np.where(noise[:,0]==freq_value),1]
-
-                if len(y_value) > 0:
-                    # Ensure y_value is a scalar (extract the value from the array)
-                    y.append(float(y_value[0][0]))
-                    file_name = os.path.basename(file_path)
-                    file_name_without_ext = float(os.path.splitext(file_name)[0])
-                    x.append(file_name_without_ext)
-
-            # Sort the magnetic field values in ascending order
-            sorted_indices = np.argsort(x)
-            x_data = np.array(x)[sorted_indices]
-            y_data = np.array(y)[sorted_indices]
+        for i, (freq_value, column) in enumerate(zip(index_freq_values, columns)):
+            if column < 0:
+                continue
+
+            # Magnetic field values (already in ascending order) and background-free S21 values
+            x_data = fields
+            y_data = s21_pure[:, column]
 
             filtered_freq_data[freq_value] = {"mag_field": pd.Series(x_data), "s21": pd.Series(y_data)}
 
@@ -127,7 +129,7 @@ class DataProcessorGUI:
 
             # Save the DataFrame to a CSV file
             csv_path = os.path.join(path, str(freq_value) + ".csv")
-            df.to_csv(csv_path, index=False)
+            df.to_csv(csv_path, index=False, float_format=compact_float_format())
 
             # Update progress bar
             self.progress.set((i+1) / len(index_freq_values) * 100)
@@ -7,12 +7,18 @@ import tkinter as tk
 from tkinter import filedialog, messagebox
 from tkinter import ttk
 import os
-import re
+import time
 from sklearn.metrics import r2_score
 import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
-from lmfit import Model
+from fit_window import sort_by_field, window_around_peak
+from sweep_catalog import SweepCatalog
+from fit_backends import FIT_BACKENDS, get_backend, summarize_results
+from fit_cache import CachedBackend
+from lineshapes import LINESHAPES, MIXED_LINESHAPES
+from results_db import save_results
+from prescreen import SCREEN_POLICIES, screen_spectra, report_screen
 
 class LorentzianFittingApp:
     def __init__(self, master):
@@ -20,7 +26,7 @@ class LorentzianFittingApp:
         master.title("Skew Lorentzian Fitting GUI")
 
         # Set window size and background color
-        master.geometry("450x760")
+        master.geometry("450x940")
         master.configure(bg="#f0f0f0")
 
         # Add title label with styling
@@ -41,6 +47,11 @@ class LorentzianFittingApp:
         self.LW = tk.DoubleVar()
         self.alpha = tk.DoubleVar()
         self.r2_threshold = tk.DoubleVar()
+        self.backend_name = tk.StringVar()
+        self.save_plots = tk.BooleanVar(value=True)
+        self.cache_fits = tk.BooleanVar(value=True)
+        self.dispersive = tk.BooleanVar(value=False)
+        self.screen_policy = tk.StringVar()
 
         self.create_widgets()
 
@@ -57,6 +68,24 @@ class LorentzianFittingApp:
         self.create_label_entry("Initial Parameter LW:", self.LW, 40)
         self.create_label_entry("Initial Parameter alpha(asymmetry term):", self.alpha, 0.02)
         self.create_label_entry("R2 Value Threshold:", self.r2_threshold, 0.9)
+        self.create_label_combobox("Fit Backend:", self.backend_name, list(FIT_BACKENDS), "lmfit")
+        self.create_label_combobox("Pre-screen (skip spectra without a resonance):", self.screen_policy,
+                                   list(SCREEN_POLICIES), "lenient")
+
+        # PNG plots are optional, the Fit Browser shows every fit without them
+        save_plots_check = tk.Checkbutton(self.master, text="Save PNG Plots", variable=self.save_plots,
+                                          font=("Helvetica", 10), bg="#f0f0f0")
+        save_plots_check.pack(pady=5)
+
+        # Reuse the stored result of every spectrum whose window, guesses and backend are unchanged
+        cache_fits_check = tk.Checkbutton(self.master, text="Reuse Cached Fits", variable=self.cache_fits,
+                                          font=("Helvetica", 10), bg="#f0f0f0")
+        cache_fits_check.pack(pady=5)
+
+        # Fit A_disp * dispersive derivative + offset + slope * (H - H_res) along with the skew term
+        dispersive_check = tk.Checkbutton(self.master, text="Dispersive Term + Linear Background",
+                                          variable=self.dispersive, font=("Helvetica", 10), bg="#f0f0f0")
+        dispersive_check.pack(pady=5)
 
         self.run_button = tk.Button(self.master, text="Run Fitting", font=("Helvetica", 10, "bold"),
                                     bg="#4CAF50", fg="white", command=self.run_fitting)
@@ -82,6 +111,13 @@ class LorentzianFittingApp:
         entry = tk.Entry(self.master, textvariable=variable)
         entry.pack(pady=5)
 
+    def create_label_combobox(self, label_text, variable, values, default_value):
+        label = tk.Label(self.master, text=label_text, font=("Helvetica", 10), bg="#f0f0f0")
+        label.pack(pady=5)
+        variable.set(default_value)
+        combobox = ttk.Combobox(self.master, textvariable=variable, values=values, state="readonly")
+        combobox.pack(pady=5)
+
     def select_input_directory(self):
         directory = filedialog.askdirectory()
         self.input_dir_path.set(directory)
@@ -91,49 +127,42 @@ class LorentzianFittingApp:
         self.output_dir_path.set(directory)
 
     def run_fitting(self):
-        input_directory = self.input_dir_path.get()
-        output_directory = os.path.join(self.output_dir_path.get(), 'Skew Lorentzian Fits')
+        self.fit_skew_lorentzian(self.input_dir_path.get(), self.output_dir_path.get(), self.delta_x.get(),
+                                 self.A.get(), self.LW.get(), self.alpha.get(), self.r2_threshold.get(),
+                                 self.backend_name.get(), self.save_plots.get(), self.cache_fits.get(),
+                                 self.screen_policy.get(), self.dispersive.get())
+
+    def fit_skew_lorentzian(self, input_directory, output_directory, delta_x, A, LW, alpha, r2_threshold,
+                            backend_name="lmfit", save_plots=True, use_cache=True, screen_policy="lenient",
+                            dispersive=False):
+        start = time.perf_counter()
+        output_directory = os.path.join(output_directory, 'Skew Lorentzian Fits')
         os.makedirs(output_directory, exist_ok=True)
 
-        delta_x = self.delta_x.get()
-        A = self.A.get()
-        LW = self.LW.get()
-        alpha = self.alpha.get()
-        r2_threshold = self.r2_threshold.get()
+        backend = get_backend(backend_name)
+        if use_cache:
+            backend = CachedBackend(backend)
 
-        csv_files = [file for file in os.listdir(input_directory) if file.endswith(".csv")]
-        csv_files_sorted = sorted(csv_files, key=lambda x: int(re.search(r"(\d+)", x).group()))
-
-        # Update progress bar maximum value
-        self.progress["maximum"] = len(csv_files_sorted)
+        csv_files_sorted = SweepCatalog.load(input_directory, "*.csv").names()
 
-        def derivative_lorentzian(new_x, A, H_res, LW, alpha):
-            numerator = -2 * A * (new_x - H_res) * (LW / 2 * (1 + alpha * (new_x - H_res)))
-            denominator = np.pi * ((new_x - H_res) ** 2 + (LW / 2 * (1 + alpha * (new_x - H_res))) ** 2) ** 2
-            return numerator / denominator
+        lineshape = LINESHAPES[MIXED_LINESHAPES["skew_derivative_lorentzian"] if dispersive
+                               else "skew_derivative_lorentzian"]
+        extra_names = [name for name in lineshape.linear_names if name != "A"]
 
-        fitted_params_df = pd.DataFrame(columns=["Frequency (Hz)", "A", "LW", "H_res", "alpha", "R2"])
+        fitted_params_df = pd.DataFrame(columns=["Frequency (Hz)", "A", "LW", "H_res", "alpha"] + extra_names + ["R2"])
 
-        for index, csv_file in enumerate(csv_files_sorted):
-            fig_name = os.path.splitext(csv_file)[0]
+        # Read and window every spectrum first so the backend can fit them together
+        fitted_files, spectra, windows, initials, bounds = [], [], [], [], []
+        for csv_file in csv_files_sorted:
             file_path = os.path.join(input_directory, csv_file)
             df = pd.read_csv(file_path)
-            x_data = df['Magnetic Field']
-            y_data = df['dS21/dH']
-
-            sorted_indices = np.argsort(x_data)
-            x = np.array(x_data)[sorted_indices]
-            y = np.array(y_data)[sorted_indices]
+            x, y = sort_by_field(df['Magnetic Field'], df['dS21/dH'])
 
             if len(x) == 0 or len(y) == 0:
                 print(f"Empty data in file: {csv_file}")
                 continue
 
-            min_y_index = np.argmax(y)
-            x_min = x[min_y_index] - delta_x
-            x_max = x[min_y_index] + delta_x
-            new_x = x[(x >= x_min) & (x <= x_max)]
-            new_y = y[(x >= x_min) & (x <= x_max)]
+            new_x, new_y = window_around_peak(x, y, delta_x, peak="max")
 
             if len(new_x) == 0 or len(new_y) == 0:
                 print(f"No data in the specified range for file: {csv_file}")
@@ -141,21 +170,34 @@ class LorentzianFittingApp:
 
             H_res_guess = (new_x.max() + new_x.min()) / 2
 
-            model = Model(derivative_lorentzian)
-            params = model.make_params(A=A, LW=LW, H_res=H_res_guess, alpha=alpha)
-            params['A'].set(min=-30, max=0)
-            params['LW'].set(min=10, max=100)
-            params['H_res'].set(min=H_res_guess - 100, max=H_res_guess + 100)
-            params['alpha'].set(min=-0.1, max=0.1)
-
-            try:
-                result = model.fit(new_y, params, new_x=new_x)
-            except Exception as e:
-                print(f"Error fitting file {csv_file}: {e}")
-                continue
+            fitted_files.append(csv_file)
+            spectra.append((x, y))
+            windows.append((new_x, new_y))
+            initials.append(dict(A=A, LW=LW, H_res=H_res_guess, alpha=alpha, **{name: 0.0 for name in extra_names}))
+            bounds.append({
+                "A": (-30, 0),
+                "LW": (10, 100),
+                "H_res": (H_res_guess - 100, H_res_guess + 100),
+                "alpha": (-0.1, 0.1),
+            })
+
+        # Skip the spectra that cannot reach the R2 threshold before fitting them
+        fit, reasons = screen_spectra(spectra, windows, screen_policy, kind="derivative")
+        screen_summary = report_screen(fitted_files, fit, reasons)
+        fitted_files, windows, initials, bounds = (
+            [item for item, keep in zip(items, fit) if keep] for items in (fitted_files, windows, initials, bounds))
+
+        results = backend.fit_many(lineshape, [w[0] for w in windows], [w[1] for w in windows], initials, bounds)
+
+        # Update progress bar maximum value
+        self.progress["maximum"] = len(fitted_files)
+
+        for index, (csv_file, (new_x, new_y), result) in enumerate(zip(fitted_files, windows, results)):
+            fig_name = os.path.splitext(csv_file)[0]
 
-            x_fit = np.linspace(new_x.min(), new_x.max(), 1000)
-            y_fit = derivative_lorentzian(x_fit, result.params["A"].value, result.params["H_res"].value, result.params["LW"].value, result.params["alpha"].value)
+            if result.best_fit is None:
+                print(f"Error fitting file {csv_file}: {result.message}")
+                continue
 
             r2 = r2_score(new_y, result.best_fit)
 
@@ -163,23 +205,27 @@ class LorentzianFittingApp:
                 fitted_params_df = fitted_params_df._append(
                     {
                         "Frequency (Hz)": fig_name,
-                        "A": result.params["A"].value,
-                        "LW": result.params["LW"].value,
-                        "alpha": result.params["alpha"].value,
-                        "H_res": result.params["H_res"].value,
+                        "A": result.params["A"],
+                        "LW": result.params["LW"],
+                        "alpha": result.params["alpha"],
+                        "H_res": result.params["H_res"],
+                        **{name: result.params[name] for name in extra_names},
                         "R2": r2,
                     },
                     ignore_index=True,
                 )
-                plt.scatter(new_x, new_y, label="Limited range")
-                plt.plot(x_fit, y_fit, "r-", label="Best Fit")
-                plt.xlabel('Magnetic Field')
-                plt.ylabel('dS21')
-                plt.title(f"FMR Data for Frequency {fig_name} Hz\nH_res: {result.params['H_res'].value:.2f} Oe, LW: {result.params['LW'].value:.2f} Oe, alpha: {result.params['alpha'].value:.6f}")
-                plt.legend()
-                plt.grid()
-                plt.savefig(os.path.join(output_directory, f"{fig_name}.png"))
-                plt.clf()
+                if save_plots:
+                    x_fit = np.linspace(new_x.min(), new_x.max(), 1000)
+                    y_fit = result.eval(x_fit)
+                    plt.scatter(new_x, new_y, label="Limited range")
+                    plt.plot(x_fit, y_fit, "r-", label="Best Fit")
+                    plt.xlabel('Magnetic Field')
+                    plt.ylabel('dS21')
+                    plt.title(f"FMR Data for Frequency {fig_name} Hz\nH_res: {result.params['H_res']:.2f} Oe, LW: {result.params['LW']:.2f} Oe, alpha: {result.params['alpha']:.6f}")
+                    plt.legend()
+                    plt.grid()
+                    plt.savefig(os.path.join(output_directory, f"{fig_name}.png"))
+                    plt.clf()
             else:
                 print(f"Low R2 value for file: {csv_file}, R2: {r2}")
 
@@ -190,6 +236,15 @@ class LorentzianFittingApp:
         csv_file_path = os.path.join(output_directory, "field domain parameters.csv")
         fitted_params_df.to_csv(csv_file_path, index=False)
         print(f"Fitted parameters and R2 values saved to {csv_file_path}")
+        save_results("Skew Lorentzian Fitting", input_directory,
+                     dict(delta_x=delta_x, A=A, LW=LW, alpha=alpha, R2_threshold=r2_threshold,
+                          screen_policy=screen_policy, dispersive=dispersive), fitted_params_df,
+                     backend=backend_name, wall_time=time.perf_counter() - start,
+                     fit_time=sum(result.wall_time for result in results))
+        print(screen_summary)
+        print(summarize_results(results))
+        if use_cache:
+            print(backend.cache.stats())
 
 if __name__ == "__main__":
     root = tk.Tk()
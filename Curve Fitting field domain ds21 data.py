@@ -6,12 +6,19 @@
 import tkinter as tk
 from tkinter import filedialog, messagebox, ttk
 import os
-import re
+import time
 from sklearn.metrics import r2_score
 import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
-from lmfit import Model
+from fit_window import sort_by_field, window_around_peak
+from sweep_catalog import SweepCatalog
+from fit_backends import FIT_BACKENDS, get_backend, summarize_results
+from fit_cache import CachedBackend
+from lineshapes import LINESHAPES, MIXED_LINESHAPES
+from results_db import save_results
+from prescreen import SCREEN_POLICIES, screen_spectra, report_screen
+from multiresolution import fit_coarse_to_fine
 
 
 class LorentzianFittingApp:
@@ -20,7 +27,7 @@ class LorentzianFittingApp:
         master.title("FMR Lorentzian Fitting")
 
         # Set window size and background color
-        master.geometry("500x600")
+        master.geometry("500x820")
         master.configure(bg="#f0f0f0")
 
         # Add title label with styling
@@ -66,6 +73,44 @@ class LorentzianFittingApp:
         self.R2_entry.insert(0, "0.9")
         self.R2_entry.pack(pady=5)
 
+        self.backend_label = tk.Label(master, text="Fit Backend:", font=("Helvetica", 12), bg="#f0f0f0")
+        self.backend_label.pack(pady=5)
+        self.backend_combobox = ttk.Combobox(master, values=list(FIT_BACKENDS), state="readonly")
+        self.backend_combobox.set("lmfit")
+        self.backend_combobox.pack(pady=5)
+
+        self.screen_label = tk.Label(master, text="Pre-screen (skip spectra without a resonance):",
+                                     font=("Helvetica", 12), bg="#f0f0f0")
+        self.screen_label.pack(pady=5)
+        self.screen_combobox = ttk.Combobox(master, values=list(SCREEN_POLICIES), state="readonly")
+        self.screen_combobox.set("lenient")
+        self.screen_combobox.pack(pady=5)
+
+        # PNG plots are optional, the Fit Browser shows every fit without them
+        self.save_plots = tk.BooleanVar(value=True)
+        self.save_plots_check = tk.Checkbutton(master, text="Save PNG Plots", variable=self.save_plots,
+                                               font=("Helvetica", 12), bg="#f0f0f0")
+        self.save_plots_check.pack(pady=5)
+
+        # Reuse the stored result of every spectrum whose window, guesses and backend are unchanged
+        self.cache_fits = tk.BooleanVar(value=True)
+        self.cache_fits_check = tk.Checkbutton(master, text="Reuse Cached Fits", variable=self.cache_fits,
+                                               font=("Helvetica", 12), bg="#f0f0f0")
+        self.cache_fits_check.pack(pady=5)
+
+        # Fit an averaged window first, then the full data on +/- 5 linewidths around the coarse H_res
+        self.coarse_to_fine = tk.BooleanVar(value=False)
+        self.coarse_to_fine_check = tk.Checkbutton(master, text="Coarse-to-Fine Fitting (dense field steps)",
+                                                   variable=self.coarse_to_fine, font=("Helvetica", 12),
+                                                   bg="#f0f0f0")
+        self.coarse_to_fine_check.pack(pady=5)
+
+        # Fit A_disp * dispersive derivative + offset + slope * (H - H_res) along with the absorption term
+        self.dispersive = tk.BooleanVar(value=False)
+        self.dispersive_check = tk.Checkbutton(master, text="Dispersive Term + Linear Background",
+                                               variable=self.dispersive, font=("Helvetica", 12), bg="#f0f0f0")
+        self.dispersive_check.pack(pady=5)
+
         self.run_button = tk.Button(master, text="Run Fitting", font=("Helvetica", 10, "bold"), bg="#4CAF50",
                                     fg="white", command=self.run_fitting)
         self.run_button.pack(pady=20)
@@ -97,57 +142,69 @@ class LorentzianFittingApp:
             LW = float(self.LW_entry.get())
             H_res = float(self.H_res_entry.get())
             R2_threshold = float(self.R2_entry.get())
+            backend_name = self.backend_combobox.get()
 
-            self.fit_lorentzian(self.directory, self.directory, delta_x, A, LW, H_res, R2_threshold)
+            self.fit_lorentzian(self.directory, self.directory, delta_x, A, LW, H_res, R2_threshold, backend_name,
+                                self.save_plots.get(), self.cache_fits.get(), self.screen_combobox.get(),
+                                self.coarse_to_fine.get(), self.dispersive.get())
             messagebox.showinfo("Success", "Fitting completed successfully!")
         except Exception as e:
             messagebox.showerror("Error", f"An error occurred: {e}")
 
-    def fit_lorentzian(self, input_directory, output_directory, delta_x, A, LW, H_res, R2_threshold):
+    def fit_lorentzian(self, input_directory, output_directory, delta_x, A, LW, H_res, R2_threshold,
+                       backend_name="lmfit", save_plots=True, use_cache=True, screen_policy="lenient",
+                       coarse_to_fine=False, dispersive=False):
+        start = time.perf_counter()
         path = os.path.join(output_directory, 'plots')
         os.makedirs(path, exist_ok=True)
 
         # Get a list of all CSV files in the directory with sorting
-        csv_files = [file for file in os.listdir(input_directory) if file.endswith(".csv")]
-        csv_files_sorted = sorted(csv_files, key=lambda x: int(re.search(r"(\d+)", x).group()))
-
-        self.progress["maximum"] = len(csv_files_sorted)  # Set progress bar maximum value
+        csv_files_sorted = SweepCatalog.load(input_directory, "*.csv").names()
 
-        def derivative_lorentzian(new_x, A, H_res, LW):
-            return -(A * LW * (new_x - H_res)) / (np.pi * ((new_x - H_res) ** 2 + (LW / 2) ** 2) ** 2)
+        lineshape = LINESHAPES[MIXED_LINESHAPES["derivative_lorentzian"] if dispersive else "derivative_lorentzian"]
+        extra_names = [name for name in lineshape.linear_names if name != "A"]
+        backend = get_backend(backend_name)
+        if use_cache:
+            backend = CachedBackend(backend)
 
         # Initialize a DataFrame to store fitted parameters and R2 values
-        fitted_params_df = pd.DataFrame(columns=["Frequency (Hz)", "A", "LW", "H_res", "R2"])
+        fitted_params_df = pd.DataFrame(columns=["Frequency (Hz)", "A", "LW", "H_res"] + extra_names + ["R2"])
 
-        # Loop through each CSV file
-        for i, csv_file in enumerate(csv_files_sorted):
-            fig_name = os.path.splitext(csv_file)[0]
+        # Read each CSV file and cut the fit window
+        fig_names, spectra, windows = [], [], []
+        for csv_file in csv_files_sorted:
+            fig_names.append(os.path.splitext(csv_file)[0])
             file_path = os.path.join(input_directory, csv_file)
             df = pd.read_csv(file_path)  # Read CSV data into a DataFrame
-            x_data = df['Magnetic Field']
-            y_data = df['dS21/dH']
-            # Sort the magnetic field values in ascending order
-            sorted_indices = np.argsort(x_data)
-            x = np.array(x_data)[sorted_indices]
-            y = np.array(y_data)[sorted_indices]
+            # Sort the magnetic field values in ascending order (skipped when already sorted)
+            x, y = sort_by_field(df['Magnetic Field'], df['dS21/dH'])
+            spectra.append((x, y))
 
             # Redefine the y range where there is a dip over a total length of 1000 oe field
-            min_y_index = np.argmax(y)
-            x_min = x[min_y_index] - delta_x
-            x_max = x[min_y_index] + delta_x
-            new_x = x[(x >= x_min) & (x <= x_max)]
-            new_y = y[(x >= x_min) & (x <= x_max)]
-
-            # Fit each dataset to the derivative Lorentzian model
-            model = Model(derivative_lorentzian)
-            params = model.make_params(A=A, LW=LW, H_res=H_res)
-            params['LW'].min = 0  # Constrain LW to be non-negative
-            result = model.fit(new_y, params, new_x=new_x)
-
-            # Generate finer x data for smoother curve
-            x_fit = np.linspace(new_x.min(), new_x.max(), 1000)
-            y_fit = derivative_lorentzian(x_fit, result.params["A"].value, result.params["H_res"].value,
-                                          result.params["LW"].value)
+            windows.append(window_around_peak(x, y, delta_x, peak="max"))
+
+        # Skip the spectra that cannot reach the R2 threshold before fitting them
+        fit, reasons = screen_spectra(spectra, windows, screen_policy, kind="derivative")
+        screen_summary = report_screen([f"{fig_name}.csv" for fig_name in fig_names], fit, reasons)
+        fig_names = [fig_name for fig_name, keep in zip(fig_names, fit) if keep]
+        spectra = [spectrum for spectrum, keep in zip(spectra, fit) if keep]
+        windows = [window for window, keep in zip(windows, fit) if keep]
+
+        self.progress["maximum"] = len(fig_names)  # Set progress bar maximum value
+
+        # Fit each dataset to the derivative Lorentzian model (LW constrained to be non-negative)
+        initial = dict(A=A, LW=LW, H_res=H_res, **{name: 0.0 for name in extra_names})
+        bounds = {"LW": (0, None)}
+        if coarse_to_fine:
+            # The R2 values and plots then refer to the adaptive +/- 5 LW windows
+            windows, results = fit_coarse_to_fine(backend, lineshape, spectra, windows, initial, bounds)
+        else:
+            results = backend.fit_many(lineshape, [w[0] for w in windows], [w[1] for w in windows], initial, bounds)
+
+        for i, (fig_name, (new_x, new_y), result) in enumerate(zip(fig_names, windows, results)):
+            if result.best_fit is None:
+                print(f"Error fitting file {fig_name}.csv: {result.message}")
+                continue
 
             # Calculate R2 value
             r2 = r2_score(new_y, result.best_fit)
@@ -157,25 +214,30 @@ class LorentzianFittingApp:
                 fitted_params_df = fitted_params_df._append(
                     {
                         "Frequency (Hz)": fig_name,
-                        "A": result.params["A"].value,
-                        "LW": result.params["LW"].value,
-                        "H_res": result.params["H_res"].value,
+                        "A": result.params["A"],
+                        "LW": result.params["LW"],
+                        "H_res": result.params["H_res"],
+                        **{name: result.params[name] for name in extra_names},
                         "R2": r2,
                     },
                     ignore_index=True,
                 )
 
                 # Plots
-                plt.scatter(new_x, new_y, label="Limited range")
-                plt.plot(x_fit, y_fit, "r-", label="Best Fit")
-                plt.xlabel('Magnetic Field')
-                plt.ylabel('dS21')
-                plt.title(
-                    f"FMR Data for Frequency {fig_name} Hz\nH_res: {result.params['H_res'].value:.2f} Oe, LW: {result.params['LW'].value:.2f} Oe")
-                plt.legend()
-                plt.grid()
-                plt.savefig(os.path.join(path, f"{fig_name}.png"))
-                plt.clf()
+                if save_plots:
+                    # Generate finer x data for smoother curve
+                    x_fit = np.linspace(new_x.min(), new_x.max(), 1000)
+                    y_fit = result.eval(x_fit)
+                    plt.scatter(new_x, new_y, label="Limited range")
+                    plt.plot(x_fit, y_fit, "r-", label="Best Fit")
+                    plt.xlabel('Magnetic Field')
+                    plt.ylabel('dS21')
+                    plt.title(
+                        f"FMR Data for Frequency {fig_name} Hz\nH_res: {result.params['H_res']:.2f} Oe, LW: {result.params['LW']:.2f} Oe")
+                    plt.legend()
+                    plt.grid()
+                    plt.savefig(os.path.join(path, f"{fig_name}.png"))
+                    plt.clf()
 
             self.progress["value"] = i + 1  # Update progress bar
             self.master.update_idletasks()  # Force update of the GUI
@@ -184,6 +246,16 @@ class LorentzianFittingApp:
         csv_file_path = os.path.join(path, "field domain parameters.csv")
         fitted_params_df.to_csv(csv_file_path, index=False)
         print(f"Fitted parameters and R2 values saved to {csv_file_path}")
+        save_results("Lorentzian Fitting", input_directory,
+                     dict(delta_x=delta_x, A=A, LW=LW, H_res=H_res, R2_threshold=R2_threshold,
+                          screen_policy=screen_policy, coarse_to_fine=coarse_to_fine,
+                          dispersive=dispersive), fitted_params_df,
+                     backend=backend_name, wall_time=time.perf_counter() - start,
+                     fit_time=sum(result.wall_time for result in results))
+        print(screen_summary)
+        print(summarize_results(results))
+        if use_cache:
+            print(backend.cache.stats())
 
 
 if __name__ == "__main__":
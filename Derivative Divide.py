@@ -0,0 +1,127 @@
+#-------------------------------------------------
+# Author:      Suraj Joshi
+# Created:     21-08-2024
+# Copyright:   (c) Suraj Joshi 2024
+#--------------------------------------------------
+import tkinter as tk
+from tkinter import filedialog, messagebox
+from tkinter import ttk
+import os
+import numpy as np
+import pandas as pd
+from sweep_cube import frequency_columns
+from sweep_store import load_sweep, compact_float_format
+from derivative_divide import COMPONENTS, derivative_divide
+
+
+class DerivativeDivideApp:
+    def __init__(self, master):
+        self.master = master
+        master.title("FMR Derivative Divide")
+
+        # Set window size and background color
+        master.geometry("500x550")
+        master.configure(bg="#f0f0f0")
+
+        # Add title label with styling
+        self.title_label = tk.Label(master, text="FMR Derivative Divide", font=("Helvetica", 16, "bold"),
+                                    bg="#3F51B5", fg="white", pady=10)
+        self.title_label.pack(fill="x")
+
+        self.label = tk.Label(master, text="Derivative Divide of Complex S21 Traces", font=("Helvetica", 12),
+                              bg="#f0f0f0")
+        self.label.pack(pady=10)
+
+        self.select_dir_button = tk.Button(master, text="Select Directory", font=("Helvetica", 10, "bold"),
+                                           bg="#4CAF50", fg="white", command=self.select_directory)
+        self.select_dir_button.pack(pady=5)
+
+        self.step_size_label = tk.Label(master, text="Step Size for Frequency:", font=("Helvetica", 12), bg="#f0f0f0")
+        self.step_size_label.pack(pady=5)
+        self.step_size_entry = tk.Entry(master)
+        self.step_size_entry.insert(0, "1e9")
+        self.step_size_entry.pack(pady=5)
+
+        self.modulation_label = tk.Label(master, text="Modulation Step (field steps):", font=("Helvetica", 12),
+                                         bg="#f0f0f0")
+        self.modulation_label.pack(pady=5)
+        self.modulation_entry = tk.Entry(master)
+        self.modulation_entry.insert(0, "1")
+        self.modulation_entry.pack(pady=5)
+
+        self.component_label = tk.Label(master, text="Component passed to the fits:", font=("Helvetica", 12),
+                                        bg="#f0f0f0")
+        self.component_label.pack(pady=5)
+        self.component_combobox = ttk.Combobox(master, values=list(COMPONENTS), state="readonly")
+        self.component_combobox.set("real")
+        self.component_combobox.pack(pady=5)
+
+        self.run_button = tk.Button(master, text="Run Derivative Divide", font=("Helvetica", 10, "bold"),
+                                    bg="#4CAF50", fg="white", command=self.run_derivative_divide)
+        self.run_button.pack(pady=20)
+
+        # Progress bar
+        self.progress = tk.DoubleVar()
+        self.progress_bar = ttk.Progressbar(master, variable=self.progress, maximum=100)
+        self.progress_bar.pack(fill="x", padx=20, pady=10)
+
+        self.creator_label = tk.Label(master, text="Created by Suraj Chandra Joshi", font=("Helvetica", 10, "italic"),
+                                      bg="#f0f0f0", fg="#555555")
+        self.creator_label.pack(side="bottom", pady=10)
+
+        self.directory = None
+
+    def select_directory(self):
+        self.directory = filedialog.askdirectory()
+        if self.directory:
+            messagebox.showinfo("Selected Directory", f"Directory: {self.directory}")
+
+    def run_derivative_divide(self):
+        if not self.directory:
+            messagebox.showwarning("Missing Information", "Please select a directory.")
+            return
+
+        try:
+            step_size = float(self.step_size_entry.get())
+            modulation_step = int(self.modulation_entry.get())
+            self.calculate_derivative_divide(self.directory, self.directory, step_size, modulation_step,
+                                             self.component_combobox.get())
+            messagebox.showinfo("Success", "Derivative divide completed successfully!")
+        except Exception as e:
+            messagebox.showerror("Error", f"An error occurred: {e}")
+
+    def calculate_derivative_divide(self, input_directory, output_directory, step_size, modulation_step=1,
+                                    component="real"):
+        output_directory = os.path.join(output_directory, 'ds21')
+        os.makedirs(output_directory, exist_ok=True)
+
+        # Complex S21 of all traces (or of the sweep's compact store) as one field x frequency array
+        # sorted by field, differentiated in a single pass in float64
+        fields, freq_values, s21, _ = load_sweep(input_directory, complex_values=True, dtype=np.float64)
+        H_mid, dD_dH = derivative_divide(fields, s21, modulation_step)
+
+        index_freq_values = np.arange(min(freq_values), max(freq_values) + step_size, step_size)
+        columns = frequency_columns(freq_values, index_freq_values)
+
+        for i, (freq_value, column) in enumerate(zip(index_freq_values, columns)):
+            if column >= 0:
+                derivative_data = pd.DataFrame({
+                    'Magnetic Field': H_mid,
+                    'dS21/dH': COMPONENTS[component](dD_dH[:, column]),
+                    'Re dD/dH': dD_dH[:, column].real,
+                    'Im dD/dH': dD_dH[:, column].imag,
+                })
+                derivative_data.to_csv(os.path.join(output_directory, str(freq_value) + ".csv"), index=False,
+                                       float_format=compact_float_format())
+
+            # Update progress bar
+            self.progress.set((i + 1) / len(index_freq_values) * 100)
+            self.master.update_idletasks()
+
+        print(f"Derivative divide data saved to {output_directory}")
+
+
+if __name__ == "__main__":
+    root = tk.Tk()
+    app = DerivativeDivideApp(root)
+    root.mainloop()
@@ -6,12 +6,16 @@
 import tkinter as tk
 from tkinter import filedialog, messagebox
 import os
-import re
 from sklearn.metrics import r2_score
 import pandas as pd
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
 import numpy as np
-from lmfit import Model
+from fit_window import sort_by_field, window_around_peak
+from sweep_catalog import SweepCatalog
+from fit_backends import get_backend, summarize_results
+from fit_cache import CachedBackend
+from lineshapes import LINESHAPES
 
 class FittingApp:
     def __init__(self, master):
@@ -63,6 +67,12 @@ class FittingApp:
         self.R2_entry.insert(0, "0.9")
         self.R2_entry.pack(pady=5)
 
+        # Draw the parameters saved by the Lorentzian fitting step, only missing frequencies are fitted
+        self.use_stored = tk.BooleanVar(value=True)
+        self.use_stored_check = tk.Checkbutton(master, text="Use Stored Fit Parameters", variable=self.use_stored,
+                                               font=("Helvetica", 12), bg="#f0f0f0")
+        self.use_stored_check.pack(pady=5)
+
         self.run_button = tk.Button(master, text="Run Fitting", font=("Helvetica", 10, "bold"), bg="#4CAF50", fg="white", command=self.run_fitting)
         self.run_button.pack(pady=20)
 
@@ -96,74 +106,92 @@ class FittingApp:
             messagebox.showwarning("Missing Information", "Please select a directory for results.")
             return
 
-        self.perform_fitting(self.directory_path, self.results_path, delta_x, A, LW, R2_threshold)
-
-    def perform_fitting(self, directory_path, results_path, delta_x, A, LW, R2_threshold):
+        self.perform_fitting(self.directory_path, self.results_path, delta_x, A, LW, R2_threshold,
+                             self.use_stored.get())
+
+    def load_stored_params(self, directory_path, results_path):
+        # {frequency in Hz: (A, LW, H_res, R2)} from the field domain parameters.csv of the Lorentzian fitting step
+        for path in (os.path.join(results_path, "field domain parameters.csv"),
+                     os.path.join(results_path, "plots", "field domain parameters.csv"),
+                     os.path.join(directory_path, "plots", "field domain parameters.csv")):
+            if os.path.exists(path):
+                df = pd.read_csv(path)
+                print(f"Using the stored fit parameters of {path}")
+                return {float(row["Frequency (Hz)"]): (row["A"], row["LW"], row["H_res"], row["R2"])
+                        for _, row in df.iterrows()}
+        return {}
+
+    def perform_fitting(self, directory_path, results_path, delta_x, A, LW, R2_threshold, use_stored=True):
         # Get a list of all CSV files in the directory with sorting
-        csv_files = [file for file in os.listdir(directory_path) if file.endswith(".csv")]
-        csv_files_sorted = sorted(csv_files, key=lambda x: int(re.search(r"(\d+)", x).group()))
-
-        def derivative_lorentzian(new_x, A, H_res, LW):
-            return -(A * LW * (new_x - H_res)) / (np.pi * ((new_x - H_res) ** 2 + (LW / 2) ** 2) ** 2)
+        csv_files_sorted = SweepCatalog.load(directory_path, "*.csv").names()
+        lineshape = LINESHAPES["derivative_lorentzian"]
+        stored = self.load_stored_params(directory_path, results_path) if use_stored else {}
 
-        # Loop through each CSV file
+        frequencies, windows, params = [], [], []
+        refit, initials, bounds = [], [], []
         for csv_file in csv_files_sorted:
             fig_name = os.path.splitext(csv_file)[0]
             file_path = os.path.join(directory_path, csv_file)
             df = pd.read_csv(file_path)  # Read CSV data into a DataFrame
-            x_data = df['Magnetic Field']
-            y_data = df['dS21/dH']
 
-            # Sort the magnetic field values in ascending order
-            sorted_indices = np.argsort(x_data)
-            x = np.array(x_data)[sorted_indices]
-            y = np.array(y_data)[sorted_indices]
+            # Sort the magnetic field values in ascending order (skipped when already sorted)
+            x, y = sort_by_field(df['Magnetic Field'], df['dS21/dH'])
 
             # Redefine the y range where there is a dip, over a total length of 1000 Oe field
-            min_y_index = np.argmax(y)
-            x_min = x[min_y_index] - delta_x
-            x_max = x[min_y_index] + delta_x
-            new_x = x[(x >= x_min) & (x <= x_max)]
-            new_y = y[(x >= x_min) & (x <= x_max)]
-
-            # Estimate H_res as the midpoint of max and min point
-            H_res_guess = (new_x.max() + new_x.min()) / 2
+            new_x, new_y = window_around_peak(x, y, delta_x, peak="max")
+            frequencies.append(float(fig_name))
+            windows.append((new_x, new_y))
 
-            # Fit each dataset to the derivative Lorentzian model
-            model = Model(derivative_lorentzian)
-            params = model.make_params(A=A, LW=LW, H_res=H_res_guess)
+            if float(fig_name) in stored:
+                # Stored fits were kept by the fitting step's own R2 threshold; apply this one as well
+                stored_A, stored_LW, stored_H_res, stored_r2 = stored[float(fig_name)]
+                params.append(dict(A=stored_A, LW=stored_LW, H_res=stored_H_res) if stored_r2 > R2_threshold else None)
+                continue
 
-            # Constrain parameters
-            params['A'].set(min=-30, max=0)
-            params['LW'].set(min=10, max=100)
-            params['H_res'].set(min=H_res_guess - 100, max=H_res_guess + 100)
-
-            result = model.fit(new_y, params, new_x=new_x)
-
-            # Calculate R2 value
-            r2 = r2_score(new_y, result.best_fit)
-
-            # Plot only if R2 > threshold
-            if r2 > R2_threshold:
-                # Generate finer x data for smoother curve
+            # Estimate H_res as the midpoint of max and min point and constrain the parameters around it
+            H_res_guess = (new_x.max() + new_x.min()) / 2
+            refit.append(len(params))
+            params.append(None)
+            initials.append(dict(A=A, LW=LW, H_res=H_res_guess))
+            bounds.append({"A": (-30, 0), "LW": (10, 100), "H_res": (H_res_guess - 100, H_res_guess + 100)})
+
+        # Fit only the frequencies without stored results, reusing cached fits of earlier runs
+        if refit:
+            backend = CachedBackend(get_backend("lmfit"))
+            results = backend.fit_many(lineshape, [windows[i][0] for i in refit], [windows[i][1] for i in refit],
+                                       initials, bounds)
+            for i, result in zip(refit, results):
+                if result.best_fit is not None and r2_score(windows[i][1], result.best_fit) > R2_threshold:
+                    params[i] = result.params
+            print(f"Refitted {len(refit)} of {len(frequencies)} frequencies: {summarize_results(results)}")
+            print(backend.cache.stats())
+
+        # All curves form one LineCollection and all data points one scatter, coloured by frequency
+        shown = [i for i, spectrum_params in enumerate(params) if spectrum_params is not None]
+        fig, ax = plt.subplots()
+        if shown:
+            freq_in_ghz = np.array([frequencies[i] for i in shown]) * 1e-9
+            norm = plt.Normalize(freq_in_ghz.min(), freq_in_ghz.max())
+            curves = []
+            for i in shown:
+                new_x = windows[i][0]
                 x_fit = np.linspace(new_x.min(), new_x.max(), 1000)
-                y_fit = derivative_lorentzian(x_fit, result.params["A"].value, result.params["H_res"].value, result.params["LW"].value)
-
-                # Convert frequency to GHz
-                freq_in_ghz = float(fig_name) * 1e-9
-                freq_in_ghz = round(freq_in_ghz, 0)
-
-                # Plot experimental data
-                plt.scatter(new_x, new_y)
-                # Plot fitted result
-                plt.plot(x_fit, y_fit, label=f"{freq_in_ghz} GHz")
-
-        plt.xlabel('Magnetic Field (Oe)')
-        plt.ylabel('dS21')
-        plt.title("FMR Data for Different Frequencies")
-        plt.legend(bbox_to_anchor=(1.10, 1), loc='upper right')  # supported values are 'best', 'upper right', etc.
-        plt.grid()
-        plt.savefig(os.path.join(results_path, "FMR_fitting_results.png"))
+                curves.append(np.column_stack([x_fit, lineshape(x_fit, **params[i])]))
+            lines = LineCollection(curves, cmap="viridis", norm=norm)
+            lines.set_array(freq_in_ghz)
+            ax.add_collection(lines)
+
+            # Plot experimental data
+            ax.scatter(np.concatenate([windows[i][0] for i in shown]), np.concatenate([windows[i][1] for i in shown]),
+                       c=np.repeat(freq_in_ghz, [len(windows[i][0]) for i in shown]), cmap="viridis", norm=norm, s=4)
+            ax.autoscale_view()
+            fig.colorbar(lines, ax=ax, label="Frequency (GHz)")
+
+        ax.set_xlabel('Magnetic Field (Oe)')
+        ax.set_ylabel('dS21')
+        ax.set_title("FMR Data for Different Frequencies")
+        ax.grid()
+        fig.savefig(os.path.join(results_path, "FMR_fitting_results.png"))
         plt.show()
 
         messagebox.showinfo("Success", "Fitting completed and results saved!")
@@ -0,0 +1,318 @@
+#-------------------------------------------------
+# Author:      Suraj Joshi
+# Created:     21-08-2024
+# Copyright:   (c) Suraj Joshi 2024
+#--------------------------------------------------
+import tkinter as tk
+from tkinter import filedialog, messagebox, ttk
+import os
+from sklearn.metrics import r2_score
+import pandas as pd
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+from fit_window import sort_by_field, window_bounds
+from sweep_catalog import SweepCatalog
+from fit_backends import FIT_BACKENDS, get_backend, summarize_results
+from lineshapes import LINESHAPES
+
+
+class FitBrowserApp:
+    def __init__(self, master):
+        self.master = master
+        master.title("FMR Fit Browser")
+
+        # Set window size and background color
+        master.geometry("1200x760")
+        master.configure(bg="#f0f0f0")
+
+        # Add title label with styling
+        self.title_label = tk.Label(master, text="FMR Fit Browser", font=("Helvetica", 16, "bold"), bg="#3F51B5",
+                                    fg="white", pady=10)
+        self.title_label.pack(fill="x")
+
+        # Add the creator's name at the bottom
+        self.creator_label = tk.Label(master, text="Created by Suraj Chandra Joshi", font=("Helvetica", 10, "italic"),
+                                      bg="#f0f0f0", fg="#555555")
+        self.creator_label.pack(side="bottom", pady=10)
+
+        controls = tk.Frame(master, bg="#f0f0f0")
+        controls.pack(side="left", fill="y", padx=10)
+        self.controls = controls
+
+        self.label = tk.Label(controls, text="Browse and Re-fit dS21/dH Spectra", font=("Helvetica", 12),
+                              bg="#f0f0f0")
+        self.label.pack(pady=10)
+
+        self.select_dir_button = tk.Button(controls, text="Select Directory", font=("Helvetica", 10, "bold"),
+                                           bg="#4CAF50", fg="white", command=self.select_directory)
+        self.select_dir_button.pack(pady=5)
+
+        self.delta_x_entry = self.create_label_entry("Range around peak (delta_H):", "150")
+        self.A_entry = self.create_label_entry("Initial Parameter A:", "-15")
+        self.LW_entry = self.create_label_entry("Initial Parameter LW:", "40")
+        self.alpha_entry = self.create_label_entry("Initial Parameter alpha (skew only):", "0.02")
+        self.R2_entry = self.create_label_entry("R2 Value Threshold:", "0.9")
+
+        self.lineshape_label = tk.Label(controls, text="Lineshape:", font=("Helvetica", 12), bg="#f0f0f0")
+        self.lineshape_label.pack(pady=5)
+        self.lineshape_combobox = ttk.Combobox(controls, values=["derivative_lorentzian", "skew_derivative_lorentzian"],
+                                               state="readonly")
+        self.lineshape_combobox.set("derivative_lorentzian")
+        self.lineshape_combobox.pack(pady=5)
+
+        self.backend_label = tk.Label(controls, text="Fit Backend:", font=("Helvetica", 12), bg="#f0f0f0")
+        self.backend_label.pack(pady=5)
+        self.backend_combobox = ttk.Combobox(controls, values=list(FIT_BACKENDS), state="readonly")
+        self.backend_combobox.set("batch_lm")
+        self.backend_combobox.pack(pady=5)
+
+        self.load_button = tk.Button(controls, text="Load and Fit All", font=("Helvetica", 10, "bold"), bg="#4CAF50",
+                                     fg="white", command=self.load_and_fit)
+        self.load_button.pack(pady=10)
+
+        self.refit_button = tk.Button(controls, text="Re-fit This Frequency", font=("Helvetica", 10, "bold"),
+                                      bg="#4CAF50", fg="white", command=self.refit_current)
+        self.refit_button.pack(pady=5)
+
+        self.save_button = tk.Button(controls, text="Save Parameters", font=("Helvetica", 10, "bold"), bg="#4CAF50",
+                                     fg="white", command=self.save_parameters)
+        self.save_button.pack(pady=5)
+
+        self.export_button = tk.Button(controls, text="Export PNG", font=("Helvetica", 10, "bold"), bg="#4CAF50",
+                                       fg="white", command=self.export_png)
+        self.export_button.pack(pady=5)
+
+        # Add the progress bar
+        self.progress = ttk.Progressbar(controls, orient='horizontal', length=250, mode='determinate')
+        self.progress.pack(pady=10)
+
+        # Plot area: the axes, grid and labels are drawn once and cached, a frequency change only
+        # redraws the animated data, window and fit artists on top of the cached background (blitting)
+        plot_frame = tk.Frame(master, bg="#f0f0f0")
+        plot_frame.pack(side="right", fill="both", expand=True, padx=10)
+
+        self.figure = Figure(figsize=(7, 5))
+        self.ax = self.figure.add_subplot(111)
+        self.ax.set_xlabel('Magnetic Field')
+        self.ax.set_ylabel('dS21 (normalized)')
+        self.ax.grid()
+        self.data_line, = self.ax.plot([], [], ".", color="0.6", label="Data", animated=True)
+        self.window_line, = self.ax.plot([], [], "o", color="C0", markersize=4, label="Fit range", animated=True)
+        self.fit_line, = self.ax.plot([], [], "r-", label="Best Fit", animated=True)
+        self.info_text = self.ax.text(0.02, 0.97, "", transform=self.ax.transAxes, va="top", animated=True)
+        self.ax.legend(loc="lower right")
+        self.background = None
+
+        self.canvas = FigureCanvasTkAgg(self.figure, master=plot_frame)
+        self.canvas.get_tk_widget().pack(fill="both", expand=True)
+        self.canvas.mpl_connect("draw_event", self.on_draw)
+        self.canvas.mpl_connect("button_press_event", self.on_click)
+
+        self.slider = tk.Scale(plot_frame, from_=0, to=0, orient="horizontal", showvalue=False,
+                               command=lambda value: self.show(int(value)))
+        self.slider.pack(fill="x", pady=5)
+        master.bind("<Left>", lambda event: self.step(-1))
+        master.bind("<Right>", lambda event: self.step(1))
+
+        self.directory = None
+        self.frequencies = []  # file name stems, e.g. "5000000000"
+        self.spectra = []  # (x, y) of every spectrum sorted by field
+        self.centers = []  # field the fit window of every spectrum is centred on
+        self.windows = []  # (lo, hi) index range of every fit window
+        self.results = []  # FitResult of every spectrum
+        self.current = 0
+
+    def create_label_entry(self, label_text, default_value):
+        label = tk.Label(self.controls, text=label_text, font=("Helvetica", 12), bg="#f0f0f0")
+        label.pack(pady=2)
+        entry = tk.Entry(self.controls)
+        entry.insert(0, default_value)
+        entry.pack(pady=2)
+        return entry
+
+    def select_directory(self):
+        self.directory = filedialog.askdirectory()
+        if self.directory:
+            messagebox.showinfo("Selected Directory", f"Directory: {self.directory}")
+
+    def initial_guess(self, index):
+        lo, hi = self.windows[index]
+        initial = dict(A=float(self.A_entry.get()), LW=float(self.LW_entry.get()), H_res=self.centers[index])
+        bounds = {"LW": (0, None)}
+        if self.lineshape_combobox.get() == "skew_derivative_lorentzian":
+            x = self.spectra[index][0][lo:hi]
+            H_res_guess = (x.max() + x.min()) / 2 if hi > lo else self.centers[index]
+            initial.update(H_res=H_res_guess, alpha=float(self.alpha_entry.get()))
+            bounds = {"A": (-30, 0), "LW": (10, 100), "H_res": (H_res_guess - 100, H_res_guess + 100),
+                      "alpha": (-0.1, 0.1)}
+        return initial, bounds
+
+    def load_and_fit(self):
+        if not self.directory:
+            messagebox.showwarning("Missing Information", "Please select a directory.")
+            return
+
+        try:
+            delta_x = float(self.delta_x_entry.get())
+            csv_files_sorted = SweepCatalog.load(self.directory, "*.csv").names()
+            self.progress["maximum"] = len(csv_files_sorted)
+
+            self.frequencies, self.spectra, self.centers, self.windows = [], [], [], []
+            for i, csv_file in enumerate(csv_files_sorted):
+                df = pd.read_csv(os.path.join(self.directory, csv_file))
+                x, y = sort_by_field(df['Magnetic Field'].to_numpy(), df['dS21/dH'].to_numpy())
+                center = x[np.argmax(y)] if len(x) else 0.0
+                self.frequencies.append(os.path.splitext(csv_file)[0])
+                self.spectra.append((x, y))
+                self.centers.append(center)
+                self.windows.append(window_bounds(x, center, delta_x))
+
+                self.progress["value"] = i + 1
+                self.master.update_idletasks()
+
+            guesses = [self.initial_guess(i) for i in range(len(self.spectra))]
+            xs = [x[lo:hi] for (x, _), (lo, hi) in zip(self.spectra, self.windows)]
+            ys = [y[lo:hi] for (_, y), (lo, hi) in zip(self.spectra, self.windows)]
+            self.results = get_backend(self.backend_combobox.get()).fit_many(
+                LINESHAPES[self.lineshape_combobox.get()], xs, ys,
+                [guess[0] for guess in guesses], [guess[1] for guess in guesses])
+            print(summarize_results(self.results))
+        except Exception as e:
+            messagebox.showerror("Error", f"An error occurred: {e}")
+            return
+
+        self.slider.configure(to=max(len(self.spectra) - 1, 0))
+        self.setup_axes()
+        self.slider.set(0)
+        self.show(0)
+
+    def setup_axes(self):
+        # Fixed limits for the whole sweep (spectra are normalized), so browsing never needs a full redraw
+        if self.spectra:
+            self.ax.set_xlim(min(x.min() for x, _ in self.spectra if len(x)),
+                             max(x.max() for x, _ in self.spectra if len(x)))
+        self.ax.set_ylim(-1.2, 1.2)
+        self.canvas.draw()
+
+    def on_draw(self, event):
+        # Cache everything except the animated artists after every full draw (start-up, resize)
+        self.background = self.canvas.copy_from_bbox(self.figure.bbox)
+        self.draw_artists()
+
+    def draw_artists(self):
+        for artist in (self.data_line, self.window_line, self.fit_line, self.info_text):
+            self.ax.draw_artist(artist)
+
+    def update_artists(self, index):
+        x, y = self.spectra[index]
+        lo, hi = self.windows[index]
+        result = self.results[index]
+        scale = np.max(np.abs(y)) if len(y) else 1.0
+        scale = scale if scale > 0 else 1.0
+        self.data_line.set_data(x, y / scale)
+        self.window_line.set_data(x[lo:hi], y[lo:hi] / scale)
+
+        text = f"Frequency {self.frequencies[index]} Hz ({index + 1}/{len(self.spectra)})"
+        if result.best_fit is None or hi - lo < 2:
+            self.fit_line.set_data([], [])
+            text += f"\nFit failed: {result.message}"
+        else:
+            x_fit = np.linspace(x[lo], x[hi - 1], 1000)
+            self.fit_line.set_data(x_fit, result.eval(x_fit) / scale)
+            r2 = r2_score(y[lo:hi], result.best_fit)
+            status = "" if r2 > float(self.R2_entry.get()) else " (below threshold)"
+            text += (f"\nH_res: {result.params['H_res']:.2f} Oe, LW: {result.params['LW']:.2f} Oe"
+                     f"\nR2: {r2:.4f}{status}")
+        self.info_text.set_text(text)
+
+    def show(self, index):
+        if not self.spectra:
+            return
+        self.current = min(max(index, 0), len(self.spectra) - 1)
+        self.update_artists(self.current)
+        if self.background is None:
+            self.canvas.draw()
+            return
+        self.canvas.restore_region(self.background)
+        self.draw_artists()
+        self.canvas.blit(self.figure.bbox)
+
+    def step(self, offset):
+        if self.spectra:
+            self.slider.set(min(max(self.current + offset, 0), len(self.spectra) - 1))
+
+    def on_click(self, event):
+        # A click inside the axes moves the fit window centre of the current spectrum to that field
+        if event.inaxes is self.ax and self.spectra and event.xdata is not None:
+            self.centers[self.current] = event.xdata
+            self.refit_current()
+
+    def refit_current(self):
+        if not self.spectra:
+            return
+        try:
+            index = self.current
+            x, y = self.spectra[index]
+            self.windows[index] = window_bounds(x, self.centers[index], float(self.delta_x_entry.get()))
+            lo, hi = self.windows[index]
+            initial, bounds = self.initial_guess(index)
+            previous = self.results[index]
+            if previous.best_fit is not None and hi > lo and x[lo] <= previous.params["H_res"] <= x[hi - 1]:
+                # Start from the previous solution while it still lies inside the adjusted window
+                initial.update(previous.params)
+            self.results[index] = get_backend(self.backend_combobox.get()).fit(
+                LINESHAPES[self.lineshape_combobox.get()], x[lo:hi], y[lo:hi], initial, bounds)
+        except Exception as e:
+            messagebox.showerror("Error", f"An error occurred: {e}")
+            return
+        self.show(index)
+
+    def save_parameters(self):
+        # Same layout as the field domain parameters.csv of the fitting steps
+        if not self.spectra:
+            messagebox.showwarning("Missing Information", "Please load and fit a directory first.")
+            return
+        R2_threshold = float(self.R2_entry.get())
+        rows = []
+        for frequency, (x, y), (lo, hi), result in zip(self.frequencies, self.spectra, self.windows, self.results):
+            if result.best_fit is None or hi - lo < 2:
+                continue
+            r2 = r2_score(y[lo:hi], result.best_fit)
+            if r2 > R2_threshold:
+                row = {"Frequency (Hz)": frequency}
+                row.update(result.params)
+                row["R2"] = r2
+                rows.append(row)
+
+        lineshape_name = self.lineshape_combobox.get()
+        output_folder = 'Skew Lorentzian Fits' if lineshape_name == "skew_derivative_lorentzian" else 'plots'
+        path = os.path.join(self.directory, output_folder)
+        os.makedirs(path, exist_ok=True)
+        extra_params = [name for name in LINESHAPES[lineshape_name].param_names if name not in ("A", "LW", "H_res")]
+        columns = ["Frequency (Hz)", "A", "LW", "H_res"] + extra_params + ["R2"]
+        csv_file_path = os.path.join(path, "field domain parameters.csv")
+        pd.DataFrame(rows, columns=columns).to_csv(csv_file_path, index=False)
+        messagebox.showinfo("Success", f"Fitted parameters saved to {csv_file_path}")
+
+    def export_png(self):
+        # The animated artists are left out of a normal draw, so they are made static for the export
+        if not self.spectra:
+            return
+        path = os.path.join(self.directory, 'plots')
+        os.makedirs(path, exist_ok=True)
+        file_path = os.path.join(path, f"{self.frequencies[self.current]}.png")
+        artists = (self.data_line, self.window_line, self.fit_line, self.info_text)
+        for artist in artists:
+            artist.set_animated(False)
+        self.figure.savefig(file_path)
+        for artist in artists:
+            artist.set_animated(True)
+        self.canvas.draw()
+        print(f"Plot saved to {file_path}")
+
+
+if __name__ == "__main__":
+    root = tk.Tk()
+    app = FitBrowserApp(root)
+    root.mainloop()
@@ -9,6 +9,11 @@ import subprocess
 import os
 import sys
 import webbrowser
+from pipeline import STAGES, PipelineRun
+from fit_service import SERVICE_ADDRESS, RemoteRun
+
+STATUS_COLORS = {"waiting": "#555555", "running": "#1E88E5", "done": "#2E7D32", "up to date": "#2E7D32",
+                 "failed": "#C62828", "blocked": "#EF6C00", "cancelled": "#555555"}
 
 
 class ToolTip:
@@ -43,7 +48,7 @@ class MasterGUI:
         master.title("FMR Data Processing - Step by Step")
 
         # Set the window size
-        master.geometry("1400x600")
+        master.geometry("1400x900")
 
         # Change background color
         master.configure(bg="#f0f0f0")
@@ -96,8 +101,13 @@ class MasterGUI:
         second_steps = [
             ("Conversion of Frequency to Field Domain", "conversion of freq to field domain.py"),
             ("Derivative of Field Domain", "conversion to field domain to ds21 data.py"),
+            ("Derivative Divide of Complex S21", "Derivative Divide.py"),
             ("Lorentzian Fitting of dS data", "curve fitting field domain ds21 data.py"),
             ("Skew Lorentzian Fitting of dS data", "curve fitting field domain ds21 data to skew lorentzian function.py"),
+            ("Parameter Sweep of dS Fits", "Parameter Sweep.py"),
+            ("Multi Resonance Fitting of dS data", "Multi Resonance Fitting.py"),
+            ("Fit Browser of dS data", "Fit Browser.py"),
+            ("Field-Frequency Resonance Map", "Resonance Map.py"),
             ("Derivative FMR Spectra", "FMR Spectra.py")
         ]
 
@@ -117,7 +127,8 @@ class MasterGUI:
         third_steps = [
             ("Kittel Fit", "Kittel fit from field domain data.py"),
             ("Linewidth Fitting", "Linewidth Fit.py"),
-            ("Asymptotic Analysis of g factor", "Asymptotic Analysis of g factor.py")
+            ("Asymptotic Analysis of g factor", "Asymptotic Analysis of g factor.py"),
+            ("Angle-Dependent Analysis", "Angle Dependent Analysis.py")
         ]
 
         for step, script in third_steps:
@@ -129,6 +140,60 @@ class MasterGUI:
             button.pack(side="right")
             ToolTip(button, f"Click to run the {step.lower()} script")
 
+        # One-click pipeline: all steps of a sample directory with default settings, independent
+        # branches at the same time and up-to-date stages skipped
+        pipeline_frame = tk.Frame(main_frame, borderwidth=2, relief="solid", padx=10, pady=10, bg="#ffffff")
+        pipeline_frame.grid(row=1, column=0, columnspan=3, sticky="nsew", padx=5, pady=5)
+        pipeline_label = tk.Label(pipeline_frame, text="Run Full Pipeline", font=("Helvetica", 14, "bold"), bg="#ffffff")
+        pipeline_label.pack(fill="x", pady=5)
+
+        controls = tk.Frame(pipeline_frame, bg="#ffffff")
+        controls.pack(fill="x")
+        select_button = tk.Button(controls, text="Select Sample Directory", font=("Helvetica", 10, "bold"),
+                                  bg="#4CAF50", fg="white", command=self.select_pipeline_directory)
+        select_button.pack(side="left", padx=5)
+        ToolTip(select_button, "Directory with the raw .txt traces of one sample")
+        self.pipeline_directory_label = tk.Label(controls, text="No directory selected", font=("Helvetica", 10),
+                                                 bg="#ffffff", fg="#555555")
+        self.pipeline_directory_label.pack(side="left", padx=5)
+
+        self.run_pipeline_button = tk.Button(controls, text="Run Pipeline", font=("Helvetica", 10, "bold"),
+                                             bg="#4CAF50", fg="white", command=self.run_pipeline)
+        self.run_pipeline_button.pack(side="right", padx=5)
+        ToolTip(self.run_pipeline_button, "Settings other than the defaults go in pipeline_settings.json "
+                                          "of the sample directory")
+        self.force_rerun = tk.BooleanVar(value=False)
+        tk.Checkbutton(controls, text="Rerun Up-to-Date Stages", variable=self.force_rerun, font=("Helvetica", 10),
+                       bg="#ffffff").pack(side="right", padx=5)
+        self.use_service = tk.BooleanVar(value=False)
+        service_check = tk.Checkbutton(controls, text="Run on Fit Service", variable=self.use_service,
+                                       font=("Helvetica", 10), bg="#ffffff")
+        service_check.pack(side="right", padx=5)
+        ToolTip(service_check, f"Queue the pipeline on the fit service shared by all users of this machine\n"
+                               f"(python fit_service.py serve, at {SERVICE_ADDRESS})")
+        self.max_workers = tk.Spinbox(controls, from_=1, to=max(os.cpu_count() or 1, 8), width=4)
+        self.max_workers.delete(0, tk.END)
+        self.max_workers.insert(0, str(os.cpu_count() or 1))
+        self.max_workers.pack(side="right", padx=5)
+        tk.Label(controls, text="Parallel Stages:", font=("Helvetica", 10), bg="#ffffff").pack(side="right")
+
+        self.stage_table = ttk.Treeview(pipeline_frame, columns=("status", "time"), height=len(STAGES))
+        self.stage_table.heading("#0", text="Stage")
+        self.stage_table.heading("status", text="Status")
+        self.stage_table.heading("time", text="Time")
+        self.stage_table.column("time", width=100, anchor="e")
+        for stage in STAGES:
+            self.stage_table.insert("", "end", iid=stage.name, text=stage.label, values=("", ""))
+        for status, color in STATUS_COLORS.items():
+            self.stage_table.tag_configure(status, foreground=color)
+        self.stage_table.pack(fill="x", pady=5)
+        self.pipeline_summary = tk.Label(pipeline_frame, text="", font=("Helvetica", 10), bg="#ffffff")
+        self.pipeline_summary.pack(fill="x")
+
+        self.pipeline_directory = None
+        self.pipeline_run = None
+        master.protocol("WM_DELETE_WINDOW", self.close)
+
         # Help section with clickable email
         help_label = tk.Label(master, text="For help, please contact: ", font=("Helvetica", 10), bg="#f0f0f0", fg="#555555")
         help_label.pack(side="top", pady=5)
@@ -153,6 +218,68 @@ class MasterGUI:
     def open_email(self, email):
         webbrowser.open(f"mailto:{email}")
 
+    def select_pipeline_directory(self):
+        directory = filedialog.askdirectory()
+        if directory:
+            self.pipeline_directory = directory
+            self.pipeline_directory_label.config(text=directory)
+
+    def run_pipeline(self):
+        if not self.pipeline_directory:
+            messagebox.showwarning("Missing Information", "Please select a sample directory.")
+            return
+        if self.pipeline_run is not None:
+            return
+
+        try:
+            if self.use_service.get():
+                self.pipeline_run = RemoteRun(self.pipeline_directory, force=self.force_rerun.get())
+            else:
+                self.pipeline_run = PipelineRun(self.pipeline_directory, max_workers=int(self.max_workers.get()),
+                                                force=self.force_rerun.get())
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to start the pipeline:\n{e}")
+            return
+        self.run_pipeline_button.config(state="disabled")
+        self.poll_pipeline()
+
+    def poll_pipeline(self):
+        run = self.pipeline_run
+        try:
+            working = run.poll()
+        except Exception as e:
+            run.cancel()
+            working = False
+            messagebox.showerror("Error", f"Pipeline stopped:\n{e}")
+
+        for stage in STAGES:
+            status = run.status.get(stage.name, "")
+            elapsed = run.elapsed(stage.name)
+            text = status
+            if status == "running" and stage.name in run.progress:
+                text = f"running {run.progress[stage.name]}%"
+            if elapsed is None:
+                elapsed = ""
+            elif status == "running":
+                elapsed = f"{elapsed:.0f} s"
+            else:
+                elapsed = f"{elapsed:.1f} s"
+            self.stage_table.item(stage.name, values=(text, elapsed), tags=(status,))
+        self.pipeline_summary.config(text=run.summary())
+
+        if working:
+            self.master.after(200, self.poll_pipeline)
+        else:
+            self.pipeline_run = None
+            self.run_pipeline_button.config(state="normal")
+            if "failed" in run.status.values():
+                messagebox.showwarning("Pipeline", f"{run.summary()}\nSee the pipeline logs folder of the sample.")
+
+    def close(self):
+        if self.pipeline_run is not None:
+            self.pipeline_run.cancel()
+        self.master.destroy()
+
 
 if __name__ == "__main__":
     root = tk.Tk()
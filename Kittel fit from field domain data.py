@@ -4,12 +4,14 @@
 # Copyright:   (c) Suraj Joshi 2024
 #--------------------------------------------------
 import tkinter as tk
-from tkinter import filedialog, messagebox
+from tkinter import filedialog, messagebox, ttk
 import os
 import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd
-from lmfit import Model
+from fit_backends import FIT_BACKENDS, get_backend
+from lineshapes import LINESHAPES
+from results_db import save_results
 
 class KittelFittingApp:
     def __init__(self, master):
@@ -50,6 +52,12 @@ class KittelFittingApp:
         self.gamma_entry.insert(0, "29")
         self.gamma_entry.pack(pady=5)
 
+        self.backend_label = tk.Label(master, text="Fit Backend:", font=("Helvetica", 12), bg="#f0f0f0")
+        self.backend_label.pack(pady=5)
+        self.backend_combobox = ttk.Combobox(master, values=list(FIT_BACKENDS), state="readonly")
+        self.backend_combobox.set("lmfit")
+        self.backend_combobox.pack(pady=5)
+
         self.run_button = tk.Button(master, text="Run Fitting", font=("Helvetica", 10, "bold"), bg="#4CAF50",
                                     fg="white", command=self.run_fitting)
         self.run_button.pack(pady=20)
@@ -75,15 +83,13 @@ class KittelFittingApp:
             M_eff = float(self.M_eff_entry.get())
             H_k = float(self.H_k_entry.get())
             gamma = float(self.gamma_entry.get())
+            backend_name = self.backend_combobox.get()
 
-            self.fit_kittel(self.directory, self.directory, M_eff, H_k, gamma)
+            self.fit_kittel(self.directory, self.directory, M_eff, H_k, gamma, backend_name)
         except Exception as e:
             messagebox.showerror("Error", f"An error occurred: {e}")
 
-    def fit_kittel(self, input_directory, output_directory, M_eff, H_k, gamma):
-        def f_kittel(x_T, M_eff, H_k, gamma):
-            return gamma * (((x_T + H_k) * (x_T + M_eff + H_k)) ** 0.5)
-
+    def fit_kittel(self, input_directory, output_directory, M_eff, H_k, gamma, backend_name="lmfit"):
         file_path = os.path.join(output_directory, 'field domain parameters.csv')
         df = pd.read_csv(file_path)
 
@@ -92,27 +98,28 @@ class KittelFittingApp:
         x = df["H_res"]
         x_T = 1e-4 * x  # Convert to Tesla
 
-        kittel_model = Model(f_kittel)
+        kittel_model = LINESHAPES["f_kittel"]
+        backend = get_backend(backend_name)
 
         # Initial parameter guesses
-        params = kittel_model.make_params(M_eff=M_eff, H_k=H_k, gamma=gamma)
+        params = dict(M_eff=M_eff, H_k=H_k, gamma=gamma)
 
         try:
-            result = kittel_model.fit(y, params, x_T=x_T)
+            result = backend.fit(kittel_model, x_T, y, params)
         except Exception as e:
             messagebox.showerror("Error during fitting", f"The model function generated NaN values and the fit aborted! Please check your model function and/or set boundaries on parameters where applicable.")
             return
 
-        if result is None:
+        if result is None or result.best_fit is None:
             messagebox.showerror("Error", "Fitting process failed.")
             return
 
         x_fit = np.linspace(min(x_T), max(x_T), 1000)
-        y_fit = result.eval(x_T=x_fit)
+        y_fit = result.eval(x_fit)
 
-        print(result.fit_report())
+        print(result.report())
 
-        gfactor = 2 * np.pi * (result.params["gamma"].value) / 87.99
+        gfactor = 2 * np.pi * (result.params["gamma"]) / 87.99
 
         plt.scatter(x_T, y, label="Data")
         plt.plot(x_fit, y_fit, label="Fitted Curve", color="red")
@@ -121,7 +128,7 @@ class KittelFittingApp:
         plt.title("Fitting Data to Kittel Equation")
         plt.legend()
         plt.grid(True)
-        fit_parameters = f"M_eff = {result.params['M_eff'].value:.2f} T \ngamma = {result.params['gamma'].value:.2f} GHz/T \nH_k = 0.00 T \ng-factor = {gfactor:.4f}"
+        fit_parameters = f"M_eff = {result.params['M_eff']:.2f} T \ngamma = {result.params['gamma']:.2f} GHz/T \nH_k = 0.00 T \ng-factor = {gfactor:.4f}"
         plt.text(0.6, 0.2, fit_parameters, transform=plt.gca().transAxes,
                  bbox=dict(facecolor='white', edgecolor='gray'))
 
@@ -131,9 +138,12 @@ class KittelFittingApp:
         # Save fitting results to material parameter.csv
         material_params = pd.DataFrame({
             "Parameter": ["M_eff (T)", "gamma (GHz/T)", "H_k (T)", "g-factor"],
-            "Value": [result.params['M_eff'].value, result.params['gamma'].value, H_k, gfactor]
+            "Value": [result.params['M_eff'], result.params['gamma'], H_k, gfactor]
         })
         material_params.to_csv(os.path.join(output_directory, "material parameter.csv"), index=False)
+        save_results("Kittel Fit", output_directory, params,
+                     material_params=dict(zip(material_params["Parameter"], material_params["Value"])),
+                     backend=backend_name, fit_time=result.wall_time)
         print(f"Fitted parameters and R2 values saved to {os.path.join(output_directory, 'material parameter.csv')}")
 
 if __name__ == "__main__":
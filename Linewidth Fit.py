@@ -11,6 +11,7 @@ import matplotlib.pyplot as plt
 import pandas as pd
 from lmfit import Model
 from sklearn.metrics import r2_score
+from results_db import save_results
 
 
 class LinewidthFittingApp:
@@ -94,7 +95,7 @@ class LinewidthFittingApp:
 
         material_df = pd.read_csv(material_file_path)
         gamma_row = material_df.loc[material_df['Parameter'] == 'gamma (GHz/T)']
-        gamma = 2 * np.pi * gamma_row['Value'].values[0]
+        gamma = 2 * np.pi * float(gamma_row['Value'].values[0])  # the column holds text once Material is stored
 
         file_path = os.path.join(output_directory, 'field domain parameters.csv')
         df = pd.read_csv(file_path)
@@ -136,7 +137,8 @@ class LinewidthFittingApp:
             plt.savefig(os.path.join(output_directory, "linewidth_fit.png"))
             plt.show()
 
-            # Update material parameter.csv with fitting results
+            # Update material parameter.csv with fitting results, replacing those of an earlier run
+            material_df = material_df[~material_df["Parameter"].isin(["Material", "alpha", "DH0 (Oe)"])]
             material_df = material_df._append(
                 {
                     "Parameter": "Material",
@@ -156,6 +158,10 @@ class LinewidthFittingApp:
                 }, ignore_index=True
             )
             material_df.to_csv(os.path.join(output_directory, 'material parameter.csv'), index=False)
+            save_results("Linewidth Fit", output_directory, dict(alpha=alpha, DH0=DH0),
+                         material_params={"Material": material_name, "alpha": result.params['alpha'].value,
+                                          "DH0 (Oe)": result.params['DH0'].value},
+                         backend="lmfit")
         else:
             print("Fitting process failed.")
 
@@ -7,12 +7,17 @@ import tkinter as tk
 from tkinter import filedialog, messagebox
 from tkinter import ttk
 import os
-import re
+import time
 from sklearn.metrics import r2_score
 import pandas as pd
 import matplotlib.pyplot as plt
-import numpy as np
-from lmfit import Model
+from fit_window import sort_by_field, window_around_peak
+from sweep_catalog import SweepCatalog
+from fit_backends import FIT_BACKENDS, get_backend, summarize_results
+from lineshapes import LINESHAPES, MIXED_LINESHAPES
+from results_db import save_results
+from prescreen import SCREEN_POLICIES, screen_spectra, report_screen
+from multiresolution import fit_coarse_to_fine
 
 class LorentzianFitGUI:
     def __init__(self, master):
@@ -20,7 +25,7 @@ class LorentzianFitGUI:
         master.title("Lorentzian Absorption Fit")
 
         # Set the window size
-        master.geometry("700x600")
+        master.geometry("700x680")
 
         # Change background color
         master.configure(bg="#f0f0f0")
@@ -53,6 +58,34 @@ class LorentzianFitGUI:
             param_entry.insert(0, default_values[i])
             self.param_entries.append(param_entry)
 
+        # Fit backend selection
+        backend_frame = tk.Frame(master, bg="#f0f0f0")
+        backend_frame.pack(pady=10)
+        backend_label = tk.Label(backend_frame, text="Fit Backend:", font=("Helvetica", 12), bg="#f0f0f0")
+        backend_label.pack(side="left", padx=5)
+        self.backend_combobox = ttk.Combobox(backend_frame, values=list(FIT_BACKENDS), state="readonly")
+        self.backend_combobox.set("lmfit")
+        self.backend_combobox.pack(side="left", padx=5)
+
+        # Pre-screen policy: spectra without a visible dip are skipped before fitting
+        screen_label = tk.Label(backend_frame, text="Pre-screen:", font=("Helvetica", 12), bg="#f0f0f0")
+        screen_label.pack(side="left", padx=5)
+        self.screen_combobox = ttk.Combobox(backend_frame, values=list(SCREEN_POLICIES), state="readonly", width=12)
+        self.screen_combobox.set("lenient")
+        self.screen_combobox.pack(side="left", padx=5)
+
+        # Fit an averaged window first, then the full data on +/- 5 linewidths around the coarse H_res
+        self.coarse_to_fine = tk.BooleanVar(value=False)
+        coarse_to_fine_check = tk.Checkbutton(master, text="Coarse-to-Fine Fitting (dense field steps)",
+                                              variable=self.coarse_to_fine, font=("Helvetica", 12), bg="#f0f0f0")
+        coarse_to_fine_check.pack(pady=5)
+
+        # Fit A_disp * dispersive Lorentzian + offset + slope * (H - H_res) along with the absorption dip
+        self.dispersive = tk.BooleanVar(value=False)
+        dispersive_check = tk.Checkbutton(master, text="Dispersive Term + Linear Background",
+                                          variable=self.dispersive, font=("Helvetica", 12), bg="#f0f0f0")
+        dispersive_check.pack(pady=5)
+
         # Run button
         run_button = tk.Button(master, text="Run", font=("Helvetica", 12, "bold"), bg="#4CAF50", fg="white", command=self.run_fit)
         run_button.pack(pady=20)
@@ -71,65 +104,78 @@ class LorentzianFitGUI:
     def run_fit(self):
         directory_path = self.path_entry.get()
         initial_params = [float(entry.get()) for entry in self.param_entries]
+        backend_name = self.backend_combobox.get()
+        screen_policy = self.screen_combobox.get()
 
         if not directory_path:
             messagebox.showerror("Error", "Please select a directory path.")
             return
 
         try:
-            self.perform_fit(directory_path, initial_params)
+            self.perform_fit(directory_path, initial_params, backend_name, screen_policy, self.coarse_to_fine.get(),
+                             self.dispersive.get())
             messagebox.showinfo("Success", "Lorentzian fitting completed and data saved.")
         except Exception as e:
             messagebox.showerror("Error", str(e))
 
-    def perform_fit(self, directory_path, initial_params):
+    def perform_fit(self, directory_path, initial_params, backend_name="lmfit", screen_policy="lenient",
+                    coarse_to_fine=False, dispersive=False):
+        start = time.perf_counter()
         path = os.path.join(directory_path, "plots")
         if not os.path.exists(path):
             os.makedirs(path)
 
         # Get a list of all CSV files in the directory with sorting
-        csv_files = [file for file in os.listdir(directory_path) if file.endswith(".csv")]
-        csv_files_sorted = sorted(csv_files, key=lambda x: int(re.search(r"(\d+)", x).group()))
-
-        # Update progress bar maximum value
-        self.progress["maximum"] = len(csv_files_sorted)
+        csv_files_sorted = SweepCatalog.load(directory_path, "*.csv").names()
 
-        ## Define S21 function
-        def S21(new_x, A, sigma, H_res):
-            return (A * sigma) / (np.pi * ((new_x - H_res) ** 2 + sigma ** 2))
+        ## S21 Lorentzian absorption model
+        lineshape = LINESHAPES[MIXED_LINESHAPES["S21"] if dispersive else "S21"]
+        extra_names = [name for name in lineshape.linear_names if name != "A"]
+        backend = get_backend(backend_name)
 
         # Initialize a DataFrame to store fitted parameters and R2 values
-        fitted_params_df = pd.DataFrame(columns=["Frequency (Hz)", "A", "LW", "H_res", "R2"])
+        fitted_params_df = pd.DataFrame(columns=["Frequency (Hz)", "A", "LW", "H_res"] + extra_names + ["R2"])
 
         freq_value = []
+        spectra, windows = [], []
+        delta_x = 120  # Half width of the fit window in Oe, adjust this value as needed
 
-        # Loop through each CSV file
-        for index, csv_file in enumerate(csv_files_sorted):
+        # Read each CSV file and cut the fit window
+        for csv_file in csv_files_sorted:
             fig_name = os.path.splitext(csv_file)[0]
             freq_value.append(fig_name)
             file_path = os.path.join(directory_path, csv_file)
             df = pd.read_csv(file_path)  # Read CSV data into a DataFrame
-            x_data = df['mag_field(oe)']
-            y_data = df['s21']
-            # Sort the magnetic field values in ascending order
-            sorted_indices = np.argsort(x_data)
-            x = np.array(x_data)[sorted_indices]
-            y = np.array(y_data)[sorted_indices]
+            # Sort the magnetic field values in ascending order (skipped when already sorted)
+            x, y = sort_by_field(df['mag_field(oe)'], df['s21'])
 
             # Now redefine the y range where there is a dip over a total length of 1000 oe field
-            min_y_index = np.argmin(y)
-            delta_x = 120  # Adjust this value as needed
-            x_min = x[min_y_index] - delta_x
-            x_max = x[min_y_index] + delta_x
-            new_x = x[(x >= x_min) & (x <= x_max)]
-            new_y = y[(x >= x_min) & (x <= x_max)]
-
-            # Fit each dataset to the Lorentzian model
-            model = Model(S21)
-            params = model.make_params(A=initial_params[0], sigma=initial_params[1], H_res=initial_params[2])
-            params['sigma'].min = 0  # Constrain LW to be non-negative
-            params['H_res'].set(min=0, max=2400)
-            result = model.fit(new_y, params, new_x=new_x)
+            spectra.append((x, y))
+            windows.append(window_around_peak(x, y, delta_x, peak="min"))
+
+        # Skip the spectra without a visible dip before fitting them
+        fit, reasons = screen_spectra(spectra, windows, screen_policy, kind="absorption")
+        screen_summary = report_screen([f"{fig_name}.csv" for fig_name in freq_value], fit, reasons)
+        freq_value, spectra, windows = (
+            [item for item, keep in zip(items, fit) if keep] for items in (freq_value, spectra, windows))
+
+        # Update progress bar maximum value
+        self.progress["maximum"] = len(freq_value)
+
+        # Fit each dataset to the Lorentzian model (LW constrained to be non-negative)
+        initial = dict(A=initial_params[0], sigma=initial_params[1], H_res=initial_params[2],
+                       **{name: 0.0 for name in extra_names})
+        bounds = {"sigma": (0, None), "H_res": (0, 2400)}
+        if coarse_to_fine:
+            # The R2 values and plots then refer to the adaptive +/- 5 linewidth windows
+            windows, results = fit_coarse_to_fine(backend, lineshape, spectra, windows, initial, bounds)
+        else:
+            results = backend.fit_many(lineshape, [w[0] for w in windows], [w[1] for w in windows], initial, bounds)
+
+        for index, (fig_name, (x, y), (new_x, new_y), result) in enumerate(zip(freq_value, spectra, windows, results)):
+            if result.best_fit is None:
+                print(f"Error fitting file {fig_name}.csv: {result.message}")
+                continue
 
             # Calculate R2 value
             y_fit = result.best_fit
@@ -142,9 +188,10 @@ class LorentzianFitGUI:
                 fitted_params_df = fitted_params_df._append(
                     {
                         "Frequency (Hz)": fig_name,
-                        "A": result.params["A"].value,
-                        "LW": result.params["sigma"].value * 2,
-                        "H_res": result.params["H_res"].value,
+                        "A": result.params["A"],
+                        "LW": result.params["sigma"] * 2,
+                        "H_res": result.params["H_res"],
+                        **{name: result.params[name] for name in extra_names},
                         "R2": r2,
                     },
                     ignore_index=True,
@@ -170,6 +217,13 @@ class LorentzianFitGUI:
         csv_file_path = os.path.join(path, "field domain parameters.csv")
         fitted_params_df.to_csv(csv_file_path, index=False)
         print(f"Fitted parameters and R2 values saved to {csv_file_path}")
+        save_results("Lorentzian Absorption Fit", directory_path,
+                     dict(initial, delta_x=delta_x, R2_threshold=0.9, screen_policy=screen_policy,
+                          coarse_to_fine=coarse_to_fine, dispersive=dispersive),
+                     fitted_params_df, backend=backend_name, wall_time=time.perf_counter() - start,
+                     fit_time=sum(result.wall_time for result in results))
+        print(screen_summary)
+        print(summarize_results(results))
 
 if __name__ == "__main__":
     root = tk.Tk()
@@ -0,0 +1,209 @@
+#-------------------------------------------------
+# Author:      Suraj Joshi
+# Created:     21-08-2024
+# Copyright:   (c) Suraj Joshi 2024
+#--------------------------------------------------
+import tkinter as tk
+from tkinter import filedialog, messagebox, ttk
+import os
+from sklearn.metrics import r2_score
+import pandas as pd
+import matplotlib.pyplot as plt
+import numpy as np
+from fit_window import sort_by_field
+from sweep_catalog import SweepCatalog
+from fit_backends import FIT_BACKENDS, get_backend, summarize_results
+from lineshapes import LINESHAPES
+from multi_peak import fit_multi_peak_spectra, track_modes
+
+
+class MultiResonanceFittingApp:
+    def __init__(self, master):
+        self.master = master
+        master.title("FMR Multi Resonance Fitting")
+
+        # Set window size and background color
+        master.geometry("500x760")
+        master.configure(bg="#f0f0f0")
+
+        # Add title label with styling
+        self.title_label = tk.Label(master, text="FMR Multi Resonance Fitting", font=("Helvetica", 16, "bold"),
+                                    bg="#3F51B5", fg="white", pady=10)
+        self.title_label.pack(fill="x")
+
+        self.label = tk.Label(master, text="Fit dS21/dH Data to a Sum of Lorentzian Resonances",
+                              font=("Helvetica", 12), bg="#f0f0f0")
+        self.label.pack(pady=10)
+
+        self.select_dir_button = tk.Button(master, text="Select Directory", font=("Helvetica", 10, "bold"),
+                                           bg="#4CAF50", fg="white", command=self.select_directory)
+        self.select_dir_button.pack(pady=5)
+
+        self.delta_x_entry = self.create_label_entry("Range around outer resonances (delta_H):", "150")
+        self.max_peaks_entry = self.create_label_entry("Maximum Resonances per Frequency:", "3")
+        self.prominence_entry = self.create_label_entry("Minimum Peak Prominence (fraction of max):", "0.1")
+        self.R2_entry = self.create_label_entry("R2 Value Threshold:", "0.9")
+        self.max_jump_entry = self.create_label_entry("Maximum H_res Jump between Frequencies (Oe):", "100")
+
+        self.lineshape_label = tk.Label(master, text="Lineshape:", font=("Helvetica", 12), bg="#f0f0f0")
+        self.lineshape_label.pack(pady=5)
+        self.lineshape_combobox = ttk.Combobox(master, values=["derivative_lorentzian", "skew_derivative_lorentzian"],
+                                               state="readonly")
+        self.lineshape_combobox.set("derivative_lorentzian")
+        self.lineshape_combobox.pack(pady=5)
+
+        self.backend_label = tk.Label(master, text="Fit Backend:", font=("Helvetica", 12), bg="#f0f0f0")
+        self.backend_label.pack(pady=5)
+        self.backend_combobox = ttk.Combobox(master, values=list(FIT_BACKENDS), state="readonly")
+        self.backend_combobox.set("batch_lm")
+        self.backend_combobox.pack(pady=5)
+
+        self.run_button = tk.Button(master, text="Run Fitting", font=("Helvetica", 10, "bold"), bg="#4CAF50",
+                                    fg="white", command=self.run_fitting)
+        self.run_button.pack(pady=20)
+
+        # Add the progress bar
+        self.progress = ttk.Progressbar(master, orient='horizontal', length=300, mode='determinate')
+        self.progress.pack(pady=5)
+
+        # Add the creator's name at the bottom
+        self.creator_label = tk.Label(master, text="Created by Suraj Chandra Joshi", font=("Helvetica", 10, "italic"),
+                                      bg="#f0f0f0", fg="#555555")
+        self.creator_label.pack(side="bottom", pady=10)
+
+        self.directory = None
+
+    def create_label_entry(self, label_text, default_value):
+        label = tk.Label(self.master, text=label_text, font=("Helvetica", 12), bg="#f0f0f0")
+        label.pack(pady=5)
+        entry = tk.Entry(self.master)
+        entry.insert(0, default_value)
+        entry.pack(pady=5)
+        return entry
+
+    def select_directory(self):
+        self.directory = filedialog.askdirectory()
+        if self.directory:
+            messagebox.showinfo("Selected Directory", f"Directory: {self.directory}")
+
+    def run_fitting(self):
+        if not self.directory:
+            messagebox.showwarning("Missing Information", "Please select a directory.")
+            return
+
+        try:
+            delta_x = float(self.delta_x_entry.get())
+            max_peaks = int(self.max_peaks_entry.get())
+            min_prominence = float(self.prominence_entry.get())
+            R2_threshold = float(self.R2_entry.get())
+            max_jump = float(self.max_jump_entry.get())
+
+            self.fit_multi_resonance(self.directory, self.directory, delta_x, max_peaks, min_prominence,
+                                     R2_threshold, max_jump, self.lineshape_combobox.get(),
+                                     self.backend_combobox.get())
+            messagebox.showinfo("Success", "Fitting completed successfully!")
+        except Exception as e:
+            messagebox.showerror("Error", f"An error occurred: {e}")
+
+    def fit_multi_resonance(self, input_directory, output_directory, delta_x, max_peaks, min_prominence,
+                            R2_threshold, max_jump, base_name="derivative_lorentzian", backend_name="batch_lm"):
+        path = os.path.join(output_directory, 'Multi Resonance Fits')
+        os.makedirs(path, exist_ok=True)
+
+        # Get a list of all CSV files in the directory with sorting
+        csv_files_sorted = SweepCatalog.load(input_directory, "*.csv").names()
+
+        self.progress["maximum"] = len(csv_files_sorted)
+        backend = get_backend(backend_name)
+        peak_param_names = LINESHAPES[base_name].param_names
+
+        spectra = []
+        for csv_file in csv_files_sorted:
+            df = pd.read_csv(os.path.join(input_directory, csv_file))
+            x, y = sort_by_field(df['Magnetic Field'], df['dS21/dH'])
+            spectra.append((os.path.splitext(csv_file)[0], x, y))
+
+        fits = fit_multi_peak_spectra(spectra, backend, delta_x, max_peaks, min_prominence, base_name)
+
+        # Keep the spectra whose multi-peak fit passes the R2 threshold
+        frequencies, peak_fields, peak_rows = [], [], []
+        for index, (fig_name, _, _) in enumerate(spectra):
+            if index in fits:
+                n_peaks, new_x, new_y, result = fits[index]
+                if result.best_fit is None:
+                    print(f"Error fitting file {fig_name}.csv: {result.message}")
+                else:
+                    r2 = r2_score(new_y, result.best_fit)
+                    if r2 > R2_threshold:
+                        rows = []
+                        for k in range(n_peaks):
+                            row = {"Frequency (Hz)": fig_name}
+                            row.update({name: result.params[f"{name}_{k}"] for name in peak_param_names})
+                            row["R2"] = r2
+                            rows.append(row)
+                        rows.sort(key=lambda row: row["H_res"])
+                        frequencies.append(float(fig_name))
+                        peak_fields.append([row["H_res"] for row in rows])
+                        peak_rows.append(rows)
+                    else:
+                        print(f"Low R2 value for file: {fig_name}.csv, R2: {r2}")
+
+            self.progress["value"] = index + 1
+            self.master.update_idletasks()
+
+        # Track the resonances across frequencies into modes
+        labels = track_modes(frequencies, peak_fields, max_jump)
+        all_rows = []
+        for rows, frequency_labels in zip(peak_rows, labels):
+            for row, mode in zip(rows, frequency_labels):
+                row["Mode"] = mode
+                all_rows.append(row)
+        fitted_params_df = pd.DataFrame(all_rows, columns=["Frequency (Hz)", "Mode"] + peak_param_names + ["R2"])
+        fitted_params_df.to_csv(os.path.join(path, "multi peak parameters.csv"), index=False)
+
+        # One field domain parameters file and Kittel fit per mode
+        kittel_model = LINESHAPES["f_kittel"]
+        branch_rows = []
+        for mode, mode_df in fitted_params_df.groupby("Mode"):
+            mode_df[["Frequency (Hz)", "A", "LW", "H_res", "R2"]].to_csv(
+                os.path.join(path, f"field domain parameters mode {mode}.csv"), index=False)
+            x_T = 1e-4 * mode_df["H_res"].to_numpy()
+            y = 1e-9 * mode_df["Frequency (Hz)"].astype(float).to_numpy()
+            plt.scatter(x_T, y, label=f"Mode {mode}")
+            if len(mode_df) < 4:
+                continue
+            with np.errstate(invalid="ignore"):
+                result = backend.fit(kittel_model, x_T, y, dict(M_eff=1, H_k=0.01, gamma=29))
+            if result.best_fit is None or not np.all(np.isfinite(result.best_fit)):
+                print(f"Kittel fit failed for mode {mode}: {result.message}")
+                continue
+            x_fit = np.linspace(x_T.min(), x_T.max(), 1000)
+            plt.plot(x_fit, result.eval(x_fit))
+            branch_rows.append({
+                "Mode": mode,
+                "Points": len(mode_df),
+                "M_eff (T)": result.params["M_eff"],
+                "H_k (T)": result.params["H_k"],
+                "gamma (GHz/T)": result.params["gamma"],
+                "g-factor": 2 * np.pi * result.params["gamma"] / 87.99,
+                "R2": r2_score(y, result.best_fit),
+            })
+
+        plt.xlabel("Magnetic Field (T)")
+        plt.ylabel("Frequency (GHz)")
+        plt.title("Kittel Branches of the Resonance Modes")
+        plt.legend()
+        plt.grid(True)
+        plt.savefig(os.path.join(path, "Kittel_branches.png"))
+        plt.clf()
+
+        csv_file_path = os.path.join(path, "kittel branches.csv")
+        pd.DataFrame(branch_rows).to_csv(csv_file_path, index=False)
+        print(f"Fitted parameters and Kittel branches saved to {path}")
+        print(summarize_results([fit[3] for fit in fits.values()]))
+
+
+if __name__ == "__main__":
+    root = tk.Tk()
+    app = MultiResonanceFittingApp(root)
+    root.mainloop()
@@ -0,0 +1,118 @@
+#-------------------------------------------------
+# Author:      Suraj Joshi
+# Created:     21-08-2024
+# Copyright:   (c) Suraj Joshi 2024
+#--------------------------------------------------
+import tkinter as tk
+from tkinter import filedialog, messagebox, ttk
+import os
+from fit_backends import FIT_BACKENDS
+from parameter_sweep import run_sweep
+
+
+class ParameterSweepApp:
+    def __init__(self, master):
+        self.master = master
+        master.title("FMR Fit Parameter Sweep")
+
+        # Set window size and background color
+        master.geometry("500x700")
+        master.configure(bg="#f0f0f0")
+
+        # Add title label with styling
+        self.title_label = tk.Label(master, text="FMR Fit Parameter Sweep", font=("Helvetica", 16, "bold"),
+                                    bg="#3F51B5", fg="white", pady=10)
+        self.title_label.pack(fill="x")
+
+        self.label = tk.Label(master, text="Grid Search of Fit Window and Initial Guesses (comma separated)",
+                              font=("Helvetica", 12), bg="#f0f0f0")
+        self.label.pack(pady=10)
+
+        self.select_dir_button = tk.Button(master, text="Select Directory", font=("Helvetica", 10, "bold"),
+                                           bg="#4CAF50", fg="white", command=self.select_directory)
+        self.select_dir_button.pack(pady=5)
+
+        self.delta_x_entry = self.create_label_entry("Range values (delta_H):", "100, 150, 200")
+        self.A_entry = self.create_label_entry("Initial Parameter A values:", "-15")
+        self.LW_entry = self.create_label_entry("Initial Parameter LW values:", "20, 40, 80")
+        self.H_res_entry = self.create_label_entry("Initial Parameter H_res values:", "100")
+        self.R2_entry = self.create_label_entry("R2 Value Thresholds:", "0.8, 0.9, 0.95")
+        self.workers_entry = self.create_label_entry("Worker Processes:", str(os.cpu_count() or 1))
+
+        self.backend_label = tk.Label(master, text="Fit Backend:", font=("Helvetica", 12), bg="#f0f0f0")
+        self.backend_label.pack(pady=5)
+        self.backend_combobox = ttk.Combobox(master, values=list(FIT_BACKENDS), state="readonly")
+        self.backend_combobox.set("lmfit")
+        self.backend_combobox.pack(pady=5)
+
+        self.run_button = tk.Button(master, text="Run Sweep", font=("Helvetica", 10, "bold"), bg="#4CAF50",
+                                    fg="white", command=self.run_parameter_sweep)
+        self.run_button.pack(pady=20)
+
+        # Add the progress bar
+        self.progress = ttk.Progressbar(master, orient='horizontal', length=300, mode='determinate')
+        self.progress.pack(pady=5)
+
+        # Add the creator's name at the bottom
+        self.creator_label = tk.Label(master, text="Created by Suraj Chandra Joshi", font=("Helvetica", 10, "italic"),
+                                      bg="#f0f0f0", fg="#555555")
+        self.creator_label.pack(side="bottom", pady=10)
+
+        self.directory = None
+
+    def create_label_entry(self, label_text, default_value):
+        label = tk.Label(self.master, text=label_text, font=("Helvetica", 12), bg="#f0f0f0")
+        label.pack(pady=5)
+        entry = tk.Entry(self.master)
+        entry.insert(0, default_value)
+        entry.pack(pady=5)
+        return entry
+
+    def select_directory(self):
+        self.directory = filedialog.askdirectory()
+        if self.directory:
+            messagebox.showinfo("Selected Directory", f"Directory: {self.directory}")
+
+    def run_parameter_sweep(self):
+        if not self.directory:
+            messagebox.showwarning("Missing Information", "Please select a directory.")
+            return
+
+        try:
+            def values(entry):
+                return [float(value) for value in entry.get().split(",") if value.strip()]
+
+            sweep_df = self.parameter_sweep(self.directory, values(self.delta_x_entry), values(self.A_entry),
+                                            values(self.LW_entry), values(self.H_res_entry), values(self.R2_entry),
+                                            self.backend_combobox.get(), int(self.workers_entry.get()))
+            best = sweep_df.iloc[0]
+            messagebox.showinfo("Success", f"Sweep completed!\nBest configuration: delta_H = {best['delta_x']:g}, "
+                                           f"A = {best['A']:g}, LW = {best['LW']:g}, H_res = {best['H_res']:g}, "
+                                           f"R2 > {best['R2 threshold']:g}\nYield: {best['Yield']:.0%}")
+        except Exception as e:
+            messagebox.showerror("Error", f"An error occurred: {e}")
+
+    def parameter_sweep(self, input_directory, delta_x_values, A_values, LW_values, H_res_values, r2_thresholds,
+                        backend_name="lmfit", max_workers=None):
+        def update_progress(done, total):
+            self.progress["maximum"] = total
+            self.progress["value"] = done
+            self.master.update_idletasks()
+
+        sweep_df = run_sweep(input_directory, delta_x_values, A_values, LW_values, H_res_values, r2_thresholds,
+                             backend_name, max_workers, update_progress)
+
+        # Stored next to the fit results so the sweep file is not picked up as a spectrum
+        path = os.path.join(input_directory, 'plots')
+        os.makedirs(path, exist_ok=True)
+        csv_file_path = os.path.join(path, "parameter sweep.csv")
+        sweep_df.to_csv(csv_file_path, index=False)
+        print(sweep_df.to_string())
+        print(f"Parameter sweep results saved to {csv_file_path}")
+        return sweep_df
+
+
+if __name__ == "__main__":
+    root = tk.Tk()
+    app = ParameterSweepApp(root)
+    root.mainloop()
@@ -0,0 +1,125 @@
+#-------------------------------------------------
+# Author:      Suraj Joshi
+# Created:     21-08-2024
+# Copyright:   (c) Suraj Joshi 2024
+#--------------------------------------------------
+import tkinter as tk
+from tkinter import filedialog, messagebox, ttk
+import os
+import pandas as pd
+import matplotlib.pyplot as plt
+from sweep_store import load_sweep
+from background import BACKGROUND_MODELS, subtract_background
+from resonance_map import MAP_QUANTITIES, map_values, plot_resonance_map, overlay_resonances
+
+
+class ResonanceMapApp:
+    def __init__(self, master):
+        self.master = master
+        master.title("FMR Resonance Map")
+
+        # Set window size and background color
+        master.geometry("500x560")
+        master.configure(bg="#f0f0f0")
+
+        # Add title label with styling
+        self.title_label = tk.Label(master, text="FMR Resonance Map", font=("Helvetica", 16, "bold"), bg="#3F51B5",
+                                    fg="white", pady=10)
+        self.title_label.pack(fill="x")
+
+        self.label = tk.Label(master, text="Field x Frequency Map of the Whole Sweep", font=("Helvetica", 12),
+                              bg="#f0f0f0")
+        self.label.pack(pady=10)
+
+        self.select_dir_button = tk.Button(master, text="Select Trace Directory", font=("Helvetica", 10, "bold"),
+                                           bg="#4CAF50", fg="white", command=self.select_directory)
+        self.select_dir_button.pack(pady=5)
+
+        self.select_params_button = tk.Button(master, text="Select Fit Results Directory (optional)",
+                                              font=("Helvetica", 10, "bold"), bg="#4CAF50", fg="white",
+                                              command=self.select_params_directory)
+        self.select_params_button.pack(pady=5)
+
+        self.quantity_label = tk.Label(master, text="Colour:", font=("Helvetica", 12), bg="#f0f0f0")
+        self.quantity_label.pack(pady=5)
+        self.quantity_combobox = ttk.Combobox(master, values=MAP_QUANTITIES, state="readonly")
+        self.quantity_combobox.set(MAP_QUANTITIES[0])
+        self.quantity_combobox.pack(pady=5)
+
+        self.background_label = tk.Label(master, text="Background Model:", font=("Helvetica", 12), bg="#f0f0f0")
+        self.background_label.pack(pady=5)
+        self.background_combobox = ttk.Combobox(master, values=list(BACKGROUND_MODELS), state="readonly")
+        self.background_combobox.set("median")
+        self.background_combobox.pack(pady=5)
+
+        self.run_button = tk.Button(master, text="Show Map", font=("Helvetica", 10, "bold"), bg="#4CAF50",
+                                    fg="white", command=self.show_map)
+        self.run_button.pack(pady=20)
+
+        # Add the creator's name at the bottom
+        self.creator_label = tk.Label(master, text="Created by Suraj Chandra Joshi", font=("Helvetica", 10, "italic"),
+                                      bg="#f0f0f0", fg="#555555")
+        self.creator_label.pack(side="bottom", pady=10)
+
+        self.directory = None
+        self.params_directory = None
+        self.cube = None  # (directory, fields, freq_values, values, times) of the last loaded sweep
+
+    def select_directory(self):
+        self.directory = filedialog.askdirectory()
+        if self.directory:
+            messagebox.showinfo("Selected Directory", f"Directory: {self.directory}")
+
+    def select_params_directory(self):
+        self.params_directory = filedialog.askdirectory()
+        if self.params_directory:
+            messagebox.showinfo("Selected Directory", f"Directory: {self.params_directory}")
+
+    def show_map(self):
+        if not self.directory:
+            messagebox.showwarning("Missing Information", "Please select a trace directory.")
+            return
+
+        try:
+            self.render_map(self.directory, self.params_directory, self.quantity_combobox.get(),
+                            self.background_combobox.get())
+            plt.show()
+        except Exception as e:
+            messagebox.showerror("Error", f"An error occurred: {e}")
+
+    def render_map(self, directory, params_directory=None, quantity="background-removed S21",
+                   background_model="median"):
+        # The sweep stays in memory, so switching colour or background model does not re-read it
+        if self.cube is None or self.cube[0] != directory:
+            self.cube = (directory,) + load_sweep(directory)
+        _, fields, freq_values, values, times = self.cube
+        values = map_values(fields, subtract_background(values, fields, times, background_model), quantity)
+
+        fig, ax = plt.subplots(figsize=(9, 6))
+        image = plot_resonance_map(ax, fields, freq_values, values)
+        fig.colorbar(image, ax=ax, label=quantity)
+        ax.set_title("FMR Resonance Map")
+
+        # Fitted H_res(f) of the Lorentzian fits and the Kittel curve, when available
+        if params_directory:
+            params_path = os.path.join(params_directory, "field domain parameters.csv")
+            material_path = os.path.join(params_directory, "material parameter.csv")
+            if os.path.exists(params_path):
+                df = pd.read_csv(params_path)
+                kittel_params = None
+                if os.path.exists(material_path):
+                    material = pd.read_csv(material_path).set_index("Parameter")["Value"]
+                    # the Value column holds text once Linewidth Fit has stored the material
+                    kittel_params = dict(M_eff=float(material["M_eff (T)"]), H_k=float(material["H_k (T)"]),
+                                         gamma=float(material["gamma (GHz/T)"]))
+                overlay_resonances(ax, df["H_res"], df["Frequency (Hz)"], kittel_params)
+
+        fig.savefig(os.path.join(directory, "resonance map.png"))
+        print(f"Resonance map saved to {os.path.join(directory, 'resonance map.png')}")
+        return fig
+
+
+if __name__ == "__main__":
+    root = tk.Tk()
+    app = ResonanceMapApp(root)
+    root.mainloop()
@@ -0,0 +1,148 @@
+#-------------------------------------------------
+# Author:      Suraj Joshi
+# Created:     21-08-2024
+# Copyright:   (c) Suraj Joshi 2024
+#--------------------------------------------------
+# Acquisition of a sweep over a local socket instead of from a folder of .txt traces. The instrument
+# side (or vna_simulator.py) sends one frame per field step:
+#   header  magic b"FMR1", n_freq (uint32), n_columns (uint32), field in Oe (float64),
+#           send time in s since the epoch (float64), little endian
+#   data    n_freq x n_columns float64 values, row by row, as the columns of a .txt trace
+#           (frequency in Hz, S21, optionally the imaginary part of S21)
+# and a frame with n_freq = 0 at the end of the sweep. The client reads the frames with asyncio,
+# optionally writes every trace as <field>.txt while the sweep runs (the folder the steps read), and
+# builds the field x frequency array with build_sweep_cube, the loader behind process_files and
+# convert_freq_to_field; cube_records of streaming.py turns it into per-frequency records.
+#
+# Command line (with "python vna_simulator.py --port 5025" running):
+#   python acquisition.py --port 5025 [--directory D:/data/sample] [--complex]
+import os
+import sys
+import time
+import struct
+import asyncio
+import argparse
+import numpy as np
+from sweep_cube import build_sweep_cube
+
+MAGIC = b"FMR1"
+HEADER = struct.Struct("<4sIIdd")
+DEFAULT_PORT = 5025
+
+
+def pack_frame(field, trace, sent_time=None):
+    trace = np.ascontiguousarray(trace, dtype="<f8")
+    header = HEADER.pack(MAGIC, trace.shape[0], trace.shape[1], field, time.time() if sent_time is None else sent_time)
+    return header + trace.tobytes()
+
+
+def end_frame():
+    return HEADER.pack(MAGIC, 0, 0, 0.0, time.time())
+
+
+def trace_file_name(field):
+    # "250.txt", "12.5.txt": the field value as the steps parse it back from the name
+    return np.format_float_positional(field, trim="-") + ".txt"
+
+
+async def read_frames(reader):
+    # Async generator of (field, trace, sent_time, received_time) up to the end frame
+    while True:
+        header = await reader.readexactly(HEADER.size)
+        magic, n_freq, n_columns, field, sent_time = HEADER.unpack(header)
+        if magic != MAGIC:
+            raise ValueError("Not an FMR trace stream (bad frame header).")
+        if n_freq == 0:
+            return
+        data = await reader.readexactly(8 * n_freq * n_columns)
+        trace = np.frombuffer(data, dtype="<f8").reshape(n_freq, n_columns)
+        yield field, trace, sent_time, time.time()
+
+
+class AcquiredSweep:
+    # Traces of one sweep in arrival order with their send and receive times
+    def __init__(self):
+        self.fields = []
+        self.traces = []
+        self.sent_times = []
+        self.received_times = []
+        self.start = time.perf_counter()
+        self.end = None
+
+    def add(self, field, trace, sent_time, received_time):
+        self.fields.append(field)
+        self.traces.append(trace)
+        self.sent_times.append(sent_time)
+        self.received_times.append(received_time)
+
+    def cube(self, complex_values=False):
+        # (fields, freq_values, values, times) as load_sweep_cube returns them; times are the send times
+        return build_sweep_cube(self.fields, self.traces, self.sent_times, complex_values)
+
+    def stats(self):
+        n_traces = len(self.traces)
+        duration = ((self.end or time.perf_counter()) - self.start) or float("nan")
+        latency = 1e3 * (np.array(self.received_times) - np.array(self.sent_times))
+        n_bytes = sum(trace.nbytes for trace in self.traces)
+        return dict(traces=n_traces, duration=duration, traces_per_s=n_traces / duration,
+                    MB_per_s=n_bytes / 1e6 / duration,
+                    latency_ms_mean=float(latency.mean()) if n_traces else float("nan"),
+                    latency_ms_p95=float(np.percentile(latency, 95)) if n_traces else float("nan"),
+                    latency_ms_max=float(latency.max()) if n_traces else float("nan"))
+
+    def report(self):
+        stats = self.stats()
+        return (f"Acquired {stats['traces']} traces in {stats['duration']:.2f} s: {stats['traces_per_s']:.0f} traces/s, "
+                f"{stats['MB_per_s']:.1f} MB/s, latency {stats['latency_ms_mean']:.2f} ms mean / "
+                f"{stats['latency_ms_p95']:.2f} ms p95 / {stats['latency_ms_max']:.2f} ms max")
+
+
+async def acquire(host="127.0.0.1", port=DEFAULT_PORT, directory=None, on_trace=None):
+    # Receive one sweep. With directory, every trace is written as <field>.txt in a worker thread
+    # while the next frames arrive; on_trace(field, trace) is called for every frame.
+    reader, writer = await asyncio.open_connection(host, port)
+    sweep = AcquiredSweep()
+    loop = asyncio.get_running_loop()
+    writes = []
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    try:
+        async for field, trace, sent_time, received_time in read_frames(reader):
+            sweep.add(field, trace, sent_time, received_time)
+            if on_trace is not None:
+                on_trace(field, trace)
+            if directory:
+                writes.append(loop.run_in_executor(None, np.savetxt,
+                                                   os.path.join(directory, trace_file_name(field)), trace))
+        await asyncio.gather(*writes)
+    finally:
+        writer.close()
+        await writer.wait_closed()
+    sweep.end = time.perf_counter()
+    return sweep
+
+
+def acquire_sweep(host="127.0.0.1", port=DEFAULT_PORT, directory=None, on_trace=None):
+    # Blocking form of acquire() for the step scripts
+    return asyncio.run(acquire(host, port, directory, on_trace))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Receive one FMR sweep from an instrument or the simulator.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--directory", help="write the traces as <field>.txt files here")
+    parser.add_argument("--complex", action="store_true", help="keep the imaginary part in the array")
+    args = parser.parse_args(argv)
+
+    sweep = acquire_sweep(args.host, args.port, args.directory)
+    print(sweep.report())
+    start = time.perf_counter()
+    fields, freq_values, values, _ = sweep.cube(args.complex)
+    print(f"Field x frequency array {values.shape} ({fields.min():g} to {fields.max():g} Oe, "
+          f"{freq_values.min() / 1e9:g} to {freq_values.max() / 1e9:g} GHz) in {time.perf_counter() - start:.3f} s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
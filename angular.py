@@ -0,0 +1,112 @@
+#-------------------------------------------------
+# Author:      Suraj Joshi
+# Created:     21-08-2024
+# Copyright:   (c) Suraj Joshi 2024
+#--------------------------------------------------
+# Angle-dependent FMR of a thin film: Smit-Beljers resonance condition with the equilibrium
+# magnetization angle solved for all (angle, field) points at once.
+# theta_H is the angle of the applied field from the film normal (0 = out of plane, 90 = in plane),
+# theta that of the magnetization; fields are in T and gamma in GHz/T, as in the Kittel fit.
+# Free energy per unit magnetization, with the field rotated in the plane of the in-plane easy axis:
+#   E = -H cos(theta - theta_H) + M_eff/2 cos^2 theta - H_4perp/4 cos^4 theta - H_k/2 sin^2 theta cos^2 phi
+#   (f / gamma)^2 = E_thetatheta * E_phiphi / sin^2 theta          (at the equilibrium theta, phi = 0)
+# In plane (theta_H = 90) this reduces to the Kittel form gamma * sqrt((H + H_k) (H + H_k + M_eff)).
+import os
+import re
+import numpy as np
+import pandas as pd
+from lineshapes import Lineshape
+from results_db import sample_from_directory
+
+MAX_NEWTON_STEP = 0.1  # rad
+
+
+def energy_derivatives(theta, theta_H, H, M_eff, H_k, H_4perp):
+    # dE/dtheta and d2E/dtheta2 at phi = 0
+    sin, cos = np.sin(theta), np.cos(theta)
+    M = M_eff + H_k
+    E_theta = H * np.sin(theta - theta_H) - M * sin * cos + H_4perp * cos ** 3 * sin
+    E_thetatheta = H * np.cos(theta - theta_H) - M * (cos ** 2 - sin ** 2) + \
+        H_4perp * (cos ** 4 - 3 * cos ** 2 * sin ** 2)
+    return E_theta, E_thetatheta
+
+
+def equilibrium_angle(theta_H, H, M_eff, H_k=0.0, H_4perp=0.0, tol=1e-12, max_iter=100):
+    # Damped Newton iterations on all points together, starting from the field direction. Points
+    # with non-positive curvature take a fixed step downhill; converged points are frozen.
+    theta_H, H = np.broadcast_arrays(np.asarray(theta_H, dtype=float), np.asarray(H, dtype=float))
+    theta = theta_H.copy()
+    active = np.ones(theta.shape, dtype=bool)
+    for _ in range(max_iter):
+        E_theta, E_thetatheta = energy_derivatives(theta[active], theta_H[active], H[active], M_eff, H_k, H_4perp)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            step = np.where(E_thetatheta > 0, -E_theta / E_thetatheta,
+                            np.where(E_theta > 0, -MAX_NEWTON_STEP, MAX_NEWTON_STEP))
+        step = np.clip(step, -MAX_NEWTON_STEP, MAX_NEWTON_STEP)
+        theta[active] += step
+        still_active = np.abs(step) > tol
+        if not still_active.any():
+            break
+        active[active] = still_active
+    return theta
+
+
+def smit_beljers_frequency(x, M_eff, H_k, H_4perp, gamma):
+    # x: (n, 2) array of (theta_H in rad, H in T); returns the resonance frequency in GHz
+    x = np.asarray(x, dtype=float)
+    theta_H, H = x[:, 0], x[:, 1]
+    theta = equilibrium_angle(theta_H, H, M_eff, H_k, H_4perp)
+    _, E_thetatheta = energy_derivatives(theta, theta_H, H, M_eff, H_k, H_4perp)
+
+    # E_phiphi / sin^2 theta = H sin(theta_H) / sin(theta) + H_k; near the normal the ratio is taken
+    # from the equilibrium condition instead, which has no 0 / 0 there
+    sin, cos = np.sin(theta), np.cos(theta)
+    near_plane = np.abs(sin) >= np.abs(cos)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = np.where(near_plane, H * np.sin(theta_H) / sin,
+                         H * np.cos(theta_H) / cos - (M_eff + H_k) + H_4perp * cos ** 2)
+    return gamma * np.sqrt(np.clip(E_thetatheta * (ratio + H_k), 0, None))
+
+
+def smit_beljers_jacobian(x, M_eff, H_k, H_4perp, gamma, step=1e-7):
+    # Central differences; every column is two batched solves over all points
+    params = np.array([M_eff, H_k, H_4perp, gamma], dtype=float)
+    columns = []
+    for k in range(len(params)):
+        delta = step * max(abs(params[k]), 1.0)
+        high, low = params.copy(), params.copy()
+        high[k] += delta
+        low[k] -= delta
+        columns.append((smit_beljers_frequency(x, *high) - smit_beljers_frequency(x, *low)) / (2 * delta))
+    return columns
+
+
+SMIT_BELJERS = Lineshape("smit_beljers", smit_beljers_frequency, smit_beljers_jacobian,
+                         ["M_eff", "H_k", "H_4perp", "gamma"])
+
+
+def folder_angle(directory):
+    # Field angle in degrees from the name of a sample folder: a number followed by "deg" or a degree
+    # sign ("FeGaB 10nm 45deg"), otherwise the last number in the name ("theta=-30.5")
+    name = sample_from_directory(directory)
+    numbers = re.findall(r"(-?\d+(?:\.\d+)?)\s*(?:deg|\u00b0)", name) or re.findall(r"-?\d+(?:\.\d+)?", name)
+    return float(numbers[-1]) if numbers else None
+
+
+def collect_angle_series(directory, results_folder="plots"):
+    # Every "field domain parameters.csv" below directory written to a results_folder folder (one
+    # sample folder per angle), as one DataFrame with the columns Angle (deg), Frequency (Hz), H_res, Source
+    frames = []
+    for root, _, files in os.walk(directory):
+        if "field domain parameters.csv" not in files or os.path.basename(root) != results_folder:
+            continue
+        angle = folder_angle(root)
+        if angle is None:
+            print(f"Skipped {root}: no angle in the folder name")
+            continue
+        df = pd.read_csv(os.path.join(root, "field domain parameters.csv"))
+        frames.append(pd.DataFrame({"Angle (deg)": angle, "Frequency (Hz)": df["Frequency (Hz)"].astype(float),
+                                    "H_res": df["H_res"].astype(float), "Source": root}))
+    if not frames:
+        return pd.DataFrame(columns=["Angle (deg)", "Frequency (Hz)", "H_res", "Source"])
+    return pd.concat(frames, ignore_index=True).sort_values(["Angle (deg)", "H_res"], ignore_index=True)
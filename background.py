@@ -0,0 +1,77 @@
+#-------------------------------------------------
+# Author:      Suraj Joshi
+# Created:     21-08-2024
+# Copyright:   (c) Suraj Joshi 2024
+#--------------------------------------------------
+# Background models for the field x frequency S21 array of a sweep (rows: fields, columns: frequencies).
+# Every model is a handful of whole-array NumPy operations, so it costs O(data) per sweep.
+import numpy as np
+
+
+def resonance_mask(values, threshold=5.0, dilation=2):
+    # True where a point belongs to a resonance: its deviation from the median over fields exceeds
+    # threshold robust standard deviations (MAD) of that frequency, grown by dilation field steps
+    median = np.median(values, axis=0)
+    deviation = np.abs(values - median)
+    mad = 1.4826 * np.median(deviation, axis=0)
+    core = deviation > threshold * np.maximum(mad, np.finfo(float).tiny)
+    mask = core.copy()
+    for shift in range(1, dilation + 1):
+        mask[shift:] |= core[:-shift]
+        mask[:-shift] |= core[shift:]
+    return mask
+
+
+def first_trace_background(values, fields, times, order=1):
+    # Original behaviour: the trace of the first (lowest) field step is the background
+    return values[:1]
+
+
+def median_background(values, fields, times, order=1):
+    # Median over all fields of each frequency, excluding the resonance band
+    mask = resonance_mask(values)
+    masked = np.where(mask, np.nan, values)
+    reference = np.median(values, axis=0)
+    with np.errstate(all="ignore"):
+        # Frequencies masked at every field keep the plain median
+        reference = np.where(mask.all(axis=0), reference, np.nanmedian(masked, axis=0))
+    return reference[None, :]
+
+
+def median_drift_background(values, fields, times, order=1):
+    # Median reference plus a per-field polynomial drift (in frequency) of the given order,
+    # fitted outside the resonance band for all fields at once through batched normal equations
+    reference = median_background(values, fields, times)
+    residual = values - reference
+    weights = (~resonance_mask(values)).astype(float)
+
+    n_freq = values.shape[1]
+    V = np.vander(np.linspace(-1, 1, n_freq), order + 1, increasing=True)
+    normal = np.einsum("ij,jp,jq->ipq", weights, V, V) + 1e-12 * np.eye(order + 1)
+    rhs = np.einsum("ij,jp,ij->ip", weights, V, residual)
+    coefficients = np.linalg.solve(normal, rhs[:, :, None])[:, :, 0]
+    return reference + coefficients @ V.T
+
+
+def interpolated_background(values, fields, times, order=1):
+    # Reference interpolated linearly in acquisition time between the first and last recorded traces
+    # (file modification times; the field order is used when the times carry no information)
+    times = np.asarray(times, dtype=float)
+    if times.size < 2 or np.ptp(times) == 0:
+        times = np.arange(values.shape[0], dtype=float)
+    start = np.argmin(times)
+    end = np.argmax(times)
+    weight = (times - times[start]) / (times[end] - times[start])
+    return values[start] + weight[:, None] * (values[end] - values[start])
+
+
+BACKGROUND_MODELS = {
+    "median": median_background,
+    "median + drift": median_drift_background,
+    "interpolated": interpolated_background,
+    "first trace": first_trace_background,
+}
+
+
+def subtract_background(values, fields, times, model="median", order=1):
+    return values - BACKGROUND_MODELS[model](values, fields, times, order)
@@ -0,0 +1,466 @@
+#-------------------------------------------------
+# Author:      Suraj Joshi
+# Created:     21-08-2024
+# Copyright:   (c) Suraj Joshi 2024
+#--------------------------------------------------
+# Micro-benchmarks for the shared processing helpers.
+# Run all of them with "python benchmarks.py" or a single one with "python benchmarks.py fit_window".
+import os
+import sys
+import pickle
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+from fit_window import window_around_peak
+from fit_backends import FIT_BACKENDS, get_backend, summarize_results
+from lineshapes import LINESHAPES
+from trace_reader import read_traces, check_frequency_axis
+from resonance_map import plot_resonance_map
+from multiresolution import fit_coarse_to_fine
+from angular import equilibrium_angle
+from shared_spectra import SharedSpectra, fit_shared
+from acquisition import acquire
+from vna_simulator import serve
+from sweep_cube import load_sweep_cube
+from resample import resample_cube, uniform_grid, gap_mask
+from kernels import available_kernels, get_kernel, select_kernels, active_kernels, validate_kernel
+from streaming import (cube_records, sweep_records, csv_records, derivative_records, csv_sink, field_domain_fits,
+                       CONVERSION_COLUMNS, DERIVATIVE_COLUMNS)
+
+
+def measure(function, *args, repeat=5):
+    # Best wall time (s) and peak traced memory (MB) of function(*args)
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    function(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak / 1e6
+
+
+def bench_fit_window(n_points=1_000_000, delta_x=150):
+    # Old argsort + boolean-mask windowing versus the searchsorted views of fit_window
+    x = np.linspace(0, 5000, n_points)
+    y = -x * 50 / ((x - 2500) ** 2 + 20 ** 2) ** 2
+
+    def mask_window(x_data, y_data):
+        sorted_indices = np.argsort(x_data)
+        x = np.array(x_data)[sorted_indices]
+        y = np.array(y_data)[sorted_indices]
+        min_y_index = np.argmax(y)
+        x_min = x[min_y_index] - delta_x
+        x_max = x[min_y_index] + delta_x
+        return x[(x >= x_min) & (x <= x_max)], y[(x >= x_min) & (x <= x_max)]
+
+    old_time, old_memory = measure(mask_window, x, y)
+    new_time, new_memory = measure(window_around_peak, x, y, delta_x)
+    print(f"fit_window ({n_points} points): mask {old_time * 1e3:.2f} ms / {old_memory:.1f} MB, "
+          f"searchsorted {new_time * 1e3:.2f} ms / {new_memory:.1f} MB")
+
+
+def bench_fit_backends(n_spectra=200, n_points=300):
+    # Same noisy derivative Lorentzian spectra fitted with every registered backend
+    rng = np.random.default_rng(0)
+    lineshape = LINESHAPES["derivative_lorentzian"]
+    x = np.linspace(0, 500, n_points)
+    H_res = rng.uniform(200, 300, n_spectra)
+    ys = [lineshape(x, -15, H, 40) + rng.normal(0, 1e-5, n_points) for H in H_res]
+    initials = [dict(A=-10, LW=30, H_res=H + 10) for H in H_res]
+    for name in FIT_BACKENDS:
+        start = time.perf_counter()
+        results = get_backend(name).fit_many(lineshape, [x] * n_spectra, ys, initials, {"LW": (0, None)})
+        elapsed = time.perf_counter() - start
+        max_error = max(abs(result.params["H_res"] - H) for result, H in zip(results, H_res))
+        print(f"fit_backends: {summarize_results(results)}, total {elapsed:.3f} s, max |dH_res| {max_error:.2e} Oe")
+
+
+def bench_trace_reader(n_files=1000, n_freq=1001):
+    # Reading a synthetic sweep of two-column .txt traces: np.loadtxt per file versus read_traces
+    rng = np.random.default_rng(0)
+    freq_values = np.linspace(1e9, 20e9, n_freq)
+    with tempfile.TemporaryDirectory() as directory:
+        file_paths = [os.path.join(directory, f"{10 * i}.txt") for i in range(n_files)]
+        for file_path in file_paths:
+            np.savetxt(file_path, np.column_stack([freq_values, rng.normal(-20, 1, n_freq)]))
+
+        def loadtxt_sweep():
+            return [np.loadtxt(file_path) for file_path in file_paths]
+
+        def reader_sweep(max_workers):
+            traces = read_traces(file_paths, max_workers)
+            check_frequency_axis(file_paths, traces)
+            return traces
+
+        identical = all(np.array_equal(a, b) for a, b in zip(loadtxt_sweep(), reader_sweep(None)))
+        old_time, _ = measure(loadtxt_sweep, repeat=2)
+        serial_time, _ = measure(reader_sweep, 1, repeat=2)
+        threaded_time, _ = measure(reader_sweep, None, repeat=2)
+    print(f"trace_reader ({n_files} files x {n_freq} rows): loadtxt {old_time:.2f} s, "
+          f"read_traces serial {serial_time:.2f} s, threaded {threaded_time:.2f} s, identical {identical}")
+
+
+def bench_resonance_map(n_fields=5000, n_freq=5000):
+    # Rendering the field x frequency map of a large sweep to a PNG buffer (Agg)
+    import io
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    fields = np.linspace(0, 10000, n_fields)
+    freq_values = np.linspace(1e9, 40e9, n_freq)
+    H_res = (-1.0 + np.sqrt(1 + 4 * (freq_values * 1e-9 / 29) ** 2)) / 2 * 1e4
+    values = -400 / ((fields[:, None] - H_res[None, :]) ** 2 + 400)
+
+    def render():
+        fig, ax = plt.subplots(figsize=(9, 6))
+        plot_resonance_map(ax, fields, freq_values, values)
+        fig.savefig(io.BytesIO(), format="png")
+        plt.close(fig)
+
+    elapsed, memory = measure(render, repeat=3)
+    print(f"resonance_map ({n_fields} x {n_freq}): {elapsed:.3f} s / {memory:.1f} MB")
+
+
+def bench_kernels(n_spectra=200, n_points=300):
+    # Residual and Jacobian of a batch of windows: reference functions with np.stack versus every
+    # available kernel set (allocating, and into preallocated outputs), then least_squares and batch_lm
+    # fits with each set; the first call of a set (numba compilation, validation) is not timed
+    rng = np.random.default_rng(0)
+    cases = {
+        "derivative_lorentzian": (np.linspace(1000, 1400, n_points), (-15, 1200, 40), dict(A=-10, H_res=1180, LW=50)),
+        "skew_derivative_lorentzian": (np.linspace(1000, 1400, n_points), (-15, 1200, 40, 1e-3),
+                                       dict(A=-10, H_res=1180, LW=50, alpha=0)),
+        "S21": (np.linspace(1000, 1400, n_points), (-20, 20, 1200), dict(A=-15, sigma=25, H_res=1190)),
+        "f_kittel": (np.linspace(0.05, 1, n_points), (1.0, 0.01, 28), dict(M_eff=0.8, H_k=0.0, gamma=27)),
+    }
+    previous = active_kernels()
+    for name, (x, true, initial) in cases.items():
+        lineshape = LINESHAPES[name]
+        X = np.tile(x, (n_spectra, 1))
+        P = np.array(true) * rng.uniform(0.98, 1.02, (n_spectra, len(true)))
+        Y = lineshape.function(X, *(P[:, k:k + 1] for k in range(len(true)))) + rng.normal(0, 1e-4, X.shape)
+        columns = [P[:, k:k + 1] for k in range(len(true))]
+
+        def reference():
+            return lineshape.function(X, *columns) - Y, np.stack(lineshape.jacobian(X, *columns), axis=-1)
+
+        reference_time, reference_memory = measure(reference, repeat=20)
+        lines = [f"reference {1e3 * reference_time:.2f} ms / {reference_memory:.1f} MB"]
+        for kernel_set in available_kernels()[:-1]:
+            kernel = get_kernel(lineshape, kernel_set)
+            error = max(validate_kernel(kernel).values())
+            r, J = kernel.residual_jacobian(X, Y, P)
+            kernel_time, kernel_memory = measure(kernel.residual_jacobian, X, Y, P, repeat=20)
+            out_time, out_memory = measure(kernel.residual_jacobian, X, Y, P, r, J, repeat=20)
+            lines.append(f"{kernel_set} {1e3 * kernel_time:.2f} ms / {kernel_memory:.1f} MB, into outputs "
+                         f"{1e3 * out_time:.2f} ms / {out_memory:.1f} MB (max error {error:.0e})")
+        print(f"kernels {name} ({n_spectra} x {n_points}) residual + Jacobian: " + "; ".join(lines))
+
+        ys = [row for row in Y[:50]]
+        for backend_name in ("least_squares", "batch_lm"):
+            fits = []
+            for kernel_set in available_kernels():
+                select_kernels(kernel_set)
+                get_backend(backend_name).fit_many(lineshape, [x] * 2, ys[:2], initial)
+                start = time.perf_counter()
+                results = get_backend(backend_name).fit_many(lineshape, [x] * len(ys), ys, initial)
+                elapsed = time.perf_counter() - start
+                fits.append((kernel_set, elapsed, results))
+            reference_results = fits[-1][2]
+            print(f"kernels {name} {backend_name} ({len(ys)} fits): " + ", ".join(
+                f"{kernel_set} {elapsed:.3f} s (max |dp| "
+                f"{max(abs(a.params[k] - b.params[k]) for a, b in zip(results, reference_results) for k in a.params):.0e})"
+                for kernel_set, elapsed, results in fits))
+    select_kernels(previous)
+
+
+def bench_multiresolution(n_spectra=50, field_step=0.01, delta_x=150):
+    # Sub-Oe field steps: direct fit of the delta_x window versus coarse-to-fine
+    rng = np.random.default_rng(0)
+    lineshape = LINESHAPES["derivative_lorentzian"]
+    x = np.arange(0, 500, field_step)
+    H_res = rng.uniform(200, 300, n_spectra)
+    LW = rng.uniform(10, 40, n_spectra)
+    spectra = [(x, lineshape(x, -15, H, width) + rng.normal(0, 1e-4, x.size)) for H, width in zip(H_res, LW)]
+    windows = [window_around_peak(x, y, delta_x, peak="max") for x, y in spectra]
+    initials, bounds = [dict(A=-10, LW=30, H_res=H + 10) for H in H_res], {"LW": (0, None)}
+    for name in ("lmfit", "batch_lm"):
+        backend = get_backend(name)
+        start = time.perf_counter()
+        direct = backend.fit_many(lineshape, [w[0] for w in windows], [w[1] for w in windows], initials, bounds)
+        direct_time = time.perf_counter() - start
+        start = time.perf_counter()
+        _, refined = fit_coarse_to_fine(backend, lineshape, spectra, windows, initials, bounds)
+        refined_time = time.perf_counter() - start
+        for label, results, elapsed in (("direct", direct, direct_time), ("coarse-to-fine", refined, refined_time)):
+            max_error = max(abs(result.params["H_res"] - H) for result, H in zip(results, H_res))
+            print(f"multiresolution {name} {label} ({len(windows[0][0])}-point windows): "
+                  f"{sum(result.nfev for result in results)} function evaluations, {elapsed:.3f} s, "
+                  f"max |dH_res| {max_error:.2e} Oe")
+
+
+def bench_varpro(n_spectra=300, n_points=2000):
+    # Dispersive admixture and sloped background with a poor initial amplitude: variable projection
+    # versus the full nonlinear fits
+    rng = np.random.default_rng(0)
+    x = np.linspace(0, 500, n_points)
+    H_res = rng.uniform(235, 265, n_spectra)
+    LW = rng.uniform(25, 60, n_spectra)
+    for name in ("derivative_lorentzian", "mixed_derivative_lorentzian"):
+        lineshape = LINESHAPES[name]
+        true = [dict(A=-15, A_disp=-5, offset=0.001, slope=1e-5, H_res=H, LW=width) for H, width in zip(H_res, LW)]
+        ys = [lineshape(x, **{param: values[param] for param in lineshape.param_names}) +
+              rng.normal(0, 1e-5, n_points) for values in true]
+        initials = [{param: 0.0 for param in lineshape.linear_names} for _ in true]
+        for initial in initials:
+            initial.update(A=-0.1, H_res=250, LW=40)
+        for backend_name in ("lmfit", "batch_lm", "varpro"):
+            start = time.perf_counter()
+            results = get_backend(backend_name).fit_many(lineshape, [x] * n_spectra, ys, initials, {"LW": (0, None)})
+            elapsed = time.perf_counter() - start
+            n_wrong = sum(not abs(result.params["H_res"] - H) < 1 for result, H in zip(results, H_res))
+            print(f"varpro {name} {backend_name}: {summarize_results(results)}, total {elapsed:.3f} s, "
+                  f"{n_wrong} with |dH_res| > 1 Oe")
+
+
+def bench_streaming(n_fields=301, n_freq=381, backend_name="batch_lm"):
+    # Conversion -> derivative -> Lorentzian fit of a synthetic sweep: one stage after the other over
+    # CSV directories (as the separate steps) versus the streaming stages, both writing all CSV files
+    rng = np.random.default_rng(0)
+    fields = np.arange(n_fields) * 10.0
+    freq_values = np.linspace(1e9, 20e9, n_freq)
+    step_size = freq_values[1] - freq_values[0]
+    H_res = (-1.0 + np.sqrt(1 + 4 * (freq_values * 1e-9 / 29) ** 2)) / 2 * 1e4
+    lineshape, backend = LINESHAPES["derivative_lorentzian"], get_backend(backend_name)
+
+    def initial(window):
+        return dict(A=-15, LW=40, H_res=(window[0].min() + window[0].max()) / 2)
+
+    with tempfile.TemporaryDirectory() as directory:
+        for H in fields:
+            s21 = -20 - 5 * 20 ** 2 / ((H - H_res) ** 2 + 20 ** 2) + rng.normal(0, 1e-3, n_freq)
+            np.savetxt(os.path.join(directory, f"{int(H)}.txt"), np.column_stack([freq_values, s21]))
+
+        def staged():
+            field_domain = os.path.join(directory, "field domain data")
+            for _ in csv_sink(sweep_records(directory, step_size), field_domain, CONVERSION_COLUMNS):
+                pass
+            for _ in csv_sink(derivative_records(csv_records(field_domain)), os.path.join(field_domain, "ds21"),
+                              DERIVATIVE_COLUMNS):
+                pass
+            spectra = list(csv_records(os.path.join(field_domain, "ds21"), DERIVATIVE_COLUMNS))
+            windows = [window_around_peak(record["x"], record["y"], 150) for record in spectra]
+            results = backend.fit_many(lineshape, [w[0] for w in windows], [w[1] for w in windows],
+                                       [initial(w) for w in windows], {"LW": (0, None)})
+            return time.perf_counter(), results
+
+        def streamed():
+            first = None
+            results = []
+            for record in field_domain_fits(directory, step_size, lineshape, backend, initial, {"LW": (0, None)}):
+                first = first or time.perf_counter()
+                results.append(record["result"])
+            return first, results
+
+        for label, run in (("staged", staged), ("streaming", streamed)):
+            tracemalloc.start()
+            start = time.perf_counter()
+            first, results = run()
+            total = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f"streaming {label} ({n_fields} fields x {len(results)} frequencies, {backend_name}): "
+                  f"first result {first - start:.2f} s, total {total:.2f} s, peak {peak / 1e6:.1f} MB, "
+                  f"{sum(result.success for result in results)} converged")
+
+
+def bench_acquisition(n_fields=301, n_freq=2001, cases=((None, False), (None, True), (50, True))):
+    # Simulated instrument and asyncio client over a local socket, for (rate, write .txt files) cases:
+    # sustained traces/s and latency, time from the last trace to the first per-frequency record, and
+    # the in-memory array versus the one loaded back from the .txt files the client writes
+    import asyncio
+
+    async def run(rate, directory):
+        server = await serve("127.0.0.1", 0, rate, fields=np.arange(n_fields) * 10.0,
+                             freq_values=np.linspace(1e9, 20e9, n_freq), complex_values=True)
+        async with server:
+            port = server.sockets[0].getsockname()[1]
+            return await acquire("127.0.0.1", port, directory)
+
+    for rate, write_txt in cases:
+        with tempfile.TemporaryDirectory() as directory:
+            sweep = asyncio.run(run(rate, directory if write_txt else None))
+            start = time.perf_counter()
+            fields, freq_values, values, _ = sweep.cube(complex_values=True)
+            next(cube_records(fields, freq_values, values, freq_values[1] - freq_values[0]))
+            ready = time.perf_counter() - start
+            check = ""
+            if write_txt:
+                stored = load_sweep_cube([os.path.join(directory, name) for name in os.listdir(directory)], True)
+                check = f", same array as the .txt files {np.array_equal(stored[2], values)}"
+        print(f"acquisition ({n_fields} x {n_freq} complex, rate {rate or 'unlimited'}, "
+              f"{'writing' if write_txt else 'no'} .txt files): {sweep.report()}; "
+              f"first record {1e3 * ready:.1f} ms after the sweep{check}")
+
+
+def bench_resample(n_fields=1000, n_freq=2001, field_step=10.0):
+    # Irregular complex sweep (jittered Gaussmeter readings, a repeated reading, a 100 Oe gap and a
+    # frequency list off the 10 MHz grid) onto uniform field and frequency grids: one np.interp or
+    # CubicSpline per column and row versus resample_cube, and the error against the noiseless signal
+    from scipy.interpolate import CubicSpline
+
+    rng = np.random.default_rng(0)
+    fields = np.arange(n_fields) * field_step + rng.uniform(-3, 3, n_fields)
+    fields = np.delete(fields, np.arange(400, 410))
+    fields = np.sort(np.append(fields, fields[100]))
+    freq_values = np.linspace(1e9, 20e9, n_freq) + rng.uniform(-1e6, 1e6, n_freq)
+    H_res = 1e4 * (np.sqrt(1 + 4 * (freq_values * 1e-9 / 29) ** 2) - 1) / 2
+
+    def signal(H, H_r):
+        return 1 - 0.3 * 40 / (40 - 1j * (H[:, None] - H_r[None, :]))
+
+    values = signal(fields, H_res)
+    field_grid = uniform_grid(fields, field_step, start=0.0)
+    freq_grid = uniform_grid(freq_values, 1e7, start=1e9)
+    unique_fields, first = np.unique(fields, return_index=True)
+
+    def per_column(method):
+        by_field = np.empty((field_grid.size, freq_values.size), dtype=complex)
+        for j in range(freq_values.size):
+            column = values[first, j]
+            if method == "linear":
+                by_field[:, j] = np.interp(field_grid, unique_fields, column.real) + \
+                    1j * np.interp(field_grid, unique_fields, column.imag)
+            else:
+                by_field[:, j] = CubicSpline(unique_fields, column)(field_grid)
+        resampled = np.empty((field_grid.size, freq_grid.size), dtype=complex)
+        for i in range(field_grid.size):
+            if method == "linear":
+                resampled[i] = np.interp(freq_grid, freq_values, by_field[i].real) + \
+                    1j * np.interp(freq_grid, freq_values, by_field[i].imag)
+            else:
+                resampled[i] = CubicSpline(freq_values, by_field[i])(freq_grid)
+        return resampled
+
+    H_res_grid = 1e4 * (np.sqrt(1 + 4 * (freq_grid * 1e-9 / 29) ** 2) - 1) / 2
+    exact = signal(field_grid, H_res_grid)
+    masked = gap_mask(unique_fields, field_grid)[:, None] | gap_mask(freq_values, freq_grid)[None, :]
+    for method in ("linear", "cubic"):
+        loop_time, loop_memory = measure(per_column, method, repeat=2)
+        cube_time, cube_memory = measure(resample_cube, fields, freq_values, values, field_grid, freq_grid, method,
+                                         repeat=2)
+        resampled = resample_cube(fields, freq_values, values, field_grid, freq_grid, method)[2]
+        valid = np.isfinite(resampled)
+        error = np.max(np.abs(resampled[valid] - exact[valid]))
+        print(f"resample {method} ({fields.size} x {n_freq} -> {field_grid.size} x {freq_grid.size} complex): "
+              f"per column {loop_time:.3f} s / {loop_memory:.1f} MB, resample_cube {cube_time:.3f} s / "
+              f"{cube_memory:.1f} MB, max error {error:.2e}, {np.count_nonzero(~valid)} NaN points "
+              f"(gap mask {np.count_nonzero(masked)})")
+
+
+def bench_equilibrium_angle(n_angles=37, n_fields=100):
+    # Equilibrium magnetization angle of an angle series: batched Newton versus one bounded
+    # scalar minimization of the free energy per (angle, field) point
+    from scipy.optimize import minimize_scalar
+    M_eff, H_k, H_4perp = 1.2, 0.005, 0.05
+    theta_H, H = np.meshgrid(np.radians(np.linspace(0, 90, n_angles)), np.linspace(0.05, 2, n_fields))
+    theta_H, H = theta_H.ravel(), H.ravel()
+
+    def energy(theta, field_angle, field):
+        return (-field * np.cos(theta - field_angle) + M_eff / 2 * np.cos(theta) ** 2
+                - H_4perp / 4 * np.cos(theta) ** 4 - H_k / 2 * np.sin(theta) ** 2)
+
+    def per_point():
+        return np.array([minimize_scalar(energy, bounds=(0, np.pi / 2), args=(field_angle, field), method="bounded",
+                                         options=dict(xatol=1e-10)).x for field_angle, field in zip(theta_H, H)])
+
+    batched_time, _ = measure(equilibrium_angle, theta_H, H, M_eff, H_k, H_4perp)
+    per_point_time, _ = measure(per_point, repeat=1)
+    max_error = np.max(np.abs(equilibrium_angle(theta_H, H, M_eff, H_k, H_4perp) - per_point()))
+    print(f"equilibrium_angle ({theta_H.size} points): batched {batched_time * 1e3:.2f} ms, "
+          f"per point {per_point_time * 1e3:.0f} ms, max |dtheta| {max_error:.1e} rad")
+
+
+def pickled_size(objects):
+    # Total bytes and time of a pickle round trip of every object, as a process pool does
+    start = time.perf_counter()
+    total = 0
+    for obj in objects:
+        data = pickle.dumps(obj)
+        pickle.loads(data)
+        total += len(data)
+    return total, time.perf_counter() - start
+
+
+def _fit_pickled(task):
+    # Naive pool task: the window travels to the worker and the whole FitResult back
+    lineshape, x, y, initial, bounds = task
+    return get_backend("lmfit").fit(lineshape, x, y, initial, bounds)
+
+
+def bench_shared_memory(n_spectra=400, n_points=20000, max_workers=None):
+    # Process-pool fitting: bytes and time spent pickling when every task carries its window and
+    # returns its FitResult, versus the shared-memory store that only sends indices and parameters
+    from concurrent.futures import ProcessPoolExecutor
+    rng = np.random.default_rng(0)
+    lineshape = LINESHAPES["derivative_lorentzian"]
+    x = np.linspace(0, 500, n_points)
+    H_res = rng.uniform(200, 300, n_spectra)
+    ys = [lineshape(x, -15, H, 40) + rng.normal(0, 1e-5, n_points) for H in H_res]
+    initials = [dict(A=-10, LW=30, H_res=H + 10) for H in H_res]
+    bounds = {"LW": (0, None)}
+    max_workers = max_workers or os.cpu_count() or 1
+    chunk_size = max(1, -(-n_spectra // (4 * max_workers)))
+
+    naive_tasks = [(lineshape, x, y, initial, bounds) for y, initial in zip(ys, initials)]
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        naive_results = list(executor.map(_fit_pickled, naive_tasks, chunksize=chunk_size))
+    naive_time = time.perf_counter() - start
+    naive_bytes, naive_pickle_time = pickled_size(naive_tasks + naive_results)
+
+    start = time.perf_counter()
+    with SharedSpectra.create([x] * n_spectra, ys) as store:
+        tasks = [(i, 0, n_points, initial, bounds) for i, initial in enumerate(initials)]
+        shared_results = fit_shared(lineshape, store, tasks, "lmfit", max_workers=max_workers, chunk_size=chunk_size)
+        spec = store.spec
+    shared_time = time.perf_counter() - start
+    numbered = [(row,) + task for row, task in enumerate(tasks)]
+    initargs = (spec, "results block", (n_spectra, 10), lineshape, "lmfit", {})
+    shared_bytes, shared_pickle_time = pickled_size([numbered[i:i + chunk_size] for i in range(0, n_spectra, chunk_size)]
+                                                    + [initargs] * max_workers)
+
+    max_difference = max(abs(a.params["H_res"] - b.params["H_res"]) for a, b in zip(naive_results, shared_results))
+    print(f"shared_memory ({n_spectra} spectra x {n_points} points, {max_workers} workers): "
+          f"pickled {naive_bytes / 1024 ** 2:.1f} MB in {naive_pickle_time * 1e3:.0f} ms, total {naive_time:.2f} s -> "
+          f"pickled {shared_bytes / 1024 ** 2:.3f} MB in {shared_pickle_time * 1e3:.1f} ms, total {shared_time:.2f} s, "
+          f"max |dH_res| {max_difference:.1e} Oe")
+
+
+BENCHMARKS = {
+    "fit_window": bench_fit_window,
+    "fit_backends": bench_fit_backends,
+    "trace_reader": bench_trace_reader,
+    "resonance_map": bench_resonance_map,
+    "multiresolution": bench_multiresolution,
+    "kernels": bench_kernels,
+    "varpro": bench_varpro,
+    "equilibrium_angle": bench_equilibrium_angle,
+    "streaming": bench_streaming,
+    "acquisition": bench_acquisition,
+    "resample": bench_resample,
+    "shared_memory": bench_shared_memory,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
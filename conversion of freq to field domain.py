@@ -9,10 +9,8 @@ from tkinter import ttk  # Import ttk module
 import subprocess
 import os
 import sys
-import glob
-import pandas as pd
-import re
-import numpy as np
+from streaming import sweep_records, csv_sink, CONVERSION_COLUMNS
+from resample import RESAMPLE_METHODS
 
 
 class FMRConversionApp:
@@ -21,7 +19,7 @@ class FMRConversionApp:
         master.title("FMR Frequency to Field Domain Conversion")
 
         # Set window size and background color
-        master.geometry("500x450")
+        master.geometry("500x560")
         master.configure(bg="#f0f0f0")
 
         # Add title label with styling
@@ -44,6 +42,24 @@ class FMRConversionApp:
         self.step_size_entry.insert(0, "1e9")
         self.step_size_entry.pack(pady=5)
 
+        # Interpolate onto the frequency grid (and a uniform field grid) instead of keeping only the
+        # frequencies the VNA measured exactly
+        self.resample_var = tk.BooleanVar(value=False)
+        self.resample_check = tk.Checkbutton(master, text="Resample onto Uniform Grid", variable=self.resample_var,
+                                             font=("Helvetica", 10), bg="#f0f0f0")
+        self.resample_check.pack(pady=5)
+
+        resample_frame = tk.Frame(master, bg="#f0f0f0")
+        resample_frame.pack(pady=5)
+        tk.Label(resample_frame, text="Field Step (Oe):", font=("Helvetica", 10), bg="#f0f0f0").pack(side="left", padx=5)
+        self.field_step_entry = tk.Entry(resample_frame, width=8)
+        self.field_step_entry.insert(0, "10")
+        self.field_step_entry.pack(side="left", padx=5)
+        tk.Label(resample_frame, text="Method:", font=("Helvetica", 10), bg="#f0f0f0").pack(side="left", padx=5)
+        self.method_combo = ttk.Combobox(resample_frame, values=RESAMPLE_METHODS, state="readonly", width=8)
+        self.method_combo.set(RESAMPLE_METHODS[0])
+        self.method_combo.pack(side="left", padx=5)
+
         self.run_button = tk.Button(master, text="Run Conversion", font=("Helvetica", 10, "bold"), bg="#4CAF50",
                                     fg="white", command=self.run_conversion)
         self.run_button.pack(pady=20)
@@ -71,56 +87,26 @@ class FMRConversionApp:
 
         try:
             step_size = float(self.step_size_entry.get())
-            self.convert_freq_to_field(self.directory, self.directory, step_size)
+            if self.resample_var.get():
+                self.convert_freq_to_field(self.directory, self.directory, step_size, self.method_combo.get(),
+                                           float(self.field_step_entry.get()) or None)
+            else:
+                self.convert_freq_to_field(self.directory, self.directory, step_size)
             messagebox.showinfo("Success", "Conversion completed successfully!")
         except Exception as e:
             messagebox.showerror("Error", f"An error occurred: {e}")
 
-    def convert_freq_to_field(self, input_directory, output_directory, step_size):
+    def convert_freq_to_field(self, input_directory, output_directory, step_size, method=None, field_step=None):
         field_domain_dir = os.path.join(output_directory, "field domain data")
-        os.makedirs(field_domain_dir, exist_ok=True)
-
-        file_paths = glob.glob(os.path.join(input_directory, "*.txt"))
-        file_paths_sorted = sorted(file_paths, key=lambda x: int(re.search(r"(\d+)", x).group()))
-        file_series = pd.Series(file_paths_sorted)
-
-        first_file_path = file_series.iloc[0]
-        data = np.loadtxt(first_file_path)
-        freq_values = data[:, 0]
-
-        min_freq = min(freq_values)
-        max_freq = max(freq_values)
-        index_freq_values = np.arange(min_freq, max_freq + step_size, step_size)
-
-        filtered_freq_data = {}
-
-        df = []
-
-        for i, freq_value in enumerate(index_freq_values):
-            x = []
-            y = []
-
-            for file_path in file_series:
-                data = np.loadtxt(file_path)
-                y_value = data[np.where(data[:, 0] == freq_value), 1]
-                if len(y_value) > 0:
-                    y.append(float(y_value[0][0]))
-                    file_name = os.path.basename(file_path)
-                    file_name_without_ext = float(os.path.splitext(file_name)[0])
-                    x.append(file_name_without_ext)
-
-            sorted_indices = np.argsort(x)
-            x_data = np.array(x)[sorted_indices]
-            y_data = np.array(y)[sorted_indices]
-
-            filtered_freq_data[freq_value] = {"mag_field": pd.Series(x_data), "s21": pd.Series(y_data)}
-            df = pd.DataFrame({'mag_field(oe)': x_data, 's21': y_data})
-
-            csv_path = os.path.join(field_domain_dir, str(freq_value) + ".csv")
-            df.to_csv(csv_path, index=False)
 
+        # Every trace is read once into a field x frequency array (rows in ascending field order);
+        # the imaginary part is kept when the traces have a third column. One CSV file per frequency.
+        # With method the array is resampled onto the frequency grid and a field_step Oe field grid.
+        records = csv_sink(sweep_records(input_directory, step_size, method=method, field_step=field_step),
+                           field_domain_dir, CONVERSION_COLUMNS)
+        for record in records:
             # Update progress bar
-            self.progress.set((i+1) / len(index_freq_values) * 100)
+            self.progress.set((record["index"] + 1) / record["count"] * 100)
             self.master.update_idletasks()
 
         print(f"Extracted data saved to {field_domain_dir}")
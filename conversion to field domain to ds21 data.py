@@ -6,8 +6,7 @@
 import tkinter as tk
 from tkinter import filedialog, messagebox
 import os
-import numpy as np
-import pandas as pd
+from streaming import csv_records, derivative_records, csv_sink, CONVERSION_COLUMNS, DERIVATIVE_COLUMNS
 
 
 class DerivativeCalculationApp:
@@ -61,26 +60,11 @@ class DerivativeCalculationApp:
 
     def calculate_derivative(self, input_directory, output_directory):
         output_directory = os.path.join(output_directory, 'ds21')
-        os.makedirs(output_directory, exist_ok=True)
 
-        def calculate_derivative(H, S21, dH=10):
-            dS21_dH = (S21[2:] - S21[:-2]) / (2 * dH)
-            H_mid = H[1:-1]
-            return H_mid, dS21_dH
-
-        for filename in os.listdir(input_directory):
-            if filename.endswith(".csv"):
-                filepath = os.path.join(input_directory, filename)
-                data = pd.read_csv(filepath)
-
-                H = data['mag_field(oe)'].values
-                S21 = data['s21'].values
-
-                H_mid, dS21_dH = calculate_derivative(H, S21)
-
-                derivative_data = pd.DataFrame({'Magnetic Field': H_mid, 'dS21/dH': dS21_dH})
-                output_filepath = os.path.join(output_directory, f"{filename}")
-                derivative_data.to_csv(output_filepath, index=False)
+        # Central difference dS21/dH of every field domain CSV file, written under the same name
+        records = derivative_records(csv_records(input_directory, CONVERSION_COLUMNS))
+        for _ in csv_sink(records, output_directory, DERIVATIVE_COLUMNS):
+            pass
 
         print("Derivative calculation and saving completed.")
 
@@ -0,0 +1,27 @@
+#-------------------------------------------------
+# Author:      Suraj Joshi
+# Created:     21-08-2024
+# Copyright:   (c) Suraj Joshi 2024
+#--------------------------------------------------
+# Derivative divide of the complex transmission: dD/dH = [S21(H + dH) - S21(H - dH)] / [S21(H) * 2 dH]
+# evaluated for every frequency at once on the field x frequency array of a sweep.
+import numpy as np
+
+COMPONENTS = {
+    "real": np.real,
+    "imaginary": np.imag,
+    "magnitude": np.abs,
+}
+
+
+def derivative_divide(fields, s21, modulation_step=1):
+    # fields: ascending field values (n_fields,), s21: complex array (n_fields, n_freq).
+    # The difference is taken modulation_step field steps to either side using the actual field
+    # spacing, so irregular field steps are handled. Returns (H_mid, dD_dH) of n_fields - 2k rows.
+    k = int(modulation_step)
+    if k < 1 or fields.size <= 2 * k:
+        raise ValueError("Modulation step must be at least 1 and smaller than half the number of fields.")
+    spacing = (fields[2 * k:] - fields[:-2 * k])[:, None]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        dD_dH = (s21[2 * k:] - s21[:-2 * k]) / (s21[k:-k] * spacing)
+    return fields[k:-k], dD_dH
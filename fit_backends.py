@@ -0,0 +1,427 @@
+#-------------------------------------------------
+# Author:      Suraj Joshi
+# Created:     21-08-2024
+# Copyright:   (c) Suraj Joshi 2024
+#--------------------------------------------------
+# Interchangeable optimizers for the fitting steps.
+# Every backend takes a Lineshape from lineshapes.py, the data, a dict of initial values and an
+# optional dict of (min, max) bounds, and returns FitResult objects that report nfev, wall time
+# and convergence status so the backends can be compared on the same data.
+import time
+import numpy as np
+from lmfit import Model
+from scipy.optimize import least_squares
+from kernels import get_kernel
+
+FIT_BACKENDS = {}
+
+
+def register_backend(cls):
+    FIT_BACKENDS[cls.name] = cls
+    return cls
+
+
+def get_backend(name):
+    if name not in FIT_BACKENDS:
+        raise ValueError(f"Unknown fit backend '{name}'. Available: {', '.join(FIT_BACKENDS)}")
+    return FIT_BACKENDS[name]()
+
+
+class FitResult:
+    def __init__(self, lineshape, params, stderr, best_fit, nfev, wall_time, success, message, backend):
+        self.lineshape = lineshape
+        self.params = params  # {name: value}
+        self.stderr = stderr  # {name: standard error or None}
+        self.best_fit = best_fit  # None when the fit raised an error
+        self.nfev = nfev
+        self.wall_time = wall_time
+        self.success = success
+        self.message = message
+        self.backend = backend
+
+    def eval(self, x):
+        return self.lineshape.function(x, **self.params)
+
+    def report(self):
+        lines = [f"[[Fit Statistics]] backend: {self.backend}, nfev: {self.nfev}, "
+                 f"wall time: {self.wall_time * 1e3:.2f} ms, success: {self.success} ({self.message})",
+                 "[[Variables]]"]
+        for name, value in self.params.items():
+            error = self.stderr.get(name)
+            error_text = f" +/- {error:.6g}" if error is not None else ""
+            lines.append(f"    {name}: {value:.6g}{error_text}")
+        return "\n".join(lines)
+
+
+def failed_result(lineshape, backend, wall_time, error):
+    params = {name: np.nan for name in lineshape.param_names}
+    stderr = {name: None for name in lineshape.param_names}
+    return FitResult(lineshape, params, stderr, None, 0, wall_time, False, str(error), backend)
+
+
+def bounds_arrays(lineshape, bounds):
+    # Lower and upper bound arrays in parameter order; missing or None limits are unbounded
+    bounds = bounds or {}
+    lower = np.full(len(lineshape.param_names), -np.inf)
+    upper = np.full(len(lineshape.param_names), np.inf)
+    for k, name in enumerate(lineshape.param_names):
+        low, high = bounds.get(name, (None, None))
+        if low is not None:
+            lower[k] = low
+        if high is not None:
+            upper[k] = high
+    return lower, upper
+
+
+def covariance_stderr(lineshape, jacobian, cost, n_points):
+    # Standard errors from the Gauss-Newton covariance estimate (J^T J)^-1 * s^2
+    n_params = len(lineshape.param_names)
+    if n_points <= n_params:
+        return {name: None for name in lineshape.param_names}
+    try:
+        covariance = np.linalg.inv(jacobian.T @ jacobian) * (2 * cost / (n_points - n_params))
+    except np.linalg.LinAlgError:
+        return {name: None for name in lineshape.param_names}
+    errors = np.sqrt(np.abs(np.diag(covariance)))
+    return {name: float(error) for name, error in zip(lineshape.param_names, errors)}
+
+
+def summarize_results(results):
+    converged = sum(result.success for result in results)
+    nfev = sum(result.nfev for result in results)
+    wall_time = sum(result.wall_time for result in results)
+    backend = results[0].backend if results else "-"
+    return (f"Backend {backend}: {len(results)} fits, {converged} converged, "
+            f"{nfev} function evaluations, {wall_time:.3f} s fitting time")
+
+
+class FitBackend:
+    name = None
+
+    def fit(self, lineshape, x, y, initial, bounds=None):
+        raise NotImplementedError
+
+    def fit_many(self, lineshape, xs, ys, initial, bounds=None):
+        # initial and bounds may be a single dict shared by all spectra or one dict per spectrum.
+        # A spectrum whose fit raises is returned as a failed FitResult with best_fit None.
+        initials = initial if isinstance(initial, (list, tuple)) else [initial] * len(xs)
+        all_bounds = bounds if isinstance(bounds, (list, tuple)) else [bounds] * len(xs)
+        results = []
+        for x, y, spectrum_initial, spectrum_bounds in zip(xs, ys, initials, all_bounds):
+            start = time.perf_counter()
+            try:
+                results.append(self.fit(lineshape, x, y, spectrum_initial, spectrum_bounds))
+            except Exception as e:
+                results.append(failed_result(lineshape, self.name, time.perf_counter() - start, e))
+        return results
+
+
+@register_backend
+class LmfitBackend(FitBackend):
+    # lmfit.Model.fit with its default leastsq, as used originally by all fitting steps
+    name = "lmfit"
+
+    def fit(self, lineshape, x, y, initial, bounds=None):
+        start = time.perf_counter()
+        model = Model(lineshape.function)
+        params = model.make_params(**initial)
+        for name, (low, high) in (bounds or {}).items():
+            if low is not None:
+                params[name].min = low
+            if high is not None:
+                params[name].max = high
+        result = model.fit(np.asarray(y), params, **{model.independent_vars[0]: np.asarray(x)})
+        wall_time = time.perf_counter() - start
+        values = {name: result.params[name].value for name in lineshape.param_names}
+        stderr = {name: result.params[name].stderr for name in lineshape.param_names}
+        return FitResult(lineshape, values, stderr, result.best_fit, result.nfev, wall_time,
+                         result.success, result.message, self.name)
+
+
+@register_backend
+class LeastSquaresBackend(FitBackend):
+    # scipy.optimize.least_squares trust-region reflective with bounds and the analytic Jacobian,
+    # evaluated through the active kernel set of kernels.py
+    name = "least_squares"
+
+    def fit(self, lineshape, x, y, initial, bounds=None):
+        start = time.perf_counter()
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        lower, upper = bounds_arrays(lineshape, bounds)
+        p0 = np.clip([initial[name] for name in lineshape.param_names], lower, upper)
+        kernel = get_kernel(lineshape)
+
+        def residual(p):
+            return kernel.residual(x, y, p)
+
+        def jacobian(p):
+            return kernel.jacobian(x, p)
+
+        result = least_squares(residual, p0, jac=jacobian, bounds=(lower, upper), method="trf")
+        wall_time = time.perf_counter() - start
+        values = dict(zip(lineshape.param_names, result.x.tolist()))
+        stderr = covariance_stderr(lineshape, result.jac, result.cost, len(x))
+        return FitResult(lineshape, values, stderr, y + result.fun, result.nfev, wall_time,
+                         result.status > 0, result.message, self.name)
+
+
+def pad_spectra(xs, ys):
+    # (n_spectra, longest) arrays of the windows and the mask of their real points
+    lengths = np.array([len(x) for x in xs])
+    X = np.zeros((len(xs), max(lengths.max(), 1)))
+    Y = np.zeros_like(X)
+    mask = np.arange(X.shape[1]) < lengths[:, None]
+    for i, (x, y) in enumerate(zip(xs, ys)):
+        x = np.asarray(x, dtype=float)
+        X[i, :lengths[i]] = x
+        Y[i, :lengths[i]] = y
+        # Pad with the first field value so the model stays finite outside the window
+        X[i, lengths[i]:] = x[0] if lengths[i] else 0.0
+    return X, Y, mask, lengths
+
+
+def batched_levenberg_marquardt(residuals, jacobians, p, lower, upper, max_iterations=200, ftol=1e-10,
+                                xtol=1e-10, jacobian_cost=0):
+    # Levenberg-Marquardt on all rows of p at once. residuals(rows, p_rows) -> (n_rows, n_points) and
+    # jacobians(rows, p_rows, r_rows) -> (n_rows, n_points, n_params) evaluate the still-active rows only.
+    # Returns p, residuals, cost, nfev (jacobian_cost is added per Jacobian), success and messages.
+    n_spectra, n_params = p.shape
+    all_rows = np.arange(n_spectra)
+    r = residuals(all_rows, p)
+    cost = 0.5 * np.sum(r ** 2, axis=1)
+    damping = np.full(n_spectra, 1e-3)
+    nfev = np.ones(n_spectra, dtype=int)
+    success = np.zeros(n_spectra, dtype=bool)
+    messages = np.full(n_spectra, "Maximum number of iterations reached", dtype=object)
+    active = np.isfinite(cost)
+    messages[~active] = "Model is not finite at the initial parameters"
+
+    for _ in range(max_iterations):
+        rows = np.flatnonzero(active)
+        if rows.size == 0:
+            break
+        J = jacobians(rows, p[rows], r[rows])
+        nfev[rows] += jacobian_cost
+        JTJ = np.einsum("bnp,bnq->bpq", J, J)
+        gradient = np.einsum("bnp,bn->bp", J, r[rows])
+        finite = np.isfinite(JTJ).all(axis=(1, 2)) & np.isfinite(gradient).all(axis=1)
+        if not finite.all():
+            active[rows[~finite]] = False
+            messages[rows[~finite]] = "Jacobian is not finite"
+            rows, J, JTJ, gradient = rows[finite], J[finite], JTJ[finite], gradient[finite]
+            if rows.size == 0:
+                break
+        scale = np.maximum(np.diagonal(JTJ, axis1=1, axis2=2), 1e-12)
+        damped = JTJ + damping[rows, None, None] * scale[:, :, None] * np.eye(n_params)
+        step = np.linalg.solve(damped, -gradient[:, :, None])[:, :, 0]
+
+        p_trial = np.clip(p[rows] + step, lower[rows], upper[rows])
+        r_trial = residuals(rows, p_trial)
+        cost_trial = 0.5 * np.sum(r_trial ** 2, axis=1)
+        nfev[rows] += 1
+
+        improved = np.isfinite(cost_trial) & (cost_trial < cost[rows])
+        accepted = rows[improved]
+        reduction = cost[accepted] - cost_trial[improved]
+        step_size = np.linalg.norm(p_trial[improved] - p[accepted], axis=1)
+        p[accepted] = p_trial[improved]
+        r[accepted] = r_trial[improved]
+        cost_before = cost[accepted]
+        cost[accepted] = cost_trial[improved]
+        damping[accepted] *= 0.3
+        damping[rows[~improved]] *= 10.0
+
+        converged = accepted[(reduction <= ftol * cost_before) |
+                             (step_size <= xtol * (np.linalg.norm(p[accepted], axis=1) + xtol))]
+        stalled = rows[~improved][damping[rows[~improved]] > 1e12]
+        success[converged] = True
+        messages[converged] = "Converged: relative reduction of cost or step below tolerance"
+        success[stalled] = True
+        messages[stalled] = "Converged: no further decrease of cost possible"
+        active[converged] = False
+        active[stalled] = False
+    return p, r, cost, nfev, success, messages
+
+
+@register_backend
+class BatchLMBackend(FitBackend):
+    # Levenberg-Marquardt run on all spectra at once: the windows are padded into one
+    # (n_spectra, n_points) array and every iteration evaluates the model, the Jacobian and the
+    # damped normal equations for all still-active spectra with single NumPy calls.
+    # Bounds are enforced by clipping each step. Wall time is the batch time shared per spectrum.
+    name = "batch_lm"
+
+    def __init__(self, max_iterations=200, ftol=1e-10, xtol=1e-10):
+        self.max_iterations = max_iterations
+        self.ftol = ftol
+        self.xtol = xtol
+
+    def fit(self, lineshape, x, y, initial, bounds=None):
+        return self.fit_many(lineshape, [x], [y], initial, bounds)[0]
+
+    def fit_many(self, lineshape, xs, ys, initial, bounds=None):
+        start = time.perf_counter()
+        n_spectra = len(xs)
+        if n_spectra == 0:
+            return []
+        n_params = len(lineshape.param_names)
+        initials = initial if isinstance(initial, (list, tuple)) else [initial] * n_spectra
+        all_bounds = bounds if isinstance(bounds, (list, tuple)) else [bounds] * n_spectra
+        X, Y, mask, lengths = pad_spectra(xs, ys)
+
+        lower = np.empty((n_spectra, n_params))
+        upper = np.empty((n_spectra, n_params))
+        for i, spectrum_bounds in enumerate(all_bounds):
+            lower[i], upper[i] = bounds_arrays(lineshape, spectrum_bounds)
+        p = np.clip([[values[name] for name in lineshape.param_names] for values in initials], lower, upper)
+        kernel = get_kernel(lineshape)
+
+        def residuals(rows, p_rows):
+            r = kernel.residual(X[rows], Y[rows], p_rows)
+            np.copyto(r, 0.0, where=~mask[rows])
+            return r
+
+        def jacobians(rows, p_rows, _):
+            J = kernel.jacobian(X[rows], p_rows)
+            np.copyto(J, 0.0, where=~mask[rows][:, :, None])
+            return J
+
+        p, r, cost, nfev, success, messages = batched_levenberg_marquardt(
+            residuals, jacobians, p, lower, upper, self.max_iterations, self.ftol, self.xtol)
+
+        wall_time = (time.perf_counter() - start) / n_spectra
+        results = []
+        for i in range(n_spectra):
+            values = dict(zip(lineshape.param_names, p[i].tolist()))
+            if not np.isfinite(cost[i]):
+                results.append(failed_result(lineshape, self.name, wall_time, messages[i]))
+                continue
+            n = lengths[i]
+            J = kernel.jacobian(X[i, :n], p[i])
+            stderr = covariance_stderr(lineshape, J, cost[i], n)
+            best_fit = Y[i, :n] + r[i, :n]
+            results.append(FitResult(lineshape, values, stderr, best_fit, int(nfev[i]), wall_time,
+                                     bool(success[i]), messages[i], self.name))
+        return results
+
+
+@register_backend
+class VarProBackend(FitBackend):
+    # Variable projection: the parameters entering linearly (lineshape.linear_names: A, or A, A_disp,
+    # offset and slope of the mixed lineshapes) are solved by linear least squares for every trial of
+    # the nonlinear ones, so Levenberg-Marquardt only searches H_res, LW (and alpha). Spectra are
+    # batched as in batch_lm, the Jacobian of the projected residual is taken by forward differences.
+    # Bounds apply to the nonlinear parameters; the linear ones are unconstrained.
+    name = "varpro"
+
+    def __init__(self, max_iterations=200, ftol=1e-10, xtol=1e-10, step=1e-7):
+        self.max_iterations = max_iterations
+        self.ftol = ftol
+        self.xtol = xtol
+        self.step = step
+
+    def fit(self, lineshape, x, y, initial, bounds=None):
+        return self.fit_many(lineshape, [x], [y], initial, bounds)[0]
+
+    def fit_many(self, lineshape, xs, ys, initial, bounds=None):
+        start = time.perf_counter()
+        n_spectra = len(xs)
+        if n_spectra == 0:
+            return []
+        if not lineshape.linear_names:
+            return [failed_result(lineshape, self.name, 0.0, f"{lineshape.name} has no linear parameters")
+                    for _ in range(n_spectra)]
+        nonlinear = [lineshape.param_names.index(name) for name in lineshape.nonlinear_names]
+        n_nonlinear = len(nonlinear)
+        initials = initial if isinstance(initial, (list, tuple)) else [initial] * n_spectra
+        all_bounds = bounds if isinstance(bounds, (list, tuple)) else [bounds] * n_spectra
+        X, Y, mask, lengths = pad_spectra(xs, ys)
+
+        lower = np.empty((n_spectra, n_nonlinear))
+        upper = np.empty((n_spectra, n_nonlinear))
+        for i, spectrum_bounds in enumerate(all_bounds):
+            spectrum_lower, spectrum_upper = bounds_arrays(lineshape, spectrum_bounds)
+            lower[i], upper[i] = spectrum_lower[nonlinear], spectrum_upper[nonlinear]
+        q = np.clip([[values[name] for name in lineshape.nonlinear_names] for values in initials], lower, upper)
+        q = q.reshape(n_spectra, n_nonlinear)
+
+        def project(rows, q_rows):
+            # Best linear coefficients for the basis terms from the normal equations, columns scaled to unit norm
+            terms = lineshape.basis(X[rows], *(q_rows[:, k:k + 1] for k in range(n_nonlinear)))
+            Phi = np.stack(np.broadcast_arrays(*terms), axis=-1) * mask[rows][:, :, None]
+            gram = np.einsum("bnm,bnl->bml", Phi, Phi)
+            norms = np.sqrt(np.diagonal(gram, axis1=1, axis2=2))
+            norms = np.where((norms > 0) & np.isfinite(norms), norms, 1.0)
+            scaled_gram = gram / (norms[:, :, None] * norms[:, None, :])
+            scaled_target = np.einsum("bnm,bn->bm", Phi, Y[rows]) / norms
+            try:
+                c = np.linalg.solve(scaled_gram, scaled_target[:, :, None])[:, :, 0] / norms
+            except np.linalg.LinAlgError:
+                # Degenerate basis (e.g. a window of fewer points than linear parameters)
+                c = (np.linalg.pinv(scaled_gram) @ scaled_target[:, :, None])[:, :, 0] / norms
+            return c, np.einsum("bnm,bm->bn", Phi, c) - np.where(mask[rows], Y[rows], 0.0)
+
+        def residuals(rows, q_rows):
+            with np.errstate(invalid="ignore", over="ignore"):
+                try:
+                    return project(rows, q_rows)[1]
+                except np.linalg.LinAlgError:
+                    return np.full((len(rows), X.shape[1]), np.nan)
+
+        def jacobians(rows, q_rows, r):
+            J = np.empty(r.shape + (n_nonlinear,))
+            for k in range(n_nonlinear):
+                shifted = q_rows.copy()
+                delta = self.step * np.maximum(np.abs(q_rows[:, k]), 1.0)
+                shifted[:, k] += delta
+                J[:, :, k] = (residuals(rows, shifted) - r) / delta[:, None]
+            return J
+
+        q, r, cost, nfev, success, messages = batched_levenberg_marquardt(
+            residuals, jacobians, q, lower, upper, self.max_iterations, self.ftol, self.xtol,
+            jacobian_cost=n_nonlinear)
+        with np.errstate(invalid="ignore", over="ignore"):
+            c = project(np.arange(n_spectra), q)[0]
+
+        wall_time = (time.perf_counter() - start) / n_spectra
+        results = []
+        for i in range(n_spectra):
+            if not np.isfinite(cost[i]) or not np.all(np.isfinite(c[i])):
+                results.append(failed_result(lineshape, self.name, wall_time, messages[i]))
+                continue
+            values = dict(zip(lineshape.linear_names, c[i].tolist()))
+            values.update(zip(lineshape.nonlinear_names, q[i].tolist()))
+            n = lengths[i]
+            J = np.column_stack(np.broadcast_arrays(*lineshape.jacobian(
+                X[i, :n], *(values[name] for name in lineshape.param_names))))
+            stderr = covariance_stderr(lineshape, J, cost[i], n)
+            results.append(FitResult(lineshape, values, stderr, Y[i, :n] + r[i, :n], int(nfev[i]), wall_time,
+                                     bool(success[i]), messages[i], self.name))
+        return results
+
+
+@register_backend
+class ProcessPoolBackend(FitBackend):
+    # The spectra are fitted by the inner backend in worker processes. The windows are copied once
+    # into shared memory (shared_spectra.py) and the workers get only indices, initial values and
+    # bounds, so the pool does not pickle the data; best_fit is evaluated back in this process.
+    name = "process_pool"
+
+    def __init__(self, inner="lmfit", max_workers=None, chunk_size=None):
+        self.inner = inner
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+
+    def fit(self, lineshape, x, y, initial, bounds=None):
+        return self.fit_many(lineshape, [x], [y], initial, bounds)[0]
+
+    def fit_many(self, lineshape, xs, ys, initial, bounds=None):
+        from shared_spectra import SharedSpectra, fit_shared
+        initials = initial if isinstance(initial, (list, tuple)) else [initial] * len(xs)
+        all_bounds = bounds if isinstance(bounds, (list, tuple)) else [bounds] * len(xs)
+        with SharedSpectra.create(xs, ys) as store:
+            tasks = [(i, 0, len(x), spectrum_initial, spectrum_bounds)
+                     for i, (x, spectrum_initial, spectrum_bounds) in enumerate(zip(xs, initials, all_bounds))]
+            return fit_shared(lineshape, store, tasks, self.inner, max_workers=self.max_workers,
+                              chunk_size=self.chunk_size, name=self.name)
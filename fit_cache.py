@@ -0,0 +1,173 @@
+#-------------------------------------------------
+# Author:      Suraj Joshi
+# Created:     21-08-2024
+# Copyright:   (c) Suraj Joshi 2024
+#--------------------------------------------------
+# Content-addressed store of single-spectrum fit results. The key is a hash of the windowed data,
+# the lineshape, the initial values, the bounds and the backend with its settings, so rerunning a
+# fitting step only fits the spectra whose input changed. The key also covers CACHE_VERSION and the
+# source of the lineshape and backend code, so results of an older model or optimizer are not served
+# after the code changes. Results live in one .npz file per key and the least recently used ones are
+# deleted when the store grows beyond max_bytes.
+import os
+import json
+import time
+import hashlib
+import inspect
+from collections import OrderedDict
+import numpy as np
+import kernels
+import lineshapes
+from fit_backends import FitBackend, FitResult
+
+CACHE_DIRECTORY = os.path.join(os.path.expanduser("~"), ".fmr_fit_cache")
+CACHE_VERSION = 1  # raised when the stored format or the meaning of a key changes
+
+_code_hashes = {}
+
+
+def code_version(lineshape, backend):
+    # Hash of the source files defining the lineshape and the backend, and of the shared model code
+    # (lineshapes.py, kernels.py); rehashed when a file is modified
+    paths = set()
+    for code in (lineshape.function, lineshape.jacobian, type(backend), lineshapes, kernels):
+        try:
+            paths.add(inspect.getsourcefile(code))
+        except TypeError:
+            pass
+    digest = hashlib.sha256(str(CACHE_VERSION).encode())
+    for path in sorted(path for path in paths if path):
+        modified = os.path.getmtime(path)
+        if _code_hashes.get(path, (None,))[0] != modified:
+            with open(path, "rb") as source_file:
+                _code_hashes[path] = (modified, hashlib.sha256(source_file.read()).hexdigest())
+        digest.update(_code_hashes[path][1].encode())
+    return digest.hexdigest()
+
+
+class FitCache:
+    def __init__(self, directory=CACHE_DIRECTORY, max_bytes=256 * 1024 ** 2):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+        # key: file size, least recently used first (file mtimes are touched on every hit)
+        self.index = OrderedDict()
+        with os.scandir(directory) as scan:
+            stored = [(entry.stat().st_mtime, entry.name[:-4], entry.stat().st_size)
+                      for entry in scan if entry.name.endswith(".npz")]
+        for _, key, size in sorted(stored):
+            self.index[key] = size
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+    def key(self, lineshape, x, y, initial, bounds, backend):
+        digest = hashlib.sha256()
+        digest.update(np.ascontiguousarray(x, dtype=float).tobytes())
+        digest.update(b"|")
+        digest.update(np.ascontiguousarray(y, dtype=float).tobytes())
+        settings = {
+            "lineshape": lineshape.name,
+            "initial": {name: float(value) for name, value in initial.items()},
+            "bounds": {name: list(limits) for name, limits in (bounds or {}).items()},
+            "backend": backend.name,
+            "backend settings": vars(backend),
+            "code": code_version(lineshape, backend),
+        }
+        digest.update(json.dumps(settings, sort_keys=True, default=str).encode())
+        return digest.hexdigest()
+
+    def get(self, key, lineshape):
+        # Stored FitResult for key, or None; a hit costs no function evaluations
+        if key not in self.index:
+            self.misses += 1
+            return None
+        start = time.perf_counter()
+        try:
+            with np.load(self.path(key)) as stored:
+                best_fit = stored["best_fit"]
+                meta = json.loads(stored["meta"].item())
+            os.utime(self.path(key))
+        except (OSError, ValueError, KeyError):
+            # Deleted or damaged by another process: fit again
+            self.index.pop(key, None)
+            self.misses += 1
+            return None
+        self.index.move_to_end(key)
+        self.hits += 1
+        return FitResult(lineshape, meta["params"], meta["stderr"], best_fit, 0, time.perf_counter() - start,
+                         meta["success"], meta["message"], meta["backend"])
+
+    def put(self, key, result):
+        # Failed fits (best_fit None) are not stored, they may not fail the next time
+        if result.best_fit is None:
+            return
+        meta = {
+            "params": result.params,
+            "stderr": result.stderr,
+            "success": bool(result.success),
+            "message": str(result.message),
+            "backend": result.backend,
+        }
+        try:
+            np.savez(self.path(key), best_fit=np.asarray(result.best_fit, dtype=float), meta=np.array(json.dumps(meta)))
+            self.index[key] = os.path.getsize(self.path(key))
+        except OSError:
+            return
+        self.index.move_to_end(key)
+        self.evict()
+
+    def evict(self):
+        total = sum(self.index.values())
+        while total > self.max_bytes and self.index:
+            key, size = self.index.popitem(last=False)
+            total -= size
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+
+    def clear(self):
+        for key in list(self.index):
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+        self.index.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = 100 * self.hits / lookups if lookups else 0.0
+        return (f"Fit cache: {self.hits} hits, {self.misses} misses ({hit_rate:.0f}% hit rate), "
+                f"{len(self.index)} results / {sum(self.index.values()) / 1024 ** 2:.1f} MB stored")
+
+
+class CachedBackend(FitBackend):
+    # Wraps a backend: spectra found in the cache are returned directly, the others are fitted
+    # together by the wrapped backend (so batch_lm still batches the misses) and stored
+    def __init__(self, backend, cache=None):
+        self.backend = backend
+        self.cache = cache if cache is not None else FitCache()
+        self.name = backend.name
+
+    def fit(self, lineshape, x, y, initial, bounds=None):
+        return self.fit_many(lineshape, [x], [y], initial, bounds)[0]
+
+    def fit_many(self, lineshape, xs, ys, initial, bounds=None):
+        initials = initial if isinstance(initial, (list, tuple)) else [initial] * len(xs)
+        all_bounds = bounds if isinstance(bounds, (list, tuple)) else [bounds] * len(xs)
+        keys = [self.cache.key(lineshape, x, y, spectrum_initial, spectrum_bounds, self.backend)
+                for x, y, spectrum_initial, spectrum_bounds in zip(xs, ys, initials, all_bounds)]
+        results = [self.cache.get(key, lineshape) for key in keys]
+
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            fitted = self.backend.fit_many(lineshape, [xs[i] for i in missing], [ys[i] for i in missing],
+                                           [initials[i] for i in missing], [all_bounds[i] for i in missing])
+            for i, result in zip(missing, fitted):
+                results[i] = result
+                self.cache.put(keys[i], result)
+        return results
@@ -0,0 +1,455 @@
+#-------------------------------------------------
+# Author:      Suraj Joshi
+# Created:     21-08-2024
+# Copyright:   (c) Suraj Joshi 2024
+#--------------------------------------------------
+# Local fitting service for an analysis machine shared by several operators. Instead of every
+# launcher starting its own interpreters, one long-running service keeps a pool of worker
+# processes, one per core, with the step scripts (numpy, scipy, lmfit, matplotlib) already imported,
+# and runs the pipeline stages of pipeline.py for all submitted sample directories on them.
+# Whenever a worker is free the dispatcher starts a ready stage: highest job priority first, then
+# the user with the fewest running stages, then the oldest job, and within a job the longest
+# branch. Every worker runs single-threaded BLAS, so the machine never has more busy threads than
+# cores. A stage writes the same outputs, pipeline_state.json record and "pipeline logs" file as
+# in a pipeline run; its progress bar is reported back to the service.
+#
+# HTTP API on 127.0.0.1 (JSON bodies), address for the clients in FMR_SERVICE:
+#   POST   /jobs        {"directory": ..., "stages": [...], "settings": {"lorentzian_fit": {...}},
+#                        "priority": 0, "user": ..., "force": false}  -> the new job
+#   GET    /jobs        all jobs; GET /jobs/<id> one job with the status, progress and time of its stages
+#   DELETE /jobs/<id>   cancel: stages that have not started are dropped, running ones finish
+#   GET    /status      workers, busy workers and job counts
+#
+# Command line:
+#   python fit_service.py serve [--port 8765] [--workers 8]
+#   python fit_service.py submit D:/data/sample [--priority 1] [--stages kittel linewidth] [--force] [--wait]
+#   python fit_service.py status [JOB]
+#   python fit_service.py cancel JOB
+import os
+import sys
+import json
+import time
+import queue
+import signal
+import getpass
+import argparse
+import threading
+import traceback
+import contextlib
+import multiprocessing
+import urllib.error
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pipeline import SCRIPT_DIRECTORY, STAGES, STAGE_MAP, LOG_FOLDER, HeadlessProgress, PipelineRun, load_script, \
+    run_stage
+
+DEFAULT_PORT = 8765
+SERVICE_ADDRESS = os.environ.get("FMR_SERVICE", f"http://127.0.0.1:{DEFAULT_PORT}")
+# Environment of the workers: one thread each, no windows
+WORKER_ENVIRONMENT = dict(OMP_NUM_THREADS="1", OPENBLAS_NUM_THREADS="1", MKL_NUM_THREADS="1",
+                          NUMEXPR_NUM_THREADS="1", MPLBACKEND="Agg")
+FINISHED_JOBS_KEPT = 100
+
+_progress_queue = None
+
+
+def warm_worker(progress_queue):
+    # Initializer of a worker process: imports every step script once, so a stage starts without
+    # the interpreter and library start-up. A script that fails to import is reported in the log
+    # of the stage that needs it.
+    global _progress_queue
+    _progress_queue = progress_queue
+    os.chdir(SCRIPT_DIRECTORY)
+    for script in sorted({stage.script for stage in STAGES}):
+        try:
+            load_script(script)
+        except Exception:
+            pass
+
+
+class ReportingProgress(HeadlessProgress):
+    # Progress bar of a stage in a worker: every whole percent is sent to the service when the step
+    # refreshes its window
+    def __init__(self, job_id, name):
+        super().__init__()
+        self.key = (job_id, name)
+        self.sent = None
+
+    def update_idletasks(self):
+        percent = int(100 * self.get("value", 0) / (self.get("maximum") or 100))
+        if percent != self.sent and _progress_queue is not None:
+            self.sent = percent
+            _progress_queue.put(self.key + (percent,))
+
+
+def run_service_stage(job_id, name, directory, settings):
+    # Body of a stage in a worker, with the output in the stage log; False when the stage failed
+    os.makedirs(os.path.join(directory, LOG_FOLDER), exist_ok=True)
+    with open(os.path.join(directory, LOG_FOLDER, f"{name}.log"), "w") as log_file, \
+            contextlib.redirect_stdout(log_file), contextlib.redirect_stderr(log_file):
+        try:
+            run_stage(name, directory, settings, ReportingProgress(job_id, name))
+            return True
+        except Exception:
+            traceback.print_exc()
+            return False
+        finally:
+            # The worker stays alive, so the figures of the stage must not
+            pyplot = sys.modules.get("matplotlib.pyplot")
+            if pyplot is not None:
+                pyplot.close("all")
+
+
+class ServiceJob(PipelineRun):
+    # Pipeline run of one submission; the service starts its stages on the shared worker pool.
+    # settings overrides the stage settings per stage, on top of pipeline_settings.json.
+    def __init__(self, job_id, directory, stage_names=None, settings=None, priority=0, user="", force=False):
+        super().__init__(directory, stage_names, None, force)
+        for name, overrides in (settings or {}).items():
+            self.settings[name].update(overrides)
+        self.id = job_id
+        self.priority = priority
+        self.user = user
+        self.submitted = time.time()
+        self.cancelled = False
+
+    def collect(self):
+        for name, (future, start) in list(self.running.items()):
+            if not future.done():
+                continue
+            del self.running[name]
+            try:
+                succeeded = future.result()
+            except BrokenProcessPool:
+                # The worker died (crash or memory), the stage log has what it wrote up to then
+                succeeded = False
+            self.finish(name, succeeded, time.perf_counter() - start)
+
+    def cancel(self):
+        self.cancelled = True
+        for name, status in self.status.items():
+            if status == "waiting":
+                self.status[name] = "cancelled"
+
+    def job_state(self):
+        if not self.finished():
+            return "running" if self.running or self.times else "queued"
+        if self.cancelled:
+            return "cancelled"
+        return "failed" if "failed" in self.status.values() else "done"
+
+    def describe(self):
+        return dict(id=self.id, directory=self.directory, user=self.user, priority=self.priority,
+                    submitted=self.submitted, state=self.job_state(), summary=self.summary(),
+                    stages={stage.name: dict(label=stage.label, status=self.status[stage.name],
+                                             progress=self.progress.get(stage.name),
+                                             time=self.elapsed(stage.name)) for stage in self.stages})
+
+
+class FitService:
+    # Job queue, warm worker pool and the dispatcher thread that starts the stages
+    def __init__(self, workers=None):
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.jobs = {}
+        self.next_id = 1
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopping = False
+        for key, value in WORKER_ENVIRONMENT.items():
+            os.environ.setdefault(key, value)
+        self.context = multiprocessing.get_context("spawn")
+        self.progress_queue = self.context.Queue()
+        self.pool = self.new_pool()
+        self.threads = [threading.Thread(target=self.dispatch, daemon=True),
+                        threading.Thread(target=self.receive_progress, daemon=True)]
+        for thread in self.threads:
+            thread.start()
+
+    def new_pool(self):
+        pool = ProcessPoolExecutor(self.workers, mp_context=self.context, initializer=warm_worker,
+                                   initargs=(self.progress_queue,))
+        # Start all workers now rather than at the first stages
+        for _ in range(self.workers):
+            pool.submit(os.getpid)
+        return pool
+
+    def submit(self, directory, stages=None, settings=None, priority=0, user="", force=False):
+        directory = os.path.abspath(directory)
+        if not os.path.isdir(directory):
+            raise ValueError(f"{directory} is not a directory.")
+        unknown = (set(stages or ()) | set(settings or {})) - set(STAGE_MAP)
+        if unknown:
+            raise ValueError(f"Unknown stages: {', '.join(sorted(unknown))}.")
+        with self.lock:
+            if any(job.directory == directory and not job.finished() for job in self.jobs.values()):
+                raise ValueError(f"A job for {directory} is already queued or running.")
+            job = ServiceJob(self.next_id, directory, stages, settings, int(priority), user or "", bool(force))
+            self.jobs[job.id] = job
+            self.next_id += 1
+            self.forget_finished()
+            description = job.describe()
+        self.wake.set()
+        return description
+
+    def forget_finished(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished()]
+        for job_id in finished[:max(0, len(finished) - FINISHED_JOBS_KEPT)]:
+            del self.jobs[job_id]
+
+    def job(self, job_id):
+        with self.lock:
+            return self.jobs[job_id].describe()
+
+    def list_jobs(self):
+        with self.lock:
+            return [job.describe() for job in self.jobs.values()]
+
+    def cancel(self, job_id):
+        with self.lock:
+            self.jobs[job_id].cancel()
+            return self.jobs[job_id].describe()
+
+    def describe(self):
+        with self.lock:
+            states = [job.job_state() for job in self.jobs.values()]
+            return dict(workers=self.workers, busy=sum(len(job.running) for job in self.jobs.values()),
+                        jobs={state: states.count(state) for state in sorted(set(states))})
+
+    def start(self, job, stage):
+        arguments = (run_service_stage, job.id, stage.name, job.directory, job.settings[stage.name])
+        try:
+            future = self.pool.submit(*arguments)
+        except BrokenProcessPool:
+            self.pool = self.new_pool()
+            future = self.pool.submit(*arguments)
+        future.add_done_callback(lambda _: self.wake.set())
+        job.running[stage.name] = (future, time.perf_counter())
+        job.status[stage.name] = "running"
+
+    def schedule(self):
+        active = [job for job in self.jobs.values() if not job.finished()]
+        for job in active:
+            job.collect()
+        free = self.workers - sum(len(job.running) for job in active)
+        candidates = [(job, stage) for job in active for stage in job.ready()]
+        running = {}
+        for job in active:
+            running[job.user] = running.get(job.user, 0) + len(job.running)
+        while free > 0 and candidates:
+            # min keeps the longest-branch order of ready() between stages of the same job
+            job, stage = min(candidates, key=lambda item: (-item[0].priority, running[item[0].user], item[0].id))
+            candidates.remove((job, stage))
+            self.start(job, stage)
+            running[job.user] += 1
+            free -= 1
+
+    def dispatch(self):
+        while not self.stopping:
+            self.wake.wait(1.0)
+            self.wake.clear()
+            with self.lock:
+                self.schedule()
+
+    def receive_progress(self):
+        while not self.stopping:
+            try:
+                job_id, name, percent = self.progress_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            with self.lock:
+                if job_id in self.jobs:
+                    self.jobs[job_id].progress[name] = percent
+
+    def shutdown(self):
+        self.stopping = True
+        self.wake.set()
+        self.pool.shutdown(wait=True, cancel_futures=True)
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    # JSON requests of the clients; self.server.service is the FitService
+    def send_json(self, code, values):
+        body = json.dumps(values).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_request(self, method):
+        service = self.server.service
+        parts = self.path.strip("/").split("/")
+        try:
+            if method == "GET" and parts == ["status"]:
+                self.send_json(200, service.describe())
+            elif method == "GET" and parts == ["jobs"]:
+                self.send_json(200, service.list_jobs())
+            elif method == "GET" and len(parts) == 2 and parts[0] == "jobs":
+                self.send_json(200, service.job(int(parts[1])))
+            elif method == "DELETE" and len(parts) == 2 and parts[0] == "jobs":
+                self.send_json(200, service.cancel(int(parts[1])))
+            elif method == "POST" and parts == ["jobs"]:
+                values = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                if not isinstance(values, dict) or "directory" not in values:
+                    raise ValueError("A job needs a directory.")
+                self.send_json(201, service.submit(values["directory"], values.get("stages"), values.get("settings"),
+                                                   values.get("priority", 0), values.get("user", ""),
+                                                   values.get("force", False)))
+            else:
+                self.send_json(404, dict(error=f"No {method} {self.path}"))
+        except KeyError as e:
+            self.send_json(404, dict(error=f"No job {e}"))
+        except (ValueError, TypeError) as e:
+            self.send_json(400, dict(error=str(e)))
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_DELETE(self):
+        self.handle_request("DELETE")
+
+    def log_message(self, format, *args):
+        # The launchers poll every fraction of a second
+        pass
+
+
+def serve(host="127.0.0.1", port=DEFAULT_PORT, workers=None):
+    service = FitService(workers)
+    server = ThreadingHTTPServer((host, port), ServiceHandler)
+    server.service = service
+    # A stopped service (kill, service manager) also takes its workers down; shutdown() has to come
+    # from another thread than serve_forever
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+    print(f"Fit service on http://{host}:{server.server_address[1]} with {service.workers} workers")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
+
+
+def request(method, path, values=None, address=None, timeout=10):
+    # One JSON request to the service; the error message of a rejected request as ValueError, an
+    # unreachable service as OSError
+    data = None if values is None else json.dumps(values).encode()
+    service_request = urllib.request.Request((address or SERVICE_ADDRESS).rstrip("/") + path, data, method=method,
+                                             headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(service_request, timeout=timeout) as response:
+            return json.load(response)
+    except urllib.error.HTTPError as e:
+        raise ValueError(json.load(e).get("error", str(e))) from None
+
+
+def service_available(address=None):
+    try:
+        request("GET", "/status", address=address, timeout=1)
+        return True
+    except (OSError, ValueError):
+        return False
+
+
+class RemoteRun:
+    # A job on the service with the polling interface of PipelineRun, so the launcher shows it in the
+    # same stage table
+    def __init__(self, directory, stage_names=None, force=False, settings=None, priority=0, user=None, address=None):
+        self.address = address
+        self.update(request("POST", "/jobs", dict(directory=os.path.abspath(directory), stages=stage_names,
+                                                  settings=settings, priority=priority, force=force,
+                                                  user=user or getpass.getuser()), address))
+
+    def update(self, job):
+        self.job = job
+        self.status = {name: stage["status"] for name, stage in job["stages"].items()}
+        self.progress = {name: stage["progress"] for name, stage in job["stages"].items()
+                         if stage["progress"] is not None}
+
+    def poll(self):
+        # Returns True while the job is queued or running
+        self.update(request("GET", f"/jobs/{self.job['id']}", address=self.address))
+        return self.job["state"] in ("queued", "running")
+
+    def elapsed(self, name):
+        return self.job["stages"][name]["time"] if name in self.job["stages"] else None
+
+    def cancel(self):
+        try:
+            self.update(request("DELETE", f"/jobs/{self.job['id']}", address=self.address))
+        except OSError:
+            # Service gone, there is nothing left to cancel
+            pass
+
+    def summary(self):
+        return f"{self.job['summary']} (fit service job {self.job['id']}, {self.job['state']})"
+
+
+def print_job(job):
+    print(f"Job {job['id']} {job['state']}: {job['directory']} ({job['user']}, priority {job['priority']})")
+    for stage in job["stages"].values():
+        progress = f"{stage['progress']}%" if stage["status"] == "running" and stage["progress"] is not None else ""
+        elapsed = f"{stage['time']:.1f} s" if stage["time"] is not None else ""
+        print(f"  {stage['label']:45s} {stage['status']:12s} {progress:>5s} {elapsed}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Shared FMR fitting service and its command line client.")
+    parser.add_argument("--address", default=None, help=f"service address (default: {SERVICE_ADDRESS})")
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve_parser = commands.add_parser("serve", help="run the service")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    serve_parser.add_argument("--workers", type=int, default=None, help="worker processes (default: CPU count)")
+    submit_parser = commands.add_parser("submit", help="queue the pipeline of a sample directory")
+    submit_parser.add_argument("directory")
+    submit_parser.add_argument("--stages", nargs="+", choices=list(STAGE_MAP), help="run only these stages")
+    submit_parser.add_argument("--priority", type=int, default=0, help="higher runs first")
+    submit_parser.add_argument("--force", action="store_true", help="also run the up-to-date stages")
+    submit_parser.add_argument("--wait", action="store_true", help="report progress until the job is finished")
+    status_parser = commands.add_parser("status", help="show the jobs, or one job")
+    status_parser.add_argument("job", type=int, nargs="?")
+    cancel_parser = commands.add_parser("cancel", help="cancel a job")
+    cancel_parser.add_argument("job", type=int)
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        serve(args.host, args.port, args.workers)
+        return 0
+    try:
+        if args.command == "submit":
+            run = RemoteRun(args.directory, args.stages, args.force, priority=args.priority, address=args.address)
+            print(run.summary())
+            summary = run.summary()
+            while args.wait and run.poll():
+                if run.summary() != summary:
+                    summary = run.summary()
+                    print(summary)
+                time.sleep(0.5)
+            if args.wait:
+                print_job(run.job)
+                return 1 if run.job["state"] == "failed" else 0
+        elif args.command == "status" and args.job is None:
+            print(request("GET", "/status", address=args.address))
+            for job in request("GET", "/jobs", address=args.address):
+                print(f"Job {job['id']:4d} {job['state']:10s} {job['user']:12s} {job['summary']}  {job['directory']}")
+        elif args.command == "status":
+            print_job(request("GET", f"/jobs/{args.job}", address=args.address))
+        else:
+            print_job(request("DELETE", f"/jobs/{args.job}", address=args.address))
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+    except OSError as e:
+        print(f"No fit service at {args.address or SERVICE_ADDRESS}: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
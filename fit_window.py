@@ -0,0 +1,43 @@
+#-------------------------------------------------
+# Author:      Suraj Joshi
+# Created:     21-08-2024
+# Copyright:   (c) Suraj Joshi 2024
+#--------------------------------------------------
+import numpy as np
+
+
+def sort_by_field(x, y):
+    # Return x and y as arrays ordered by ascending field.
+    # Data that is already ascending (the usual case) is returned without a copy,
+    # descending data is returned as reversed views, and only unordered data is sorted.
+    x = np.asarray(x)
+    y = np.asarray(y)
+    if x.size < 2:
+        return x, y
+
+    if np.all(x[1:] >= x[:-1]):
+        return x, y
+    if np.all(x[1:] <= x[:-1]):
+        return x[::-1], y[::-1]
+
+    sorted_indices = np.argsort(x, kind="stable")
+    return x[sorted_indices], y[sorted_indices]
+
+
+def window_bounds(x, center, delta_x):
+    # Index bounds [lo, hi) of the points of a sorted field array within center +/- delta_x
+    lo = int(np.searchsorted(x, center - delta_x, side="left"))
+    hi = int(np.searchsorted(x, center + delta_x, side="right"))
+    return lo, hi
+
+
+def window_around_peak(x, y, delta_x, peak="max"):
+    # Cut the field range center +/- delta_x around the maximum ("max") or minimum ("min") of y.
+    # The returned arrays are views into the sorted data, so no full-size masks are built.
+    x, y = sort_by_field(x, y)
+    if x.size == 0:
+        return x, y
+
+    peak_index = np.argmax(y) if peak == "max" else np.argmin(y)
+    lo, hi = window_bounds(x, x[peak_index], delta_x)
+    return x[lo:hi], y[lo:hi]
@@ -0,0 +1,476 @@
+#-------------------------------------------------
+# Author:      Suraj Joshi
+# Created:     21-08-2024
+# Copyright:   (c) Suraj Joshi 2024
+#--------------------------------------------------
+# Evaluation kernels for the lineshapes used by the least_squares and batch_lm backends. A kernel
+# fills the model (or the residual model - y) and the Jacobian of one lineshape in a single pass into
+# output arrays, instead of the reference functions of lineshapes.py, which recompute (x - H_res) in
+# every expression, allocate a temporary per operation and are stacked column by column afterwards.
+# Kernel sets, in the order "auto" tries them:
+#   numba      compiled loops over the points, no temporaries (when numba is installed)
+#   numpy      shared subexpressions computed once into per-thread scratch arrays that are kept
+#              between calls, in-place ufuncs writing into the outputs
+#   numexpr    blocked evaluation of the reference expressions (when numexpr is installed); it
+#              recomputes the subexpressions of every Jacobian column and only pays off with several
+#              cores, so "auto" never reaches it
+#   reference  the functions of lineshapes.py (also used for lineshapes without a kernel)
+# derivative_lorentzian, skew_derivative_lorentzian, S21 and f_kittel have kernels. The set is chosen
+# with select_kernels(name) or the FMR_KERNELS environment variable (default "auto"). The kernel of
+# a lineshape is checked against the reference functions the first time it is used and replaced by
+# the reference if its model or Jacobian differ by more than RTOL of their largest value.
+# x is (n_points,) with p (n_params,), or (n_spectra, n_points) with p (n_spectra, n_params); the
+# Jacobian has shape x.shape + (n_params,).
+import os
+import warnings
+import threading
+import numpy as np
+from lineshapes import LINESHAPES
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+RTOL = 1e-12
+KERNEL_ORDER = ("numba", "numpy", "numexpr", "reference")
+
+_EMPTY2 = np.empty((0, 0))
+_EMPTY3 = np.empty((0, 0, 0))
+_scratch = threading.local()
+
+
+def scratch(shape, n):
+    # n work arrays of shape from one buffer per thread, which only grows, so the iterations of a fit
+    # (and the shrinking batches of batch_lm) allocate nothing of the size of the spectra
+    size = n * int(np.prod(shape))
+    buffer = getattr(_scratch, "buffer", None)
+    if buffer is None or buffer.size < size:
+        buffer = _scratch.buffer = np.empty(size)
+    return buffer[:size].reshape((n,) + tuple(shape))
+
+
+# Fused NumPy kernels. Every fill(x, p, y, f, J, mode, want_J) writes the model (mode 1) or
+# model - y (mode 2) into f and, with want_J, the Jacobian into J; only per-spectrum (n_spectra, 1)
+# parameter expressions are temporaries.
+
+def derivative_lorentzian_numpy(x, p, y, f, J, mode, want_J):
+    A, H_res, LW = p[:, 0:1], p[:, 1:2], p[:, 2:3]
+    d, D, scale = scratch(x.shape, 3)
+    np.subtract(x, H_res, out=d)
+    np.multiply(d, d, out=D)
+    D += (LW / 2) ** 2
+    np.multiply(D, D, out=scale)
+    scale *= np.pi
+    np.reciprocal(scale, out=scale)  # 1 / (pi D^2)
+    if want_J:
+        dA, dH_res, dLW = J[..., 0], J[..., 1], J[..., 2]
+        np.multiply(d, scale, out=dA)
+        dA *= -LW
+        # A LW / pi (1 / D^2 - 4 d^2 / D^3) = A LW / (pi D^2) (1 - 4 d^2 / D)
+        np.multiply(d, d, out=dH_res)
+        dH_res /= D
+        dH_res *= -4
+        dH_res += 1
+        dH_res *= scale
+        dH_res *= A * LW
+        # -A d / pi (1 / D^2 - LW^2 / D^3)
+        np.divide(LW ** 2, D, out=dLW)
+        np.subtract(1, dLW, out=dLW)
+        dLW *= scale
+        dLW *= d
+        dLW *= -A
+        if mode:
+            np.multiply(dA, A, out=f)
+    elif mode:
+        np.multiply(d, scale, out=f)
+        f *= -A * LW
+    if mode == 2:
+        f -= y
+
+
+def skew_derivative_lorentzian_numpy(x, p, y, f, J, mode, want_J):
+    A, H_res, LW, alpha = p[:, 0:1], p[:, 1:2], p[:, 2:3], p[:, 3:4]
+    d, s, D, scale, ds, df_ds = scratch(x.shape, 6)
+    np.subtract(x, H_res, out=d)
+    np.multiply(d, alpha, out=s)
+    s += 1
+    s *= LW / 2
+    np.multiply(d, d, out=D)
+    np.multiply(s, s, out=scale)
+    D += scale
+    np.multiply(D, D, out=scale)
+    scale *= np.pi
+    np.reciprocal(scale, out=scale)  # 1 / (pi D^2)
+    np.multiply(d, s, out=ds)
+    ds *= scale
+    if mode:
+        np.multiply(ds, -2 * A, out=f)
+        if mode == 2:
+            f -= y
+    if want_J:
+        dA, dH_res, dLW, dalpha = J[..., 0], J[..., 1], J[..., 2], J[..., 3]
+        np.multiply(ds, -2, out=dA)
+        # df/ds = -2 A d / (pi D^2) (1 - 4 s^2 / D)
+        np.multiply(s, s, out=df_ds)
+        df_ds /= D
+        df_ds *= -4
+        df_ds += 1
+        df_ds *= d
+        df_ds *= scale
+        df_ds *= -2 * A
+        # df/dd = -2 A s / (pi D^2) (1 - 4 d^2 / D) and dH_res = -(df/dd + df/ds LW alpha / 2)
+        np.multiply(d, d, out=dH_res)
+        dH_res /= D
+        dH_res *= -4
+        dH_res += 1
+        dH_res *= s
+        dH_res *= scale
+        dH_res *= -2 * A
+        np.multiply(df_ds, LW * alpha / 2, out=dLW)
+        dH_res += dLW
+        np.negative(dH_res, out=dH_res)
+        np.multiply(d, alpha, out=dLW)
+        dLW += 1
+        dLW *= df_ds
+        dLW /= 2
+        np.multiply(df_ds, d, out=dalpha)
+        dalpha *= LW / 2
+
+
+def S21_numpy(x, p, y, f, J, mode, want_J):
+    A, sigma, H_res = p[:, 0:1], p[:, 1:2], p[:, 2:3]
+    d, Q, scale = scratch(x.shape, 3)
+    np.subtract(x, H_res, out=d)
+    np.multiply(d, d, out=Q)
+    Q += sigma ** 2
+    np.multiply(Q, np.pi, out=scale)
+    np.reciprocal(scale, out=scale)  # 1 / (pi Q)
+    if want_J:
+        dA, dsigma, dH_res = J[..., 0], J[..., 1], J[..., 2]
+        np.multiply(scale, sigma, out=dA)
+        # A / pi (1 / Q - 2 sigma^2 / Q^2) = A / (pi Q) (1 - 2 sigma^2 / Q)
+        np.divide(2 * sigma ** 2, Q, out=dsigma)
+        np.subtract(1, dsigma, out=dsigma)
+        dsigma *= scale
+        dsigma *= A
+        # 2 A sigma d / (pi Q^2)
+        np.multiply(d, scale, out=dH_res)
+        dH_res /= Q
+        dH_res *= 2 * A * sigma
+        if mode:
+            np.multiply(dA, A, out=f)
+    elif mode:
+        np.multiply(scale, A * sigma, out=f)
+    if mode == 2:
+        f -= y
+
+
+def f_kittel_numpy(x, p, y, f, J, mode, want_J):
+    M_eff, H_k, gamma = p[:, 0:1], p[:, 1:2], p[:, 2:3]
+    a, b, root = scratch(x.shape, 3)
+    np.add(x, H_k, out=a)
+    np.add(x, M_eff, out=b)
+    b += H_k
+    np.multiply(a, b, out=root)
+    np.sqrt(root, out=root)
+    if mode:
+        np.multiply(root, gamma, out=f)
+        if mode == 2:
+            f -= y
+    if want_J:
+        dM_eff, dH_k, dgamma = J[..., 0], J[..., 1], J[..., 2]
+        # gamma (x + H_k) / (2 root), gamma (2 x + M_eff + 2 H_k) / (2 root), root
+        np.divide(a, root, out=dM_eff)
+        dM_eff *= gamma / 2
+        np.add(a, b, out=dH_k)
+        dH_k /= root
+        dH_k *= gamma / 2
+        dgamma[...] = root
+
+
+# Loops over the points for numba: the same expressions as the NumPy kernels, one point at a time
+
+def derivative_lorentzian_loop(x, p, y, f, J, mode, want_J):
+    for i in range(x.shape[0]):
+        A, H_res, LW = p[i, 0], p[i, 1], p[i, 2]
+        for j in range(x.shape[1]):
+            d = x[i, j] - H_res
+            D = d * d + (LW / 2) * (LW / 2)
+            scale = 1 / (np.pi * D * D)
+            dA = -LW * d * scale
+            if mode == 1:
+                f[i, j] = A * dA
+            elif mode == 2:
+                f[i, j] = A * dA - y[i, j]
+            if want_J:
+                J[i, j, 0] = dA
+                J[i, j, 1] = A * LW * scale * (1 - 4 * d * d / D)
+                J[i, j, 2] = -A * d * scale * (1 - LW * LW / D)
+
+
+def skew_derivative_lorentzian_loop(x, p, y, f, J, mode, want_J):
+    for i in range(x.shape[0]):
+        A, H_res, LW, alpha = p[i, 0], p[i, 1], p[i, 2], p[i, 3]
+        for j in range(x.shape[1]):
+            d = x[i, j] - H_res
+            s = LW / 2 * (1 + alpha * d)
+            D = d * d + s * s
+            scale = 1 / (np.pi * D * D)
+            dA = -2 * d * s * scale
+            if mode == 1:
+                f[i, j] = A * dA
+            elif mode == 2:
+                f[i, j] = A * dA - y[i, j]
+            if want_J:
+                df_ds = -2 * A * d * scale * (1 - 4 * s * s / D)
+                df_dd = -2 * A * s * scale * (1 - 4 * d * d / D)
+                J[i, j, 0] = dA
+                J[i, j, 1] = -(df_dd + df_ds * LW * alpha / 2)
+                J[i, j, 2] = df_ds * (1 + alpha * d) / 2
+                J[i, j, 3] = df_ds * LW * d / 2
+
+
+def S21_loop(x, p, y, f, J, mode, want_J):
+    for i in range(x.shape[0]):
+        A, sigma, H_res = p[i, 0], p[i, 1], p[i, 2]
+        for j in range(x.shape[1]):
+            d = x[i, j] - H_res
+            Q = d * d + sigma * sigma
+            scale = 1 / (np.pi * Q)
+            dA = sigma * scale
+            if mode == 1:
+                f[i, j] = A * dA
+            elif mode == 2:
+                f[i, j] = A * dA - y[i, j]
+            if want_J:
+                J[i, j, 0] = dA
+                J[i, j, 1] = A * scale * (1 - 2 * sigma * sigma / Q)
+                J[i, j, 2] = 2 * A * sigma * d * scale / Q
+
+
+def f_kittel_loop(x, p, y, f, J, mode, want_J):
+    for i in range(x.shape[0]):
+        M_eff, H_k, gamma = p[i, 0], p[i, 1], p[i, 2]
+        for j in range(x.shape[1]):
+            a = x[i, j] + H_k
+            b = x[i, j] + M_eff + H_k
+            root = np.sqrt(a * b)
+            if mode == 1:
+                f[i, j] = gamma * root
+            elif mode == 2:
+                f[i, j] = gamma * root - y[i, j]
+            if want_J:
+                J[i, j, 0] = gamma * a / (2 * root)
+                J[i, j, 1] = gamma * (a + b) / (2 * root)
+                J[i, j, 2] = root
+
+
+# numexpr: the reference expressions with (x - H_res) etc. substituted, model and Jacobian columns
+
+def _skew_expressions():
+    d = "(x - H_res)"
+    s = f"(LW / 2 * (1 + alpha * {d}))"
+    D = f"({d} ** 2 + {s} ** 2)"
+    df_ds = f"(-2 * A * {d} / pi * (1 / {D} ** 2 - 4 * {s} ** 2 / {D} ** 3))"
+    df_dd = f"(-2 * A * {s} / pi * (1 / {D} ** 2 - 4 * {d} ** 2 / {D} ** 3))"
+    return (f"-2 * A * {d} * {s} / (pi * {D} ** 2)",
+            [f"-2 * {d} * {s} / (pi * {D} ** 2)", f"-({df_dd} + {df_ds} * LW * alpha / 2)",
+             f"{df_ds} * (1 + alpha * {d}) / 2", f"{df_ds} * LW * {d} / 2"])
+
+
+_d = "(x - H_res)"
+_D = f"({_d} ** 2 + (LW / 2) ** 2)"
+_Q = f"({_d} ** 2 + sigma ** 2)"
+_root = "sqrt((x + H_k) * (x + M_eff + H_k))"
+NUMEXPR_EXPRESSIONS = {
+    "derivative_lorentzian": (
+        f"-(A * LW * {_d}) / (pi * {_D} ** 2)",
+        [f"-(LW * {_d}) / (pi * {_D} ** 2)", f"A * LW / pi * (1 / {_D} ** 2 - 4 * {_d} ** 2 / {_D} ** 3)",
+         f"-A * {_d} / pi * (1 / {_D} ** 2 - LW ** 2 / {_D} ** 3)"]),
+    "skew_derivative_lorentzian": _skew_expressions(),
+    "S21": (
+        f"(A * sigma) / (pi * {_Q})",
+        [f"sigma / (pi * {_Q})", f"A / pi * (1 / {_Q} - 2 * sigma ** 2 / {_Q} ** 2)",
+         f"2 * A * sigma * {_d} / (pi * {_Q} ** 2)"]),
+    "f_kittel": (
+        f"gamma * {_root}",
+        [f"gamma * (x + H_k) / (2 * {_root})", f"gamma * (2 * x + M_eff + 2 * H_k) / (2 * {_root})", _root]),
+}
+
+
+def numexpr_fill(lineshape):
+    model, columns = NUMEXPR_EXPRESSIONS[lineshape.name]
+    residual = model + " - y"
+
+    def fill(x, p, y, f, J, mode, want_J):
+        names = {name: p[:, k:k + 1] for k, name in enumerate(lineshape.param_names)}
+        names.update(x=x, y=y, pi=np.pi)
+        if mode:
+            numexpr.evaluate(residual if mode == 2 else model, local_dict=names, out=f)
+        if want_J:
+            for k, column in enumerate(columns):
+                numexpr.evaluate(column, local_dict=names, out=J[..., k])
+    return fill
+
+
+def reference_fill(lineshape):
+    def fill(x, p, y, f, J, mode, want_J):
+        params = [p[:, k:k + 1] for k in range(p.shape[1])]
+        if mode:
+            f[...] = lineshape.function(x, *params)
+            if mode == 2:
+                f -= y
+        if want_J:
+            for k, column in enumerate(lineshape.jacobian(x, *params)):
+                J[..., k] = column
+    return fill
+
+
+NUMPY_FILLS = {
+    "derivative_lorentzian": derivative_lorentzian_numpy,
+    "skew_derivative_lorentzian": skew_derivative_lorentzian_numpy,
+    "S21": S21_numpy,
+    "f_kittel": f_kittel_numpy,
+}
+LOOP_FILLS = {
+    "derivative_lorentzian": derivative_lorentzian_loop,
+    "skew_derivative_lorentzian": skew_derivative_lorentzian_loop,
+    "S21": S21_loop,
+    "f_kittel": f_kittel_loop,
+}
+
+# Fill function of every lineshape with a kernel, per available kernel set
+KERNEL_SETS = {"reference": {}, "numpy": NUMPY_FILLS}
+if numexpr is not None:
+    KERNEL_SETS["numexpr"] = {name: numexpr_fill(LINESHAPES[name]) for name in NUMEXPR_EXPRESSIONS}
+if numba is not None:
+    KERNEL_SETS["numba"] = {name: numba.njit(cache=True)(loop) for name, loop in LOOP_FILLS.items()}
+
+
+class Kernel:
+    # Model, residual and Jacobian of one lineshape through a fill function. Outputs are allocated
+    # once per call unless passed in (out, r, J); the Jacobian is allocated column-contiguous.
+    def __init__(self, lineshape, fill, kernel_set):
+        self.lineshape = lineshape
+        self.fill = fill
+        self.kernel_set = kernel_set
+        self.n_params = len(lineshape.param_names)
+
+    def evaluate(self, x, p, y=None, f=None, J=None, model=True, jacobian=False):
+        x = np.asarray(x, dtype=float)
+        single = x.ndim == 1
+        x2 = x[np.newaxis] if single else x
+        p2 = np.asarray(p, dtype=float).reshape(x2.shape[0], self.n_params)
+        mode = 0
+        if model:
+            mode = 1 if y is None else 2
+            if f is None:
+                f = np.empty(x.shape)
+        if jacobian and J is None:
+            J = np.moveaxis(np.empty((self.n_params,) + x.shape), 0, -1)
+        y2 = _EMPTY2 if y is None else np.asarray(y, dtype=float).reshape(x2.shape)
+        f2 = _EMPTY2 if not model else (f[np.newaxis] if single else f)
+        J3 = _EMPTY3 if not jacobian else (J[np.newaxis] if single else J)
+        self.fill(x2, p2, y2, f2, J3, mode, jacobian)
+        return f, J
+
+    def model(self, x, p, out=None):
+        return self.evaluate(x, p, f=out)[0]
+
+    def residual(self, x, y, p, out=None):
+        return self.evaluate(x, p, y, f=out)[0]
+
+    def jacobian(self, x, p, out=None):
+        return self.evaluate(x, p, J=out, model=False, jacobian=True)[1]
+
+    def residual_jacobian(self, x, y, p, r=None, J=None):
+        return self.evaluate(x, p, y, r, J, jacobian=True)
+
+
+# Points and parameter rows on which the kernels are compared with the reference functions
+VALIDATION_CASES = {
+    "derivative_lorentzian": (np.linspace(0, 3000, 301), [[-15, 1200, 40], [3, 500, 120], [1e-3, 2500, 8]]),
+    "skew_derivative_lorentzian": (np.linspace(0, 3000, 301),
+                                   [[-15, 1200, 40, 1e-3], [3, 500, 120, -2e-3], [1e-3, 2500, 8, 0]]),
+    "S21": (np.linspace(0, 3000, 301), [[-20, 20, 1200], [5, 80, 400], [1e-2, 3, 2900]]),
+    "f_kittel": (np.linspace(0.01, 1, 100), [[1.0, 0.01, 28], [0.5, 0, 29.5], [1.8, -0.005, 30]]),
+}
+
+
+def validate_kernel(kernel):
+    # Largest difference from the reference functions, relative to the largest reference value, of
+    # the model, residual and Jacobian for one spectrum and for a batch
+    lineshape = kernel.lineshape
+    x, rows = VALIDATION_CASES[lineshape.name]
+    rows = np.array(rows, dtype=float)
+    X = np.tile(x, (len(rows), 1))
+    Y = 0.5 * lineshape.function(X, *(rows[:, k:k + 1] for k in range(kernel.n_params)))
+    reference = Kernel(lineshape, reference_fill(lineshape), "reference")
+
+    def relative(value, expected):
+        return float(np.max(np.abs(value - expected)) / np.max(np.abs(expected)))
+
+    errors = {}
+    for label, x_case, p_case, y_case in (("single", x, rows[0], Y[0]), ("batch", X, rows, Y)):
+        expected_r, expected_J = reference.residual_jacobian(x_case, y_case, p_case)
+        r, J = kernel.residual_jacobian(x_case, y_case, p_case)
+        errors[f"{label} residual"] = relative(r, expected_r)
+        errors[f"{label} model"] = relative(kernel.model(x_case, p_case), reference.model(x_case, p_case))
+        errors[f"{label} jacobian"] = max(relative(J[..., k], expected_J[..., k]) for k in range(kernel.n_params))
+        errors[f"{label} jacobian only"] = relative(kernel.jacobian(x_case, p_case), J)
+    return errors
+
+
+def available_kernels():
+    return [name for name in KERNEL_ORDER if name in KERNEL_SETS]
+
+
+_active = None
+_kernels = {}
+
+
+def select_kernels(name="auto"):
+    # Use the kernel set name ("auto": the first available of KERNEL_ORDER) from now on
+    global _active
+    if name == "auto":
+        name = available_kernels()[0]
+    if name not in KERNEL_SETS:
+        raise ValueError(f"Kernel set '{name}' is not available. Available: {', '.join(available_kernels())}")
+    _active = name
+    return name
+
+
+def active_kernels():
+    if _active is None:
+        name = os.environ.get("FMR_KERNELS", "auto")
+        if name != "auto" and name not in KERNEL_SETS:
+            warnings.warn(f"FMR_KERNELS={name} is not available, using the {available_kernels()[0]} kernels.")
+            name = "auto"
+        select_kernels(name)
+    return _active
+
+
+def get_kernel(lineshape, kernel_set=None):
+    # Kernel of lineshape in kernel_set (default the active set); the reference functions for
+    # lineshapes without a kernel, and for a kernel that does not match them to RTOL
+    kernel_set = kernel_set or active_kernels()
+    key = (kernel_set, lineshape.name, id(lineshape))
+    if key not in _kernels:
+        fill = KERNEL_SETS[kernel_set].get(lineshape.name)
+        if fill is None or LINESHAPES.get(lineshape.name) is not lineshape:
+            kernel = Kernel(lineshape, reference_fill(lineshape), "reference")
+        else:
+            kernel = Kernel(lineshape, fill, kernel_set)
+            errors = validate_kernel(kernel)
+            if max(errors.values()) > RTOL:
+                warnings.warn(f"The {kernel_set} kernel of {lineshape.name} differs from the reference by "
+                              f"{max(errors.values()):.1e}, using the reference functions.")
+                kernel = Kernel(lineshape, reference_fill(lineshape), "reference")
+        _kernels[key] = kernel
+    return _kernels[key]
@@ -0,0 +1,192 @@
+#-------------------------------------------------
+# Author:      Suraj Joshi
+# Created:     21-08-2024
+# Copyright:   (c) Suraj Joshi 2024
+#--------------------------------------------------
+# Model functions shared by the fitting steps, together with their analytic Jacobians.
+# All functions broadcast, so parameters may be scalars or column arrays of shape (n_spectra, 1).
+# Every lineshape is also written as a sum of linear coefficients times basis terms that depend only
+# on the remaining (nonlinear) parameters, which the variable projection backend uses.
+# The mixed_* lineshapes add a dispersive term (A_disp) and a linear background (offset + slope * (x - H_res)).
+import numpy as np
+
+
+class Lineshape:
+    def __init__(self, name, function, jacobian, param_names, linear_names=(), basis=None):
+        self.name = name
+        self.function = function
+        self.jacobian = jacobian
+        self.param_names = list(param_names)
+        # function(x, *params) == sum(c * term for c, term in zip(linear params, basis(x, *nonlinear params)))
+        self.linear_names = list(linear_names)
+        self.basis = basis
+
+    @property
+    def nonlinear_names(self):
+        return [name for name in self.param_names if name not in self.linear_names]
+
+    def __call__(self, x, *args, **kwargs):
+        return self.function(x, *args, **kwargs)
+
+
+def basis_jacobian(basis, n_linear, step=1e-6):
+    # Jacobian of a lineshape that is linear in its first n_linear parameters: the basis terms for
+    # those, central differences of the model for the nonlinear ones
+    def jacobian(new_x, *params):
+        linear, nonlinear = params[:n_linear], list(params[n_linear:])
+        terms = basis(new_x, *nonlinear)
+        columns = list(terms)
+        for k in range(len(nonlinear)):
+            delta = step * np.maximum(np.abs(nonlinear[k]), 1.0)
+            high, low = list(nonlinear), list(nonlinear)
+            high[k] = nonlinear[k] + delta
+            low[k] = nonlinear[k] - delta
+            difference = sum(c * (t_high - t_low) for c, t_high, t_low in
+                             zip(linear, basis(new_x, *high), basis(new_x, *low)))
+            columns.append(difference / (2 * delta))
+        return columns
+    return jacobian
+
+
+def derivative_lorentzian(new_x, A, H_res, LW):
+    return -(A * LW * (new_x - H_res)) / (np.pi * ((new_x - H_res) ** 2 + (LW / 2) ** 2) ** 2)
+
+
+def derivative_lorentzian_jacobian(new_x, A, H_res, LW):
+    d = new_x - H_res
+    D = d ** 2 + (LW / 2) ** 2
+    dA = -(LW * d) / (np.pi * D ** 2)
+    dH_res = A * LW / np.pi * (1 / D ** 2 - 4 * d ** 2 / D ** 3)
+    dLW = -A * d / np.pi * (1 / D ** 2 - LW ** 2 / D ** 3)
+    return [dA, dH_res, dLW]
+
+
+def skew_derivative_lorentzian(new_x, A, H_res, LW, alpha):
+    numerator = -2 * A * (new_x - H_res) * (LW / 2 * (1 + alpha * (new_x - H_res)))
+    denominator = np.pi * ((new_x - H_res) ** 2 + (LW / 2 * (1 + alpha * (new_x - H_res))) ** 2) ** 2
+    return numerator / denominator
+
+
+def skew_derivative_lorentzian_jacobian(new_x, A, H_res, LW, alpha):
+    d = new_x - H_res
+    s = LW / 2 * (1 + alpha * d)
+    D = d ** 2 + s ** 2
+    dA = -2 * d * s / (np.pi * D ** 2)
+    # Partial derivatives with respect to the asymmetric half width s and the offset d
+    df_ds = -2 * A * d / np.pi * (1 / D ** 2 - 4 * s ** 2 / D ** 3)
+    df_dd = -2 * A * s / np.pi * (1 / D ** 2 - 4 * d ** 2 / D ** 3)
+    dH_res = -(df_dd + df_ds * LW * alpha / 2)
+    dLW = df_ds * (1 + alpha * d) / 2
+    dalpha = df_ds * LW * d / 2
+    return [dA, dH_res, dLW, dalpha]
+
+
+def derivative_lorentzian_basis(new_x, H_res, LW):
+    return [derivative_lorentzian(new_x, 1.0, H_res, LW)]
+
+
+def skew_derivative_lorentzian_basis(new_x, H_res, LW, alpha):
+    return [skew_derivative_lorentzian(new_x, 1.0, H_res, LW, alpha)]
+
+
+def mixed_derivative_lorentzian_basis(new_x, H_res, LW):
+    # Field derivatives of the absorptive and dispersive Lorentzian, offset and slope
+    d = new_x - H_res
+    D = d ** 2 + (LW / 2) ** 2
+    return [-LW * d / (np.pi * D ** 2), ((LW / 2) ** 2 - d ** 2) / (np.pi * D ** 2), np.ones_like(d), d]
+
+
+def mixed_derivative_lorentzian(new_x, A, A_disp, offset, slope, H_res, LW):
+    absorptive, dispersive, ones, d = mixed_derivative_lorentzian_basis(new_x, H_res, LW)
+    return A * absorptive + A_disp * dispersive + offset * ones + slope * d
+
+
+def mixed_skew_derivative_lorentzian_basis(new_x, H_res, LW, alpha):
+    # As mixed_derivative_lorentzian_basis with the field-dependent half width of the skew lineshape
+    d = new_x - H_res
+    s = LW / 2 * (1 + alpha * d)
+    D = d ** 2 + s ** 2
+    return [-2 * d * s / (np.pi * D ** 2), (s ** 2 - d ** 2) / (np.pi * D ** 2), np.ones_like(d), d]
+
+
+def mixed_skew_derivative_lorentzian(new_x, A, A_disp, offset, slope, H_res, LW, alpha):
+    absorptive, dispersive, ones, d = mixed_skew_derivative_lorentzian_basis(new_x, H_res, LW, alpha)
+    return A * absorptive + A_disp * dispersive + offset * ones + slope * d
+
+
+def S21(new_x, A, sigma, H_res):
+    return (A * sigma) / (np.pi * ((new_x - H_res) ** 2 + sigma ** 2))
+
+
+def S21_jacobian(new_x, A, sigma, H_res):
+    d = new_x - H_res
+    Q = d ** 2 + sigma ** 2
+    dA = sigma / (np.pi * Q)
+    dsigma = A / np.pi * (1 / Q - 2 * sigma ** 2 / Q ** 2)
+    dH_res = 2 * A * sigma * d / (np.pi * Q ** 2)
+    return [dA, dsigma, dH_res]
+
+
+def S21_basis(new_x, sigma, H_res):
+    return [S21(new_x, 1.0, sigma, H_res)]
+
+
+def mixed_S21_basis(new_x, sigma, H_res):
+    # Absorptive and dispersive Lorentzian, offset and slope
+    d = new_x - H_res
+    Q = d ** 2 + sigma ** 2
+    return [sigma / (np.pi * Q), d / (np.pi * Q), np.ones_like(d), d]
+
+
+def mixed_S21(new_x, A, A_disp, offset, slope, sigma, H_res):
+    absorptive, dispersive, ones, d = mixed_S21_basis(new_x, sigma, H_res)
+    return A * absorptive + A_disp * dispersive + offset * ones + slope * d
+
+
+def f_kittel(x_T, M_eff, H_k, gamma):
+    return gamma * (((x_T + H_k) * (x_T + M_eff + H_k)) ** 0.5)
+
+
+def f_kittel_jacobian(x_T, M_eff, H_k, gamma):
+    root = ((x_T + H_k) * (x_T + M_eff + H_k)) ** 0.5
+    dM_eff = gamma * (x_T + H_k) / (2 * root)
+    dH_k = gamma * (2 * x_T + M_eff + 2 * H_k) / (2 * root)
+    dgamma = root
+    return [dM_eff, dH_k, dgamma]
+
+
+def f_kittel_basis(x_T, M_eff, H_k):
+    return [f_kittel(x_T, M_eff, H_k, 1.0)]
+
+
+MIXED_NAMES = ["A", "A_disp", "offset", "slope"]
+
+LINESHAPES = {
+    "derivative_lorentzian": Lineshape("derivative_lorentzian", derivative_lorentzian,
+                                       derivative_lorentzian_jacobian, ["A", "H_res", "LW"],
+                                       ["A"], derivative_lorentzian_basis),
+    "skew_derivative_lorentzian": Lineshape("skew_derivative_lorentzian", skew_derivative_lorentzian,
+                                            skew_derivative_lorentzian_jacobian, ["A", "H_res", "LW", "alpha"],
+                                            ["A"], skew_derivative_lorentzian_basis),
+    "S21": Lineshape("S21", S21, S21_jacobian, ["A", "sigma", "H_res"], ["A"], S21_basis),
+    "f_kittel": Lineshape("f_kittel", f_kittel, f_kittel_jacobian, ["M_eff", "H_k", "gamma"],
+                          ["gamma"], f_kittel_basis),
+    "mixed_derivative_lorentzian": Lineshape("mixed_derivative_lorentzian", mixed_derivative_lorentzian,
+                                             basis_jacobian(mixed_derivative_lorentzian_basis, 4),
+                                             MIXED_NAMES + ["H_res", "LW"], MIXED_NAMES,
+                                             mixed_derivative_lorentzian_basis),
+    "mixed_skew_derivative_lorentzian": Lineshape("mixed_skew_derivative_lorentzian",
+                                                  mixed_skew_derivative_lorentzian,
+                                                  basis_jacobian(mixed_skew_derivative_lorentzian_basis, 4),
+                                                  MIXED_NAMES + ["H_res", "LW", "alpha"], MIXED_NAMES,
+                                                  mixed_skew_derivative_lorentzian_basis),
+    "mixed_S21": Lineshape("mixed_S21", mixed_S21, basis_jacobian(mixed_S21_basis, 4),
+                           MIXED_NAMES + ["sigma", "H_res"], MIXED_NAMES, mixed_S21_basis),
+}
+
+# Lineshape with the dispersive term and linear background for each fitting lineshape
+MIXED_LINESHAPES = {
+    "derivative_lorentzian": "mixed_derivative_lorentzian",
+    "skew_derivative_lorentzian": "mixed_skew_derivative_lorentzian",
+    "S21": "mixed_S21",
+}
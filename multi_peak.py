@@ -0,0 +1,174 @@
+#-------------------------------------------------
+# Author:      Suraj Joshi
+# Created:     21-08-2024
+# Copyright:   (c) Suraj Joshi 2024
+#--------------------------------------------------
+# N-peak lineshape fitting for samples with several resonances (standing spin waves, multilayers).
+# Each spectrum is fitted with a sum of derivative (or skew) Lorentzians plus a shared linear
+# background. The peaks are evaluated together on a (points, peaks) array and the analytic Jacobian
+# is assembled from the single-peak Jacobians, so a spectrum costs one vectorized call per iteration.
+# Resonances are then tracked across frequencies into separate Kittel branches.
+import inspect
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+from scipy.signal import find_peaks
+
+from fit_window import window_bounds
+from lineshapes import LINESHAPES, Lineshape
+
+# Bounds of the per-peak parameters, matching the single-peak fitters
+PEAK_BOUNDS = {
+    "LW": (0, None),
+    "alpha": (-0.1, 0.1),
+}
+
+
+def multi_peak_lineshape(n_peaks, base_name="derivative_lorentzian"):
+    # Lineshape with parameters A_0, H_res_0, LW_0, ..., A_{n-1}, ..., c0, c1 (background c0 + c1 * x)
+    base = LINESHAPES[base_name]
+    n_base = len(base.param_names)
+    param_names = [f"{name}_{k}" for k in range(n_peaks) for name in base.param_names] + ["c0", "c1"]
+
+    def split(values):
+        # Per base parameter, the values of all peaks stacked on a new last (peak) axis
+        return [np.stack(np.broadcast_arrays(*values[j:n_base * n_peaks:n_base]), axis=-1) for j in range(n_base)]
+
+    def function(x, *values, **named):
+        values = values or [named[name] for name in param_names]
+        x = np.asarray(x)
+        peaks = base.function(x[..., None], *split(values)).sum(axis=-1)
+        return peaks + values[-2] + values[-1] * x
+
+    def jacobian(x, *values, **named):
+        values = values or [named[name] for name in param_names]
+        x = np.asarray(x)
+        parts = base.jacobian(x[..., None], *split(values))
+        shape = np.broadcast_shapes(*(np.shape(part) for part in parts))
+        parts = [np.broadcast_to(part, shape) for part in parts]
+        columns = [parts[j][..., k] for k in range(n_peaks) for j in range(n_base)]
+        ones = np.ones(shape[:-1])
+        return columns + [ones, ones * x]
+
+    # The amplitudes A_k and the background c0, c1 enter linearly (variable projection); basis takes
+    # the nonlinear parameters H_res_0, LW_0, ..., H_res_1, ... in the order of param_names
+    n_nonlinear = len(base.nonlinear_names)
+    linear_names = [f"{name}_{k}" for k in range(n_peaks) for name in base.linear_names] + ["c0", "c1"]
+
+    def basis(x, *nonlinear):
+        x = np.asarray(x)
+        stacked = [np.stack(np.broadcast_arrays(*nonlinear[j::n_nonlinear]), axis=-1) for j in range(n_nonlinear)]
+        terms = base.basis(x[..., None], *stacked)
+        ones = np.ones_like(x, dtype=float)
+        return [term[..., k] for k in range(n_peaks) for term in terms] + [ones, ones * x]
+
+    # An explicit signature lets lmfit.Model see the named parameters
+    signature = inspect.Signature(
+        [inspect.Parameter(name, inspect.Parameter.POSITIONAL_OR_KEYWORD) for name in ["x"] + param_names])
+    function.__signature__ = signature
+    lineshape = Lineshape(f"{n_peaks}x{base_name}", function, jacobian, param_names, linear_names, basis)
+    # What process-pool workers rebuild it from (shared_spectra.lineshape_spec)
+    lineshape.n_peaks = n_peaks
+    lineshape.base_name = base_name
+    return lineshape
+
+
+def detect_resonances(x, y, max_peaks=3, min_prominence=0.1):
+    # Candidate resonances of a derivative spectrum as (H_res, LW, A) guesses, sorted by field.
+    # A resonance is a minimum followed by a maximum (the A < 0 shape fitted by fit_lorentzian);
+    # H_res is their midpoint, LW = sqrt(3) * peak-to-peak width and A follows from the peak-to-peak height.
+    scale = np.max(np.abs(y)) if len(y) else 0
+    if scale == 0:
+        return []
+    maxima, _ = find_peaks(y, prominence=min_prominence * scale)
+    minima, _ = find_peaks(-y, prominence=min_prominence * scale)
+
+    candidates = []
+    used_minima = set()
+    for maximum in maxima:
+        below = minima[minima < maximum]
+        if below.size == 0 or below[-1] in used_minima:
+            continue
+        minimum = below[-1]
+        used_minima.add(minimum)
+        LW = np.sqrt(3) * (x[maximum] - x[minimum])
+        height = y[maximum] - y[minimum]
+        A = -height * np.sqrt(3) * np.pi * LW ** 2 / 9
+        candidates.append((height, (x[maximum] + x[minimum]) / 2, LW, A))
+
+    strongest = sorted(candidates, reverse=True)[:max_peaks]
+    return sorted((H_res, LW, A) for _, H_res, LW, A in strongest)
+
+
+def initial_guess(lineshape, resonances, base_name="derivative_lorentzian"):
+    initial = {"c0": 0.0, "c1": 0.0}
+    bounds = {}
+    for k, (H_res, LW, A) in enumerate(resonances):
+        initial.update({f"A_{k}": A, f"H_res_{k}": H_res, f"LW_{k}": LW})
+        if base_name == "skew_derivative_lorentzian":
+            initial[f"alpha_{k}"] = 0.0
+        for name, limits in PEAK_BOUNDS.items():
+            if f"{name}_{k}" in lineshape.param_names:
+                bounds[f"{name}_{k}"] = limits
+    return initial, bounds
+
+
+def fit_multi_peak_spectra(spectra, backend, delta_x, max_peaks=3, min_prominence=0.1,
+                           base_name="derivative_lorentzian"):
+    # Fit every (frequency, x, y) spectrum with as many peaks as were detected in it.
+    # Spectra with the same peak count share one lineshape and are fitted in one fit_many call.
+    # Returns {spectrum index: (n_peaks, new_x, new_y, FitResult)}.
+    groups = {}
+    for index, (_, x, y) in enumerate(spectra):
+        resonances = detect_resonances(x, y, max_peaks, min_prominence)
+        if not resonances:
+            continue
+        lo, _ = window_bounds(x, resonances[0][0], delta_x)
+        _, hi = window_bounds(x, resonances[-1][0], delta_x)
+        groups.setdefault(len(resonances), []).append((index, x[lo:hi], y[lo:hi], resonances))
+
+    fits = {}
+    for n_peaks, members in groups.items():
+        lineshape = multi_peak_lineshape(n_peaks, base_name)
+        guesses = [initial_guess(lineshape, resonances, base_name) for _, _, _, resonances in members]
+        results = backend.fit_many(lineshape, [m[1] for m in members], [m[2] for m in members],
+                                   [g[0] for g in guesses], [g[1] for g in guesses])
+        for (index, new_x, new_y, _), result in zip(members, results):
+            fits[index] = (n_peaks, new_x, new_y, result)
+    return fits
+
+
+def track_modes(frequencies, peak_fields, max_jump):
+    # Assign the resonance fields of consecutive frequencies to branches (modes).
+    # Each branch predicts its next field by linear extrapolation of its last two points (branches
+    # with a single point use the mean slope of the others) and peaks are matched to predictions by
+    # minimum total squared distance; matches further than max_jump (Oe) start a new branch.
+    # Returns one list of branch labels per frequency.
+    branches = []  # lists of (frequency, H_res)
+    labels = []
+    for frequency, fields in zip(frequencies, peak_fields):
+        fields = np.asarray(fields, dtype=float)
+        slopes = [(b[-1][1] - b[-2][1]) / (b[-1][0] - b[-2][0]) for b in branches
+                  if len(b) > 1 and b[-1][0] != b[-2][0]]
+        mean_slope = np.mean(slopes) if slopes else 0.0
+        predictions = []
+        for branch in branches:
+            f1, h1 = branch[-1]
+            if len(branch) > 1 and branch[-2][0] != f1:
+                f0, h0 = branch[-2]
+                predictions.append(h1 + (h1 - h0) / (f1 - f0) * (frequency - f1))
+            else:
+                predictions.append(h1 + mean_slope * (frequency - f1))
+
+        frequency_labels = [None] * len(fields)
+        if predictions and len(fields):
+            distance = np.abs(fields[:, None] - np.asarray(predictions)[None, :])
+            for peak, branch_index in zip(*linear_sum_assignment(distance ** 2)):
+                if distance[peak, branch_index] <= max_jump:
+                    frequency_labels[peak] = int(branch_index)
+        for peak, field in enumerate(fields):
+            if frequency_labels[peak] is None:
+                branches.append([])
+                frequency_labels[peak] = len(branches) - 1
+            branches[frequency_labels[peak]].append((frequency, field))
+        labels.append(frequency_labels)
+    return labels
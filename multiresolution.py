@@ -0,0 +1,62 @@
+#-------------------------------------------------
+# Author:      Suraj Joshi
+# Created:     21-08-2024
+# Copyright:   (c) Suraj Joshi 2024
+#--------------------------------------------------
+# Coarse-to-fine fitting of densely sampled spectra. The fixed delta_x window is first averaged down to
+# at most max_points points and fitted; the full-resolution fit then starts from that solution on a
+# window of +/- n_linewidths linewidths around the coarse H_res, so both the number of iterations on
+# the dense data and the window width follow the resonance itself.
+import numpy as np
+from fit_window import window_bounds
+
+# Full width at half maximum of each lineshape from its parameters
+LINEWIDTHS = {
+    "derivative_lorentzian": lambda params: params["LW"],
+    "skew_derivative_lorentzian": lambda params: params["LW"],
+    "S21": lambda params: 2 * abs(params["sigma"]),
+    "mixed_derivative_lorentzian": lambda params: params["LW"],
+    "mixed_skew_derivative_lorentzian": lambda params: params["LW"],
+    "mixed_S21": lambda params: 2 * abs(params["sigma"]),
+}
+
+
+def average_blocks(x, y, max_points=200):
+    # Mean of consecutive blocks of points, so that at most max_points remain (the last block may be shorter)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    factor = int(np.ceil(x.size / max_points)) if max_points else 1
+    if factor <= 1:
+        return x, y
+    edges = np.arange(0, x.size, factor)
+    counts = np.diff(np.append(edges, x.size))
+    return np.add.reduceat(x, edges) / counts, np.add.reduceat(y, edges) / counts
+
+
+def fit_coarse_to_fine(backend, lineshape, spectra, windows, initial, bounds=None, max_points=200, n_linewidths=5):
+    # spectra: (x, y) of every full spectrum sorted by field, windows: its (new_x, new_y) delta_x window.
+    # Returns the fine windows and their FitResults; nfev and wall time include the coarse pass.
+    coarse = [average_blocks(new_x, new_y, max_points) for new_x, new_y in windows]
+    coarse_results = backend.fit_many(lineshape, [c[0] for c in coarse], [c[1] for c in coarse], initial, bounds)
+
+    linewidth = LINEWIDTHS[lineshape.name]
+    fine_windows, fine_initials = [], []
+    initials = initial if isinstance(initial, (list, tuple)) else [initial] * len(windows)
+    for (x, y), window, spectrum_initial, result in zip(spectra, windows, initials, coarse_results):
+        width = linewidth(result.params) if result.best_fit is not None else np.nan
+        if np.isfinite(width) and width > 0 and np.isfinite(result.params["H_res"]):
+            lo, hi = window_bounds(x, result.params["H_res"], n_linewidths * width)
+            if hi - lo > len(lineshape.param_names) + 1:
+                fine_windows.append((x[lo:hi], y[lo:hi]))
+                fine_initials.append(dict(result.params))
+                continue
+        # Failed or degenerate coarse fit: the full-resolution fit starts from scratch on the delta_x window
+        fine_windows.append(window)
+        fine_initials.append(spectrum_initial)
+
+    results = backend.fit_many(lineshape, [w[0] for w in fine_windows], [w[1] for w in fine_windows],
+                               fine_initials, bounds)
+    for result, coarse_result in zip(results, coarse_results):
+        result.nfev += coarse_result.nfev
+        result.wall_time += coarse_result.wall_time
+    return fine_windows, results
@@ -0,0 +1,127 @@
+#-------------------------------------------------
+# Author:      Suraj Joshi
+# Created:     21-08-2024
+# Copyright:   (c) Suraj Joshi 2024
+#--------------------------------------------------
+# Grid search over the fit window (delta_x) and the initial guesses of the derivative Lorentzian fit.
+# The dS21/dH spectra are parsed once and shared by all configurations, configurations are fitted in
+# parallel worker processes, and every configuration is scored by its yield (fits passing R2), mean
+# residual and the quality of the Kittel fit through the passing resonance fields.
+import os
+import itertools
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+from sklearn.metrics import r2_score
+
+from fit_window import sort_by_field, window_around_peak
+from sweep_catalog import SweepCatalog
+from fit_backends import get_backend
+from lineshapes import LINESHAPES
+
+_SPECTRA_CACHE = {}
+_worker_spectra = None
+
+
+def load_spectra(directory):
+    # Parse every dS21/dH CSV of the directory once; repeated calls with unchanged files reuse the arrays
+    catalog = SweepCatalog.load(directory, "*.csv")
+    csv_files_sorted = catalog.names()
+    key = (os.path.abspath(directory), tuple((file, catalog.entries[file]["mtime"]) for file in csv_files_sorted))
+
+    if key not in _SPECTRA_CACHE:
+        spectra = []
+        for csv_file in csv_files_sorted:
+            df = pd.read_csv(os.path.join(directory, csv_file))
+            x, y = sort_by_field(df['Magnetic Field'].to_numpy(), df['dS21/dH'].to_numpy())
+            spectra.append((float(os.path.splitext(csv_file)[0]), x, y))
+        _SPECTRA_CACHE.clear()
+        _SPECTRA_CACHE[key] = spectra
+    return _SPECTRA_CACHE[key]
+
+
+def fit_configuration(spectra, delta_x, A, LW, H_res, backend_name="lmfit"):
+    # Fit all spectra with one window/initial-guess setting, as fit_lorentzian does
+    lineshape = LINESHAPES["derivative_lorentzian"]
+    windows = [window_around_peak(x, y, delta_x, peak="max") for _, x, y in spectra]
+    results = get_backend(backend_name).fit_many(lineshape, [w[0] for w in windows], [w[1] for w in windows],
+                                                 dict(A=A, LW=LW, H_res=H_res), bounds={"LW": (0, None)})
+
+    n_spectra = len(spectra)
+    r2 = np.full(n_spectra, -np.inf)
+    residual = np.full(n_spectra, np.nan)
+    H_res_fit = np.full(n_spectra, np.nan)
+    for i, ((new_x, new_y), result) in enumerate(zip(windows, results)):
+        if result.best_fit is None or len(new_y) < 2:
+            continue
+        r2[i] = r2_score(new_y, result.best_fit)
+        residual[i] = np.sqrt(np.mean((new_y - result.best_fit) ** 2))
+        H_res_fit[i] = result.params["H_res"]
+    frequencies = np.array([frequency for frequency, _, _ in spectra])
+    return frequencies, r2, residual, H_res_fit
+
+
+def kittel_quality(frequencies, H_res_fit, backend_name="lmfit"):
+    # R2, M_eff and gamma of the Kittel fit through (H_res, f), with the Kittel GUI's initial guesses
+    if len(frequencies) < 4:
+        return np.nan, np.nan, np.nan
+    x_T = 1e-4 * H_res_fit
+    y = frequencies * 1e-9
+    with np.errstate(invalid="ignore"):
+        result = get_backend(backend_name).fit_many(LINESHAPES["f_kittel"], [x_T], [y],
+                                                    dict(M_eff=1, H_k=0.01, gamma=29))[0]
+    if result.best_fit is None or not np.all(np.isfinite(result.best_fit)):
+        return np.nan, np.nan, np.nan
+    return r2_score(y, result.best_fit), result.params["M_eff"], result.params["gamma"]
+
+
+def score_configuration(frequencies, r2, residual, H_res_fit, r2_threshold, backend_name="lmfit"):
+    passing = r2 > r2_threshold
+    kittel_r2, M_eff, gamma = kittel_quality(frequencies[passing], H_res_fit[passing], backend_name)
+    return {
+        "R2 threshold": r2_threshold,
+        "Passing fits": int(passing.sum()),
+        "Yield": passing.mean() if len(passing) else np.nan,
+        "Mean residual": residual[passing].mean() if passing.any() else np.nan,
+        "Kittel R2": kittel_r2,
+        "Kittel M_eff (T)": M_eff,
+        "Kittel gamma (GHz/T)": gamma,
+    }
+
+
+def _init_worker(spectra):
+    global _worker_spectra
+    _worker_spectra = spectra
+
+
+def _sweep_task(fit_setting, r2_thresholds, backend_name):
+    delta_x, A, LW, H_res = fit_setting
+    fit_output = fit_configuration(_worker_spectra, delta_x, A, LW, H_res, backend_name)
+    rows = []
+    # The R2 threshold only filters the fits, so every threshold reuses the same fits
+    for r2_threshold in r2_thresholds:
+        row = {"delta_x": delta_x, "A": A, "LW": LW, "H_res": H_res}
+        row.update(score_configuration(*fit_output, r2_threshold, backend_name))
+        rows.append(row)
+    return rows
+
+
+def run_sweep(directory, delta_x_values, A_values, LW_values, H_res_values, r2_thresholds,
+              backend_name="lmfit", max_workers=None, progress_callback=None):
+    spectra = load_spectra(directory)
+    fit_settings = list(itertools.product(delta_x_values, A_values, LW_values, H_res_values))
+
+    rows = []
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(spectra,)) as executor:
+        futures = [executor.submit(_sweep_task, fit_setting, r2_thresholds, backend_name)
+                   for fit_setting in fit_settings]
+        for done, future in enumerate(as_completed(futures), start=1):
+            rows.extend(future.result())
+            if progress_callback is not None:
+                progress_callback(done, len(fit_settings))
+
+    # Configurations are ranked within each R2 threshold (a lower threshold only ever raises the
+    # yield), strictest threshold first
+    sweep_df = pd.DataFrame(rows)
+    return sweep_df.sort_values(["R2 threshold", "Yield", "Mean residual"], ascending=[False, False, True],
+                                ignore_index=True)
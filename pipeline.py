@@ -0,0 +1,362 @@
+#-------------------------------------------------
+# Author:      Suraj Joshi
+# Created:     21-08-2024
+# Copyright:   (c) Suraj Joshi 2024
+#--------------------------------------------------
+# Dependency graph of the processing steps, so the launcher can produce every output of a sample
+# directory with one click. The absorption branch (background removal -> Lorentzian absorption fit)
+# and the derivative branch (conversion -> derivative -> fits) are independent until the magnetic
+# property stages, so ready stages run at the same time, up to max_workers of them.
+# Every stage calls the compute method of its step script in a separate Python process, which keeps
+# the pyplot state of the steps apart and lets the stages use all cores; its output goes to
+# "pipeline logs/<stage>.log" in the sample directory.
+# A stage is up to date, and skipped, when its outputs exist, it last finished with the same
+# settings and none of its input files changed since; that record is pipeline_state.json.
+# The settings are the defaults of the step windows, overridden per stage by pipeline_settings.json
+# in the sample directory, e.g. {"lorentzian_fit": {"H_res": 500, "backend": "batch_lm"}}.
+#
+# fit_service.py runs the same stages in warm worker processes shared by several users.
+#
+# Command line:
+#   python pipeline.py DIRECTORY [--jobs 2] [--force] [--stages kittel linewidth]
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import subprocess
+import importlib.util
+from tkinter import messagebox
+
+SCRIPT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+STATE_FILE = "pipeline_state.json"
+SETTINGS_FILE = "pipeline_settings.json"
+LOG_FOLDER = "pipeline logs"
+
+# Folders of the stages inside a sample directory
+ABSORPTION = "background removal"
+FIELD_DOMAIN = "field domain data"
+DS21 = os.path.join(FIELD_DOMAIN, "ds21")
+PLOTS = os.path.join(DS21, "plots")
+
+
+class Stage:
+    # run(step, directory, settings) calls the compute method on a HeadlessStep of step_class;
+    # inputs and outputs are glob patterns relative to the sample directory
+    def __init__(self, name, label, script, step_class, run, inputs, outputs, depends=(), settings=None):
+        self.name = name
+        self.label = label
+        self.script = script
+        self.step_class = step_class
+        self.run = run
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.depends = list(depends)
+        self.settings = dict(settings or {})
+
+
+STAGES = [
+    Stage("background", "Background Removal", "Background removal.py", "DataProcessorGUI",
+          lambda step, d, s: step.process_files(d, s["step_size"], s["background_model"], s["drift_order"]),
+          inputs=["*.txt"], outputs=[os.path.join(ABSORPTION, "*.csv")],
+          settings=dict(step_size=1000000000, background_model="median", drift_order=1)),
+    Stage("absorption_fit", "Lorentzian Absorption Fit", "Lorentzian Absorption fit.py", "LorentzianFitGUI",
+          lambda step, d, s: step.perform_fit(os.path.join(d, ABSORPTION), [s["A"], s["sigma"], s["H_res"]],
+                                              s["backend"], s["screen_policy"], s["coarse_to_fine"], s["dispersive"]),
+          inputs=[os.path.join(ABSORPTION, "*.csv")],
+          outputs=[os.path.join(ABSORPTION, "plots", "field domain parameters.csv")], depends=["background"],
+          settings=dict(A=-20.0, sigma=20.0, H_res=200.0, backend="lmfit", screen_policy="lenient",
+                        coarse_to_fine=False, dispersive=False)),
+    Stage("conversion", "Conversion of Frequency to Field Domain", "conversion of freq to field domain.py",
+          "FMRConversionApp",
+          lambda step, d, s: step.convert_freq_to_field(d, d, s["step_size"], s["method"], s["field_step"]),
+          inputs=["*.txt"], outputs=[os.path.join(FIELD_DOMAIN, "*.csv")],
+          settings=dict(step_size=1e9, method=None, field_step=None)),
+    Stage("derivative", "Derivative of Field Domain", "conversion to field domain to ds21 data.py",
+          "DerivativeCalculationApp",
+          lambda step, d, s: step.calculate_derivative(os.path.join(d, FIELD_DOMAIN), os.path.join(d, FIELD_DOMAIN)),
+          inputs=[os.path.join(FIELD_DOMAIN, "*.csv")], outputs=[os.path.join(DS21, "*.csv")],
+          depends=["conversion"]),
+    Stage("lorentzian_fit", "Lorentzian Fitting of dS data", "Curve Fitting field domain ds21 data.py",
+          "LorentzianFittingApp",
+          lambda step, d, s: step.fit_lorentzian(os.path.join(d, DS21), os.path.join(d, DS21), s["delta_x"], s["A"],
+                                                 s["LW"], s["H_res"], s["R2_threshold"], s["backend"],
+                                                 s["save_plots"], s["use_cache"], s["screen_policy"],
+                                                 s["coarse_to_fine"], s["dispersive"]),
+          inputs=[os.path.join(DS21, "*.csv")], outputs=[os.path.join(PLOTS, "field domain parameters.csv")],
+          depends=["derivative"],
+          settings=dict(delta_x=150.0, A=-15.0, LW=40.0, H_res=100.0, R2_threshold=0.9, backend="lmfit",
+                        save_plots=True, use_cache=True, screen_policy="lenient", coarse_to_fine=False,
+                        dispersive=False)),
+    Stage("skew_fit", "Skew Lorentzian Fitting of dS data",
+          "Curve Fitting field domain ds21 data to skew lorentzian function.py", "LorentzianFittingApp",
+          lambda step, d, s: step.fit_skew_lorentzian(os.path.join(d, DS21), os.path.join(d, DS21), s["delta_x"],
+                                                      s["A"], s["LW"], s["alpha"], s["R2_threshold"], s["backend"],
+                                                      s["save_plots"], s["use_cache"], s["screen_policy"],
+                                                      s["dispersive"]),
+          inputs=[os.path.join(DS21, "*.csv")],
+          outputs=[os.path.join(DS21, "Skew Lorentzian Fits", "field domain parameters.csv")],
+          depends=["derivative"],
+          settings=dict(delta_x=200.0, A=-1.0, LW=40.0, alpha=0.02, R2_threshold=0.9, backend="lmfit",
+                        save_plots=True, use_cache=True, screen_policy="lenient", dispersive=False)),
+    Stage("kittel", "Kittel Fit", "Kittel fit from field domain data.py", "KittelFittingApp",
+          lambda step, d, s: step.fit_kittel(os.path.join(d, PLOTS), os.path.join(d, PLOTS), s["M_eff"], s["H_k"],
+                                             s["gamma"], s["backend"]),
+          inputs=[os.path.join(PLOTS, "field domain parameters.csv")],
+          outputs=[os.path.join(PLOTS, "material parameter.csv"), os.path.join(PLOTS, "Kittel_fit.png")],
+          depends=["lorentzian_fit"], settings=dict(M_eff=1.0, H_k=0.01, gamma=29.0, backend="lmfit")),
+    Stage("linewidth", "Linewidth Fitting", "Linewidth Fit.py", "LinewidthFittingApp",
+          lambda step, d, s: step.fit_linewidth(os.path.join(d, PLOTS), os.path.join(d, PLOTS), s["material"],
+                                                s["alpha"], s["DH0"]),
+          inputs=[os.path.join(PLOTS, "field domain parameters.csv"), os.path.join(PLOTS, "material parameter.csv")],
+          outputs=[os.path.join(PLOTS, "linewidth_fit.png")], depends=["kittel"],
+          settings=dict(material="FeGaB", alpha=0.003, DH0=0.0022)),
+    Stage("g_factor", "Asymptotic Analysis of g factor", "Asymptotic Analysis of g factor.py", "KittelFittingApp",
+          lambda step, d, s: step.perform_fitting(os.path.join(d, PLOTS, "field domain parameters.csv"),
+                                                  os.path.join(d, PLOTS), s["segment_size"], s["M_eff"], s["H_k"],
+                                                  s["gamma"], s["backend"]),
+          inputs=[os.path.join(PLOTS, "field domain parameters.csv")],
+          outputs=[os.path.join(PLOTS, "Kittel_fit_asymptotic.png")], depends=["lorentzian_fit"],
+          settings=dict(segment_size=4, M_eff=1.0, H_k=0.0017, gamma=29.0, backend="lmfit")),
+]
+STAGE_MAP = {stage.name: stage for stage in STAGES}
+
+
+class HeadlessProgress(dict):
+    # Takes the progress bar, DoubleVar and update_idletasks calls of the compute methods
+    def set(self, value):
+        self["value"] = value
+
+    def update_idletasks(self):
+        pass
+
+
+class HeadlessStep:
+    # Stand-in for the window of a step: the compute methods only report through self.progress and
+    # self.master, every other attribute is a method of the step class bound to this object
+    def __init__(self, step_class, progress=None):
+        self.step_class = step_class
+        self.progress = HeadlessProgress() if progress is None else progress
+        self.master = self.progress
+
+    def __getattr__(self, name):
+        return getattr(self.step_class, name).__get__(self)
+
+
+_scripts = {}
+
+
+def load_script(script):
+    # Step scripts have spaces in their names, so they are loaded from their path; a long-running
+    # process keeps the module until the script file changes
+    path = os.path.join(SCRIPT_DIRECTORY, script)
+    modified = os.path.getmtime(path)
+    if script not in _scripts or _scripts[script][0] != modified:
+        spec = importlib.util.spec_from_file_location(os.path.splitext(script)[0].replace(" ", "_"), path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _scripts[script] = (modified, module)
+    return _scripts[script][1]
+
+
+def stage_files(directory, patterns):
+    return [path for pattern in patterns for path in glob.glob(os.path.join(glob.escape(directory), pattern))]
+
+
+def read_json(path):
+    try:
+        with open(path) as json_file:
+            return json.load(json_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_json(path, values):
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, "w") as json_file:
+        json.dump(values, json_file, indent=1)
+    os.replace(temporary_path, path)
+
+
+def stage_settings(directory):
+    # Defaults of every stage updated with the pipeline_settings.json of the sample directory
+    overrides = read_json(os.path.join(directory, SETTINGS_FILE))
+    return {stage.name: dict(stage.settings, **overrides.get(stage.name, {})) for stage in STAGES}
+
+
+def is_up_to_date(stage, directory, settings, record):
+    if not record or record.get("settings") != settings:
+        return False
+    if not all(stage_files(directory, [pattern]) for pattern in stage.outputs):
+        return False
+    inputs = stage_files(directory, stage.inputs)
+    return bool(inputs) and max(os.path.getmtime(path) for path in inputs) <= record["finished"]
+
+
+def _log_dialog(title, message, **options):
+    print(f"{title}: {message}")
+
+
+def run_stage(name, directory, settings, progress=None):
+    # Body of a stage process; progress takes the progress bar calls (HeadlessProgress by default)
+    stage = STAGE_MAP[name]
+    # Dialogs of the steps go to the stage log instead of waiting for a click
+    messagebox.showinfo = messagebox.showwarning = messagebox.showerror = _log_dialog
+    module = load_script(stage.script)
+    stage.run(HeadlessStep(getattr(module, stage.step_class), progress), directory, settings)
+    missing = [pattern for pattern in stage.outputs if not stage_files(directory, [pattern])]
+    if missing:
+        raise RuntimeError(f"{stage.label} wrote no {', '.join(missing)}")
+
+
+class PipelineRun:
+    # Non-blocking scheduler: poll() collects finished stages and starts the ready ones, so the
+    # launcher drives it from Tk's after() loop and run() from a plain loop.
+    # status of a stage: waiting, running, done, up to date, failed or blocked (a dependency failed)
+    def __init__(self, directory, stage_names=None, max_workers=None, force=False):
+        self.directory = os.path.abspath(directory)
+        self.stages = [stage for stage in STAGES if stage_names is None or stage.name in stage_names]
+        self.max_workers = max(1, max_workers or os.cpu_count() or 1)
+        self.force = force
+        self.settings = stage_settings(self.directory)
+        self.state = read_json(os.path.join(self.directory, STATE_FILE))
+        self.status = {stage.name: "waiting" for stage in self.stages}
+        self.times = {}
+        self.progress = {}  # percent done of the running stages that report it
+        self.running = {}
+        self.start = time.perf_counter()
+        self.wall_time = None
+
+    def critical_path(self, stage, memo=None):
+        # Last duration of the stage plus the longest chain of stages waiting on it, so the longest
+        # branch is started first when there are more ready stages than workers
+        memo = {} if memo is None else memo
+        if stage.name not in memo:
+            children = [child for child in self.stages if stage.name in child.depends]
+            memo[stage.name] = self.state.get(stage.name, {}).get("duration", 1.0) + \
+                max((self.critical_path(child, memo) for child in children), default=0.0)
+        return memo[stage.name]
+
+    def finish(self, name, succeeded, duration):
+        self.times[name] = duration
+        if succeeded:
+            self.status[name] = "done"
+            self.state[name] = dict(settings=self.settings[name], finished=time.time(), duration=duration)
+            write_json(os.path.join(self.directory, STATE_FILE), self.state)
+        else:
+            self.status[name] = "failed"
+
+    def collect(self):
+        for name, (process, log_file, start) in list(self.running.items()):
+            if process.poll() is None:
+                continue
+            log_file.close()
+            del self.running[name]
+            self.finish(name, process.returncode == 0, time.perf_counter() - start)
+
+    def launch(self, stage):
+        os.makedirs(os.path.join(self.directory, LOG_FOLDER), exist_ok=True)
+        log_file = open(os.path.join(self.directory, LOG_FOLDER, f"{stage.name}.log"), "w")
+        command = [sys.executable, os.path.join(SCRIPT_DIRECTORY, "pipeline.py"), "--run-stage", stage.name,
+                   self.directory, json.dumps(self.settings[stage.name])]
+        process = subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT, cwd=SCRIPT_DIRECTORY,
+                                   env=dict(os.environ, MPLBACKEND="Agg"))
+        self.running[stage.name] = (process, log_file, time.perf_counter())
+        self.status[stage.name] = "running"
+
+    def ready(self):
+        # Marks the blocked and up-to-date stages and returns the ones that can start, longest
+        # branch first
+        ready = []
+        for stage in self.stages:
+            if self.status[stage.name] != "waiting":
+                continue
+            dependencies = [self.status[name] for name in stage.depends if name in self.status]
+            if any(status in ("failed", "blocked") for status in dependencies):
+                self.status[stage.name] = "blocked"
+            elif all(status in ("done", "up to date") for status in dependencies):
+                if not self.force and is_up_to_date(stage, self.directory, self.settings[stage.name],
+                                                    self.state.get(stage.name)):
+                    self.status[stage.name] = "up to date"
+                else:
+                    ready.append(stage)
+        memo = {}
+        ready.sort(key=lambda stage: self.critical_path(stage, memo), reverse=True)
+        return ready
+
+    def finished(self):
+        if self.running or "waiting" in self.status.values():
+            return False
+        if self.wall_time is None:
+            self.wall_time = time.perf_counter() - self.start
+        return True
+
+    def poll(self):
+        # Returns True while stages are running or waiting
+        self.collect()
+        for stage in self.ready()[:self.max_workers - len(self.running)]:
+            self.launch(stage)
+        return not self.finished()
+
+    def elapsed(self, name):
+        # Duration of a finished stage, time so far of a running one, None before it starts
+        if name in self.times:
+            return self.times[name]
+        if name in self.running:
+            return time.perf_counter() - self.running[name][-1]
+        return None
+
+    def run(self, interval=0.1, report=print):
+        status = {}
+        while self.poll():
+            if status != self.status:
+                status = dict(self.status)
+                report(self.summary())
+            time.sleep(interval)
+        report(self.summary())
+        return self.status
+
+    def cancel(self):
+        for name, (process, log_file, _) in list(self.running.items()):
+            process.terminate()
+            process.wait()
+            log_file.close()
+            self.status[name] = "failed"
+        self.running.clear()
+
+    def summary(self):
+        counts = {}
+        for status in self.status.values():
+            counts[status] = counts.get(status, 0) + 1
+        text = ", ".join(f"{count} {status}" for status, count in counts.items())
+        if self.wall_time is not None:
+            text += f" in {self.wall_time:.1f} s"
+        return f"Pipeline: {text}"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the FMR processing pipeline of a sample directory.")
+    parser.add_argument("directory", nargs="?")
+    parser.add_argument("--jobs", type=int, default=None, help="stages run at the same time (default: CPU count)")
+    parser.add_argument("--force", action="store_true", help="also run the up-to-date stages")
+    parser.add_argument("--stages", nargs="+", choices=list(STAGE_MAP), help="run only these stages")
+    parser.add_argument("--run-stage", nargs=3, metavar=("STAGE", "DIRECTORY", "SETTINGS"), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_stage:
+        name, directory, settings = args.run_stage
+        run_stage(name, directory, json.loads(settings))
+        return 0
+    if not args.directory:
+        parser.error("the sample directory is required")
+    run = PipelineRun(args.directory, args.stages, args.jobs, args.force)
+    status = run.run()
+    for stage in run.stages:
+        elapsed = f"{run.times[stage.name]:.1f} s" if stage.name in run.times else ""
+        print(f"{stage.label:45s} {status[stage.name]:12s} {elapsed}")
+    return 1 if "failed" in status.values() else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,107 @@
+#-------------------------------------------------
+# Author:      Suraj Joshi
+# Created:     21-08-2024
+# Copyright:   (c) Suraj Joshi 2024
+#--------------------------------------------------
+# Screening of the fit windows before the nonlinear fits: spectra without a visible resonance
+# (mostly at high frequencies) are skipped instead of being fitted and discarded by the R2 threshold.
+# All spectra are padded into one NaN-filled array, so every metric is one NumPy call for the sweep:
+#   SNR           signal in the window / white noise of the spectrum (MAD of the first differences)
+#   prominence    signal in the window / peak-to-peak of the spectrum outside the window
+#   zero crossing the derivative lineshape goes above and below the baseline inside the window,
+#                 and neither extreme sits on the window edge (a truncated or missing resonance)
+# The signal is the peak-to-peak value of dS21/dH, or the dip depth below the baseline for S21.
+import numpy as np
+
+SCREEN_POLICIES = {
+    "off": None,
+    "report only": dict(min_snr=5.0, min_prominence=1.5, require_zero_crossing=True, skip=False),
+    "lenient": dict(min_snr=5.0, min_prominence=1.5, require_zero_crossing=False, skip=True),
+    "strict": dict(min_snr=10.0, min_prominence=3.0, require_zero_crossing=True, skip=True),
+}
+
+
+def padded(arrays):
+    # (n_spectra, longest) float array, NaN beyond the end of each array
+    lengths = [len(array) for array in arrays]
+    values = np.full((len(arrays), max(max(lengths, default=0), 1)), np.nan)
+    for i, array in enumerate(arrays):
+        values[i, :lengths[i]] = array
+    return values
+
+
+def screen_metrics(spectra, windows, kind="derivative"):
+    # spectra: (x, y) of every full spectrum, windows: its (new_x, new_y) fit window
+    X = padded([np.asarray(x, dtype=float) for x, _ in spectra])
+    Y = padded([np.asarray(y, dtype=float) for _, y in spectra])
+    window_lengths = np.array([len(new_y) for _, new_y in windows])
+    empty = window_lengths == 0
+    W = padded([np.asarray(new_y, dtype=float) if len(new_y) else [0.0] for _, new_y in windows])
+    low = np.array([np.min(new_x) if len(new_x) else np.nan for new_x, _ in windows])
+    high = np.array([np.max(new_x) if len(new_x) else np.nan for new_x, _ in windows])
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        baseline = np.nanmedian(Y, axis=1)
+        steps = np.diff(Y, axis=1)
+        noise = 1.4826 * np.nanmedian(np.abs(steps - np.nanmedian(steps, axis=1)[:, None]), axis=1) / np.sqrt(2)
+
+        outside = np.where((X >= low[:, None]) & (X <= high[:, None]), np.nan, Y)
+        outside_spread = np.max(np.where(np.isnan(outside), -np.inf, outside), axis=1) - \
+            np.min(np.where(np.isnan(outside), np.inf, outside), axis=1)
+        outside_spread = np.where(np.isfinite(outside_spread), outside_spread, np.nan)
+
+        window_max = np.nanmax(W, axis=1)
+        window_min = np.nanmin(W, axis=1)
+        if kind == "derivative":
+            signal = window_max - window_min
+        else:
+            signal = baseline - window_min
+
+        snr = signal / noise
+        prominence = signal / outside_spread
+
+    last = np.maximum(window_lengths - 1, 0)
+    arg_max = np.nanargmax(W, axis=1)
+    arg_min = np.nanargmin(W, axis=1)
+    interior = (arg_max > 0) & (arg_max < last) & (arg_min > 0) & (arg_min < last)
+    zero_crossing = (window_max > baseline) & (window_min < baseline) & interior & ~empty
+    return dict(snr=np.where(empty, 0.0, snr), prominence=np.where(empty, 0.0, prominence),
+                zero_crossing=zero_crossing, empty=empty)
+
+
+def screen_spectra(spectra, windows, policy="lenient", kind="derivative"):
+    # Returns (fit, reasons): fit[i] is False for spectra to skip, reasons[i] says why a spectrum
+    # fails the policy ("" when it passes). With "report only" failures are reported but still fitted.
+    settings = SCREEN_POLICIES[policy]
+    n_spectra = len(spectra)
+    if settings is None or n_spectra == 0:
+        return np.ones(n_spectra, dtype=bool), [""] * n_spectra
+
+    metrics = screen_metrics(spectra, windows, kind)
+    reasons = []
+    for i in range(n_spectra):
+        failures = []
+        if metrics["empty"][i]:
+            failures.append("empty fit window")
+        else:
+            if not metrics["snr"][i] >= settings["min_snr"]:
+                failures.append(f"SNR {metrics['snr'][i]:.1f} < {settings['min_snr']:g}")
+            # A missing outside region (window covers the spectrum) gives NaN and is not held against it
+            if metrics["prominence"][i] < settings["min_prominence"]:
+                failures.append(f"prominence {metrics['prominence'][i]:.2f} < {settings['min_prominence']:g}")
+            if kind == "derivative" and settings["require_zero_crossing"] and not metrics["zero_crossing"][i]:
+                failures.append("no zero crossing inside the window")
+        reasons.append(", ".join(failures))
+
+    failed = np.array([bool(reason) for reason in reasons])
+    fit = ~failed if settings["skip"] else np.ones(n_spectra, dtype=bool)
+    return fit, reasons
+
+
+def report_screen(names, fit, reasons):
+    # Print the screened-out spectra and return a one-line summary
+    for name, fit_spectrum, reason in zip(names, fit, reasons):
+        if reason:
+            print(f"{'Skipped' if not fit_spectrum else 'Would skip'} {name}: {reason}")
+    n_failed = sum(bool(reason) for reason in reasons)
+    return f"Pre-screen: {n_failed} of {len(reasons)} spectra fail, {int(np.sum(~np.asarray(fit)))} skipped"
@@ -0,0 +1,107 @@
+#-------------------------------------------------
+# Author:      Suraj Joshi
+# Created:     21-08-2024
+# Copyright:   (c) Suraj Joshi 2024
+#--------------------------------------------------
+# Resampling of a sweep onto uniform field and frequency grids. The Gaussmeter readings of a real
+# sweep are irregular (hysteresis corrected, repeated or skipped steps) and the VNA frequency list
+# need not contain the requested frequencies exactly, while the derivative and fitting paths want
+# regular grids. The whole field x frequency array is interpolated along each axis in one call:
+# linear through neighbour indices and weights computed once for the grid, cubic through one scipy
+# CubicSpline over all columns. Grid points outside the measured range, or inside a gap wider than
+# gap_factor times the median step of the readings, are NaN.
+import numpy as np
+from scipy.interpolate import CubicSpline
+
+RESAMPLE_METHODS = ("linear", "cubic")
+
+
+def uniform_grid(values, step, start=None, stop=None):
+    # start, start + step, ... up to stop; by default the multiples of step within the range of values,
+    # so grid points are round fields and frequencies (and file names) whatever the readings were
+    if start is None:
+        start = step * np.ceil(np.min(values) / step - 1e-9) + 0.0
+    stop = float(np.max(values)) if stop is None else stop
+    return start + step * np.arange(int(np.floor((stop - start) / step + 1e-9)) + 1)
+
+
+def merge_duplicates(axis_values, values, axis=0):
+    # Sorted axis without repeated readings; the values of a repeated reading are averaged
+    axis_values = np.asarray(axis_values, dtype=float)
+    if np.any(np.diff(axis_values) < 0):
+        order = np.argsort(axis_values, kind="stable")
+        axis_values = axis_values[order]
+        values = np.take(values, order, axis=axis)
+    unique, starts, counts = np.unique(axis_values, return_index=True, return_counts=True)
+    if unique.size == axis_values.size:
+        return axis_values, values
+    shape = [1] * values.ndim
+    shape[axis] = -1
+    merged = np.add.reduceat(values, starts, axis=axis)
+    merged /= counts.reshape(shape)
+    return unique, merged
+
+
+def gap_mask(axis_values, grid, gap_factor=3.0):
+    # True at grid points outside the readings, or between two readings more than gap_factor median
+    # steps apart (grid points on a reading itself are kept)
+    outside = (grid < axis_values[0]) | (grid > axis_values[-1])
+    steps = np.diff(axis_values)
+    if gap_factor is None or steps.size == 0:
+        return outside
+    hi = np.clip(np.searchsorted(axis_values, grid, side="left"), 1, axis_values.size - 1)
+    on_reading = (axis_values[hi] == grid) | (axis_values[hi - 1] == grid)
+    return outside | ((steps[hi - 1] > gap_factor * np.median(steps)) & ~on_reading)
+
+
+def interpolate_axis(axis_values, values, grid, axis=0, method="linear", chunk=64):
+    # values (field x frequency) sampled at the sorted, distinct axis_values along axis, evaluated at
+    # grid. The cubic spline of chunk columns at a time keeps scipy's work arrays small.
+    if axis_values.size < 2:
+        raise ValueError("At least two readings are needed to resample an axis.")
+    if method == "cubic":
+        values = np.moveaxis(values, axis, 0)
+        resampled = np.empty((grid.size, values.shape[1]), dtype=np.result_type(values, float))
+        for start in range(0, values.shape[1], chunk):
+            resampled[:, start:start + chunk] = CubicSpline(axis_values, values[:, start:start + chunk])(grid)
+        return np.moveaxis(resampled, 0, axis)
+    if method != "linear":
+        raise ValueError(f"Unknown resampling method '{method}', use one of {', '.join(RESAMPLE_METHODS)}.")
+    hi = np.clip(np.searchsorted(axis_values, grid, side="right"), 1, axis_values.size - 1)
+    lo = hi - 1
+    shape = [1] * values.ndim
+    shape[axis] = -1
+    weight = ((grid - axis_values[lo]) / (axis_values[hi] - axis_values[lo])).reshape(shape)
+    lower = np.take(values, lo, axis=axis)
+    resampled = np.take(values, hi, axis=axis)
+    resampled -= lower
+    resampled *= weight
+    resampled += lower
+    return resampled
+
+
+def resample_cube(fields, freq_values, values, field_grid=None, freq_grid=None, method="linear", gap_factor=3.0):
+    # values[i, j] at (fields[i], freq_values[j]) -> (field_grid, freq_grid, resampled values), NaN in
+    # gaps; an axis whose grid is None is kept as measured
+    fields = np.asarray(fields, dtype=float)
+    freq_values = np.asarray(freq_values, dtype=float)
+    values = np.asarray(values)
+    if field_grid is not None:
+        fields, values = merge_duplicates(fields, values, axis=0)
+        field_grid = np.asarray(field_grid, dtype=float)
+        resampled = interpolate_axis(fields, values, field_grid, 0, method)
+        resampled[gap_mask(fields, field_grid, gap_factor)] = np.nan
+        fields, values = field_grid, resampled
+    if freq_grid is not None:
+        freq_values, values = merge_duplicates(freq_values, values, axis=1)
+        freq_grid = np.asarray(freq_grid, dtype=float)
+        # Field grid points in a gap are NaN rows, which a spline cannot take
+        rows = np.isfinite(values).all(axis=1)
+        if method == "linear" or rows.all():
+            resampled = interpolate_axis(freq_values, values, freq_grid, 1, method)
+        else:
+            resampled = np.full((values.shape[0], freq_grid.size), np.nan, dtype=np.result_type(values, float))
+            resampled[rows] = interpolate_axis(freq_values, values[rows], freq_grid, 1, method)
+        resampled[:, gap_mask(freq_values, freq_grid, gap_factor)] = np.nan
+        freq_values, values = freq_grid, resampled
+    return fields, freq_values, values
@@ -0,0 +1,103 @@
+#-------------------------------------------------
+# Author:      Suraj Joshi
+# Created:     21-08-2024
+# Copyright:   (c) Suraj Joshi 2024
+#--------------------------------------------------
+# Field x frequency map of a whole sweep (colour = background-removed S21 or dS21/dH) with the
+# fitted H_res(f) points and the Kittel curve on top. Large sweeps are reduced to screen resolution
+# before drawing, so the cost of rendering does not grow with the size of the sweep.
+import math
+import numpy as np
+from matplotlib.image import NonUniformImage
+from lineshapes import LINESHAPES
+
+MAP_QUANTITIES = ["background-removed S21", "dS21/dH"]
+
+
+def map_values(fields, values, quantity="background-removed S21"):
+    # values is the background-removed field x frequency array of the sweep
+    if quantity == "dS21/dH":
+        return np.gradient(values, fields, axis=0)
+    return values
+
+
+def block_centers(axis, factor):
+    # Mean coordinate of each block of factor consecutive points (the last block may be shorter)
+    n_blocks = math.ceil(axis.size / factor)
+    padded = np.pad(axis, (0, n_blocks * factor - axis.size), mode="edge")
+    return padded.reshape(n_blocks, factor).mean(axis=1)
+
+
+def block_reduce(values, field_factor, freq_factor, ufunc):
+    # ufunc (np.maximum / np.minimum) over blocks of field_factor x freq_factor points, computed as
+    # one strided pass per block offset instead of a reduction over short inner axes
+    columns = values[:, ::freq_factor].copy()
+    for offset in range(1, freq_factor):
+        part = values[:, offset::freq_factor]
+        ufunc(columns[:, :part.shape[1]], part, out=columns[:, :part.shape[1]])
+    rows = columns[::field_factor].copy()
+    for offset in range(1, field_factor):
+        part = columns[offset::field_factor]
+        ufunc(rows[:part.shape[0]], part, out=rows[:part.shape[0]])
+    return rows
+
+
+def decimate(fields, freq_values, values, max_shape=(1000, 1000)):
+    # Reduce values to at most max_shape pixels. Every block keeps its value of largest magnitude
+    # (values are centred on zero), so resonance lines narrower than a block stay visible.
+    field_factor = max(1, math.ceil(values.shape[0] / max_shape[0]))
+    freq_factor = max(1, math.ceil(values.shape[1] / max_shape[1]))
+    if field_factor == 1 and freq_factor == 1:
+        return fields, freq_values, values
+
+    high = block_reduce(values, field_factor, freq_factor, np.maximum)
+    low = block_reduce(values, field_factor, freq_factor, np.minimum)
+    reduced = np.where(np.abs(high) >= np.abs(low), high, low)
+    return block_centers(fields, field_factor), block_centers(freq_values, freq_factor), reduced
+
+
+def is_uniform(axis):
+    steps = np.diff(axis)
+    return steps.size == 0 or np.allclose(steps, steps[0], rtol=1e-3)
+
+
+def plot_resonance_map(ax, fields, freq_values, values, max_shape=(1000, 1000), cmap="RdBu_r"):
+    # Draw the map with the field (Oe) on x and the frequency (GHz) on y; returns the image
+    fields, freq_values, values = decimate(fields, freq_values, values, max_shape)
+    freq_GHz = freq_values * 1e-9
+    limit = np.nanpercentile(np.abs(values), 99.5) or 1.0
+
+    if is_uniform(fields) and is_uniform(freq_GHz):
+        half_field = (fields[1] - fields[0]) / 2 if fields.size > 1 else 0.5
+        half_freq = (freq_GHz[1] - freq_GHz[0]) / 2 if freq_GHz.size > 1 else 0.5
+        image = ax.imshow(values.T, origin="lower", aspect="auto", cmap=cmap, vmin=-limit, vmax=limit,
+                          interpolation="nearest",
+                          extent=[fields[0] - half_field, fields[-1] + half_field,
+                                  freq_GHz[0] - half_freq, freq_GHz[-1] + half_freq])
+    else:
+        image = NonUniformImage(ax, interpolation="nearest", cmap=cmap)
+        image.set_data(fields, freq_GHz, values.T)
+        image.set_clim(-limit, limit)
+        ax.add_image(image)
+        ax.set_xlim(fields[0], fields[-1])
+        ax.set_ylim(freq_GHz.min(), freq_GHz.max())
+
+    ax.set_xlabel("Magnetic Field (Oe)")
+    ax.set_ylabel("Frequency (GHz)")
+    return image
+
+
+def overlay_resonances(ax, H_res, frequencies, kittel_params=None):
+    # Fitted H_res (Oe) at each frequency (Hz), and the Kittel curve for
+    # kittel_params = dict(M_eff=..., H_k=..., gamma=...) over the field range of the plot
+    limits = ax.get_xlim(), ax.get_ylim()
+    ax.plot(H_res, np.asarray(frequencies) * 1e-9, "k.", markersize=4, label="Fitted H_res")
+    if kittel_params is not None:
+        field_min, field_max = ax.get_xlim()
+        x_fit = np.linspace(max(field_min, 0), field_max, 1000)
+        with np.errstate(invalid="ignore"):
+            y_fit = LINESHAPES["f_kittel"](1e-4 * x_fit, **kittel_params)
+        ax.plot(x_fit, y_fit, "k-", linewidth=1, label="Kittel fit")
+    ax.set_xlim(limits[0])
+    ax.set_ylim(limits[1])
+    ax.legend(loc="upper left")
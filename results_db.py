@@ -0,0 +1,220 @@
+#-------------------------------------------------
+# Author:      Suraj Joshi
+# Created:     21-08-2024
+# Copyright:   (c) Suraj Joshi 2024
+#--------------------------------------------------
+# Local SQLite database of all fit results, next to the CSV files the steps still write.
+# Every run of a fitting step is one row of runs (sample, step, directory, run parameters, timings);
+# the per-frequency lineshape parameters and the material parameters (Kittel, linewidth, g factor)
+# of the run are stored in long format and indexed by name, sample, frequency and run, so e.g. the
+# latest alpha of every sample against its thickness is a single indexed query.
+#
+# Command line:
+#   python results_db.py runs [--sample NAME]
+#   python results_db.py material alpha [--step "Linewidth Fit"] [--all-runs]
+#   python results_db.py spectra H_res [--sample NAME] [--step "Lorentzian Fitting"]
+#   python results_db.py sample NAME --thickness 10 [--notes "..."]
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+from contextlib import closing
+import pandas as pd
+
+DATABASE_PATH = os.environ.get("FMR_RESULTS_DB", os.path.join(os.path.expanduser("~"), "fmr_results.sqlite"))
+
+# Folders the steps create inside a sample directory; the sample is named after the folder above them
+OUTPUT_FOLDERS = {"plots", "ds21", "Skew Lorentzian Fits", "Multi Resonance Fits", "field domain data",
+                  "background removal"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL,
+    thickness REAL,
+    notes TEXT
+);
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    sample_id INTEGER NOT NULL REFERENCES samples(id),
+    step TEXT NOT NULL,
+    directory TEXT,
+    created REAL NOT NULL,
+    backend TEXT,
+    wall_time REAL,
+    fit_time REAL,
+    parameters TEXT
+);
+CREATE TABLE IF NOT EXISTS spectrum_params (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    frequency REAL NOT NULL,
+    name TEXT NOT NULL,
+    value REAL
+);
+CREATE TABLE IF NOT EXISTS material_params (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    name TEXT NOT NULL,
+    value REAL,
+    text_value TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_sample ON runs(sample_id, step);
+CREATE INDEX IF NOT EXISTS runs_step ON runs(step);
+CREATE INDEX IF NOT EXISTS spectrum_params_run ON spectrum_params(run_id, frequency);
+CREATE INDEX IF NOT EXISTS spectrum_params_name ON spectrum_params(name, run_id);
+CREATE INDEX IF NOT EXISTS material_params_name ON material_params(name, run_id);
+"""
+
+
+def connect(path=None):
+    connection = sqlite3.connect(path or DATABASE_PATH)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def sample_from_directory(directory):
+    # "D:/data/FeGaB 10nm/ds21/plots" -> "FeGaB 10nm"
+    directory = os.path.abspath(directory)
+    while os.path.basename(directory) in OUTPUT_FOLDERS:
+        directory = os.path.dirname(directory)
+    return os.path.basename(directory) or directory
+
+
+def sample_id(connection, name):
+    connection.execute("INSERT OR IGNORE INTO samples (name) VALUES (?)", (name,))
+    return connection.execute("SELECT id FROM samples WHERE name = ?", (name,)).fetchone()[0]
+
+
+def set_sample(name, thickness=None, notes=None, path=None):
+    with closing(connect(path)) as connection, connection:
+        sample = sample_id(connection, name)
+        if thickness is not None:
+            connection.execute("UPDATE samples SET thickness = ? WHERE id = ?", (thickness, sample))
+        if notes is not None:
+            connection.execute("UPDATE samples SET notes = ? WHERE id = ?", (notes, sample))
+
+
+def save_results(step, directory, parameters=None, fitted_params_df=None, material_params=None, backend=None,
+                 wall_time=None, fit_time=None, sample=None, path=None):
+    # Store one run of a step; returns the run id, or None when the database cannot be written
+    # (the CSV files remain the primary output, so a locked or read-only database is only reported)
+    sample = sample or sample_from_directory(directory)
+    try:
+        with closing(connect(path)) as connection, connection:
+            cursor = connection.execute(
+                "INSERT INTO runs (sample_id, step, directory, created, backend, wall_time, fit_time, parameters) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (sample_id(connection, sample), step, os.path.abspath(directory), time.time(), backend, wall_time,
+                 fit_time, json.dumps(parameters or {}, default=str)))
+            run_id = cursor.lastrowid
+
+            if fitted_params_df is not None and len(fitted_params_df):
+                frequencies = fitted_params_df["Frequency (Hz)"].astype(float).to_numpy()
+                rows = []
+                for column in fitted_params_df.columns:
+                    if column == "Frequency (Hz)":
+                        continue
+                    values = pd.to_numeric(fitted_params_df[column], errors="coerce").to_numpy(dtype=float)
+                    rows.extend((run_id, frequency, column, value) for frequency, value in zip(frequencies, values))
+                connection.executemany("INSERT INTO spectrum_params VALUES (?, ?, ?, ?)", rows)
+
+            for name, value in (material_params or {}).items():
+                if isinstance(value, str):
+                    connection.execute("INSERT INTO material_params VALUES (?, ?, NULL, ?)", (run_id, name, value))
+                else:
+                    connection.execute("INSERT INTO material_params VALUES (?, ?, ?, NULL)",
+                                       (run_id, name, float(value)))
+        return run_id
+    except sqlite3.Error as e:
+        print(f"Results were not stored in the database {path or DATABASE_PATH}: {e}")
+        return None
+
+
+def query_material(name, step=None, all_runs=False, path=None):
+    # Material parameter name of every sample (its latest run unless all_runs), with the sample thickness
+    query = ("SELECT s.name AS sample, s.thickness, m.value, m.text_value, r.step, r.id AS run, r.created "
+             "FROM material_params m JOIN runs r ON m.run_id = r.id JOIN samples s ON r.sample_id = s.id "
+             "WHERE m.name = ?")
+    arguments = [name]
+    if step is not None:
+        query += " AND r.step = ?"
+        arguments.append(step)
+    if not all_runs:
+        query += (" AND r.id = (SELECT MAX(m2.run_id) FROM material_params m2 JOIN runs r2 ON m2.run_id = r2.id "
+                  "WHERE m2.name = m.name AND r2.sample_id = r.sample_id" + (" AND r2.step = r.step)" if step else ")"))
+    query += " ORDER BY s.thickness, s.name, r.id"
+    with closing(connect(path)) as connection:
+        values = pd.read_sql_query(query, connection, params=arguments)
+    values["created"] = pd.to_datetime(values["created"], unit="s")
+    return values
+
+
+def query_spectra(name, sample=None, step=None, path=None):
+    # Per-frequency lineshape parameter name (e.g. H_res, LW) of every matching run
+    query = ("SELECT s.name AS sample, r.step, r.id AS run, p.frequency, p.value "
+             "FROM spectrum_params p JOIN runs r ON p.run_id = r.id JOIN samples s ON r.sample_id = s.id "
+             "WHERE p.name = ?")
+    arguments = [name]
+    if sample is not None:
+        query += " AND s.name = ?"
+        arguments.append(sample)
+    if step is not None:
+        query += " AND r.step = ?"
+        arguments.append(step)
+    query += " ORDER BY s.name, r.id, p.frequency"
+    with closing(connect(path)) as connection:
+        return pd.read_sql_query(query, connection, params=arguments)
+
+
+def list_runs(sample=None, path=None):
+    query = ("SELECT r.id AS run, s.name AS sample, r.step, r.directory, r.created, r.backend, r.wall_time, "
+             "r.fit_time, r.parameters FROM runs r JOIN samples s ON r.sample_id = s.id")
+    arguments = []
+    if sample is not None:
+        query += " WHERE s.name = ?"
+        arguments.append(sample)
+    query += " ORDER BY r.id"
+    with closing(connect(path)) as connection:
+        runs = pd.read_sql_query(query, connection, params=arguments)
+    runs["created"] = pd.to_datetime(runs["created"], unit="s")
+    return runs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Query the FMR results database.")
+    parser.add_argument("--database", default=None, help=f"database file (default {DATABASE_PATH})")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    runs_parser = commands.add_parser("runs", help="list the stored runs")
+    runs_parser.add_argument("--sample")
+
+    material_parser = commands.add_parser("material", help="a material parameter of every sample")
+    material_parser.add_argument("name", help='e.g. alpha, "g-factor", "M_eff (T)"')
+    material_parser.add_argument("--step")
+    material_parser.add_argument("--all-runs", action="store_true")
+
+    spectra_parser = commands.add_parser("spectra", help="a per-frequency fit parameter")
+    spectra_parser.add_argument("name", help="e.g. H_res, LW, A, alpha, R2")
+    spectra_parser.add_argument("--sample")
+    spectra_parser.add_argument("--step")
+
+    sample_parser = commands.add_parser("sample", help="set the thickness or notes of a sample")
+    sample_parser.add_argument("name")
+    sample_parser.add_argument("--thickness", type=float)
+    sample_parser.add_argument("--notes")
+
+    args = parser.parse_args(argv)
+    with pd.option_context("display.max_rows", None, "display.width", 200):
+        if args.command == "runs":
+            print(list_runs(args.sample, args.database).to_string(index=False))
+        elif args.command == "material":
+            print(query_material(args.name, args.step, args.all_runs, args.database).to_string(index=False))
+        elif args.command == "spectra":
+            print(query_spectra(args.name, args.sample, args.step, args.database).to_string(index=False))
+        elif args.command == "sample":
+            set_sample(args.name, args.thickness, args.notes, args.database)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
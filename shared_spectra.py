@@ -0,0 +1,174 @@
+#-------------------------------------------------
+# Author:      Suraj Joshi
+# Created:     21-08-2024
+# Copyright:   (c) Suraj Joshi 2024
+#--------------------------------------------------
+# Spectra in multiprocessing.shared_memory for fitting in worker processes. The field and signal
+# arrays of all spectra are packed end to end into two shared blocks; workers attach to them by name
+# once, receive only (spectrum index, window bounds, initial values, bounds) per fit and write
+# params, stderr, nfev, wall time and status into a shared results array. Nothing of the size of a
+# spectrum is pickled in either direction; the parent evaluates best_fit on its own copy of the data.
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+from fit_backends import FitResult, failed_result, get_backend
+from lineshapes import LINESHAPES
+from multi_peak import multi_peak_lineshape
+
+_worker = None
+
+
+def lineshape_spec(lineshape):
+    # What the workers rebuild the lineshape from: the multi-peak and mixed lineshapes are closures,
+    # which the spawn start method (Windows, macOS) cannot pickle
+    if getattr(lineshape, "n_peaks", None):
+        return ("multi_peak", lineshape.n_peaks, lineshape.base_name)
+    if LINESHAPES.get(lineshape.name) is lineshape:
+        return ("registered", lineshape.name)
+    return ("object", lineshape)
+
+
+def build_lineshape(spec):
+    kind, *arguments = spec
+    if kind == "multi_peak":
+        return multi_peak_lineshape(*arguments)
+    if kind == "registered":
+        return LINESHAPES[arguments[0]]
+    return arguments[0]
+
+
+def create_block(nbytes):
+    return SharedMemory(create=True, size=max(int(nbytes), 1))
+
+
+def attach_block(name):
+    # Only the creating process unlinks a block. Pool workers share its resource tracker, so before
+    # Python 3.13 (no track argument) their attach registers the same name again and needs no cleanup
+    try:
+        return SharedMemory(name=name, track=False)
+    except TypeError:
+        return SharedMemory(name=name)
+
+
+class SharedSpectra:
+    # x and y of spectrum i are x[offsets[i]:offsets[i + 1]] and y[...] of the shared blocks
+    def __init__(self, x_block, y_block, offsets, owner):
+        self.x_block = x_block
+        self.y_block = y_block
+        self.offsets = offsets
+        self.owner = owner
+        self.x = np.ndarray((offsets[-1],), dtype=float, buffer=x_block.buf)
+        self.y = np.ndarray((offsets[-1],), dtype=float, buffer=y_block.buf)
+
+    @classmethod
+    def create(cls, xs, ys):
+        offsets = np.concatenate([[0], np.cumsum([len(x) for x in xs])]).astype(np.int64)
+        store = cls(create_block(8 * offsets[-1]), create_block(8 * offsets[-1]), offsets, owner=True)
+        for i, (x, y) in enumerate(zip(xs, ys)):
+            store.x[offsets[i]:offsets[i + 1]] = x
+            store.y[offsets[i]:offsets[i + 1]] = y
+        return store
+
+    @classmethod
+    def attach(cls, spec):
+        x_name, y_name, offsets = spec
+        return cls(attach_block(x_name), attach_block(y_name), offsets, owner=False)
+
+    @property
+    def spec(self):
+        # Everything a worker needs to attach: two block names and the offsets
+        return self.x_block.name, self.y_block.name, self.offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def spectrum(self, index, lo=0, hi=None):
+        # Views of points lo:hi of spectrum index
+        start, end = self.offsets[index], self.offsets[index + 1]
+        hi = end - start if hi is None else hi
+        return self.x[start + lo:start + hi], self.y[start + lo:start + hi]
+
+    def close(self):
+        self.x = self.y = None
+        for block in (self.x_block, self.y_block):
+            block.close()
+            if self.owner:
+                block.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _init_worker(spec, results_name, results_shape, lineshape, backend_name, backend_settings):
+    global _worker
+    lineshape = build_lineshape(lineshape)
+    store = SharedSpectra.attach(spec)
+    results_block = attach_block(results_name)
+    results = np.ndarray(results_shape, dtype=float, buffer=results_block.buf)
+    backend = get_backend(backend_name)
+    vars(backend).update(backend_settings)
+    _worker = (store, results_block, results, lineshape, backend)
+
+
+def _fit_chunk(chunk):
+    # chunk: [(row, index, lo, hi, initial, bounds)]; the results row gets params, stderr (NaN when
+    # unknown), nfev, wall time, success and fitted (0 when the fit raised)
+    store, _, results, lineshape, backend = _worker
+    n_params = len(lineshape.param_names)
+    windows = [store.spectrum(index, lo, hi) for _, index, lo, hi, _, _ in chunk]
+    fitted = backend.fit_many(lineshape, [w[0] for w in windows], [w[1] for w in windows],
+                              [task[4] for task in chunk], [task[5] for task in chunk])
+    for task, result in zip(chunk, fitted):
+        row = results[task[0]]
+        row[:n_params] = [result.params[name] for name in lineshape.param_names]
+        row[n_params:2 * n_params] = [np.nan if result.stderr[name] is None else result.stderr[name]
+                                      for name in lineshape.param_names]
+        row[2 * n_params:] = [result.nfev, result.wall_time, bool(result.success), result.best_fit is not None]
+    return len(chunk)
+
+
+def fit_shared(lineshape, store, tasks, backend_name="lmfit", backend_settings=None, max_workers=None,
+               chunk_size=None, name="process_pool"):
+    # Fit windows of a SharedSpectra store in worker processes, one FitResult per (index, lo, hi,
+    # initial, bounds) task. The store may hold whole spectra (the tasks then carry the window bounds)
+    # or only the windows.
+    n_tasks = len(tasks)
+    if n_tasks == 0:
+        return []
+    n_params = len(lineshape.param_names)
+    max_workers = max_workers or os.cpu_count() or 1
+    chunk_size = chunk_size or max(1, -(-n_tasks // (4 * max_workers)))
+
+    shape = (n_tasks, 2 * n_params + 4)
+    results_block = create_block(8 * shape[0] * shape[1])
+    try:
+        np.ndarray(shape, dtype=float, buffer=results_block.buf)[:] = np.nan
+        numbered = [(row,) + tuple(task) for row, task in enumerate(tasks)]
+        chunks = [numbered[start:start + chunk_size] for start in range(0, n_tasks, chunk_size)]
+        initargs = (store.spec, results_block.name, shape, lineshape_spec(lineshape), backend_name,
+                    backend_settings or {})
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=initargs) as executor:
+            list(executor.map(_fit_chunk, chunks))
+        values = np.ndarray(shape, dtype=float, buffer=results_block.buf).copy()
+    finally:
+        results_block.close()
+        results_block.unlink()
+
+    fit_results = []
+    for (index, lo, hi, _, _), row in zip(tasks, values):
+        if not row[-1] == 1:
+            fit_results.append(failed_result(lineshape, name, 0.0 if np.isnan(row[-3]) else row[-3],
+                                             "Fit raised in the worker process"))
+            continue
+        params = dict(zip(lineshape.param_names, row[:n_params].tolist()))
+        stderr = {param: None if np.isnan(error) else float(error)
+                  for param, error in zip(lineshape.param_names, row[n_params:2 * n_params])}
+        x, _ = store.spectrum(index, lo, hi)
+        success = bool(row[-2])
+        fit_results.append(FitResult(lineshape, params, stderr, lineshape.function(x, **params), int(row[-4]),
+                                     row[-3], success, "Converged" if success else "Not converged", name))
+    return fit_results
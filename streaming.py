@@ -0,0 +1,211 @@
+#-------------------------------------------------
+# Author:      Suraj Joshi
+# Created:     21-08-2024
+# Copyright:   (c) Suraj Joshi 2024
+#--------------------------------------------------
+# Streaming form of the field-domain steps: conversion, derivative and lineshape fitting as generator
+# stages that pass one record per frequency, so the derivative and fit of the first frequencies run
+# while later ones are still being converted and written, and no stage holds the whole sweep.
+# A record is a dict with
+#   name          file name stem of the frequency, as written by the conversion step ("5000000000.0")
+#   frequency     frequency in Hz (None for a file name that is not a number)
+#   x, y          field (Oe) and signal arrays
+#   imag          imaginary part of S21 (conversion records of traces with a third column only)
+#   index, count  position of the frequency in the requested grid, for progress bars
+# and the fit stage adds window ((new_x, new_y) or None), result (FitResult or None) and reason
+# (why the pre-screen skipped the spectrum, "" otherwise).
+# threaded() runs a stage in its own thread behind a bounded queue, so a producer that is ahead
+# waits for the consumer (back-pressure); the CSV writers are pass-through sinks that can be left out:
+#   records = sweep_records(directory, 1e9)
+#   records = threaded(csv_sink(records, os.path.join(directory, "field domain data"), CONVERSION_COLUMNS))
+#   records = threaded(derivative_records(records))
+#   for record in fit_records(records, LINESHAPES["derivative_lorentzian"], get_backend("lmfit"), initial):
+#       ...
+import os
+import queue
+import threading
+import numpy as np
+import pandas as pd
+from fit_window import window_around_peak
+from prescreen import screen_spectra
+from resample import resample_cube, uniform_grid
+from sweep_catalog import value_from_name
+from sweep_cube import frequency_columns
+from sweep_store import load_sweep, compact_float_format
+
+# Column names of the CSV files of each stage: (field, signal, imaginary part)
+CONVERSION_COLUMNS = ("mag_field(oe)", "s21", "s21_imag")
+DERIVATIVE_COLUMNS = ("Magnetic Field", "dS21/dH", None)
+
+
+def sweep_records(input_directory, step_size, complex_values=True, method=None, field_step=None):
+    # One record per frequency of the grid min_freq, min_freq + step_size, ... present in the traces.
+    # All traces have to be read before the first frequency column exists; the records are views
+    # into that field x frequency array. With method ("linear" or "cubic") the array is first
+    # resampled onto that frequency grid and, with field_step, onto a uniform field grid, instead of
+    # keeping only the frequencies the VNA measured exactly. In the compact mode of sweep_store.py
+    # the array is float32 and read from the sweep's store when it is current.
+    fields, freq_values, s21, _ = load_sweep(input_directory, complex_values)
+    if method is None:
+        yield from cube_records(fields, freq_values, s21, step_size)
+        return
+    field_grid = uniform_grid(fields, field_step) if field_step else None
+    fields, freq_values, s21 = resample_cube(fields, freq_values, s21, field_grid,
+                                             uniform_grid(freq_values, step_size), method)
+    yield from cube_records(fields, freq_values, s21)
+
+
+def cube_records(fields, freq_values, s21, step_size=None):
+    # Records of a field x frequency array from load_sweep_cube or build_sweep_cube (acquired traces);
+    # without step_size every column is a record. NaN points (resampling gaps) are left out, and
+    # records of a float32 array are converted to float64 for the derivative and the fits.
+    has_imaginary = np.iscomplexobj(s21) and np.any(s21.imag != 0)
+
+    if step_size is None:
+        index_freq_values = np.asarray(freq_values)
+        columns = np.arange(len(index_freq_values))
+    else:
+        index_freq_values = np.arange(min(freq_values), max(freq_values) + step_size, step_size)
+        columns = frequency_columns(freq_values, index_freq_values)
+    for i, (freq_value, column) in enumerate(zip(index_freq_values, columns)):
+        if column < 0:
+            continue
+        x, values = fields, s21[:, column].astype(np.promote_types(s21.dtype, np.float64), copy=False)
+        finite = np.isfinite(values)
+        if not finite.all():
+            if not finite.any():
+                continue
+            x, values = x[finite], values[finite]
+        record = dict(name=str(freq_value), frequency=float(freq_value), x=x, y=values.real,
+                      index=i, count=len(index_freq_values))
+        if has_imaginary:
+            record["imag"] = values.imag
+        yield record
+
+
+def csv_records(directory, columns=CONVERSION_COLUMNS):
+    # Records of the CSV files a stage wrote to directory, for resuming from stored files
+    file_names = [file_name for file_name in os.listdir(directory) if file_name.endswith(".csv")]
+    for i, file_name in enumerate(file_names):
+        data = pd.read_csv(os.path.join(directory, file_name))
+        name = os.path.splitext(file_name)[0]
+        record = dict(name=name, frequency=value_from_name(file_name), x=data[columns[0]].values,
+                      y=data[columns[1]].values, index=i, count=len(file_names))
+        if columns[2] is not None and columns[2] in data:
+            record["imag"] = data[columns[2]].values
+        yield record
+
+
+def central_difference(H, S21, dH=None):
+    # dS21/dH at the inner points over the actual field spacing, so irregular or resampled fields
+    # are differentiated correctly; dH forces a nominal field step instead
+    step = (H[2:] - H[:-2]) if dH is None else 2 * dH
+    return H[1:-1], (S21[2:] - S21[:-2]) / step
+
+
+def derivative_records(records, dH=None):
+    for record in records:
+        H_mid, dS21_dH = central_difference(record["x"], record["y"], dH)
+        derivative = {key: value for key, value in record.items() if key != "imag"}
+        derivative.update(x=H_mid, y=dS21_dH)
+        yield derivative
+
+
+def fit_records(records, lineshape, backend, initial, bounds=None, delta_x=150, peak="max", batch_size=32,
+                screen_policy="off", kind="derivative"):
+    # Window, pre-screen and fit the records batch_size at a time, so batch backends still see many
+    # spectra per call while the first results come out after the first batch. initial is a dict or
+    # a function of the (new_x, new_y) window returning one.
+    batch = []
+
+    def fit_batch():
+        windows = [window_around_peak(record["x"], record["y"], delta_x, peak=peak) for record in batch]
+        fit, reasons = screen_spectra([(record["x"], record["y"]) for record in batch], windows, screen_policy,
+                                      kind)
+        fitted = [(record, window) for record, window, keep in zip(batch, windows, fit) if keep]
+        initials = [initial(window) if callable(initial) else initial for _, window in fitted]
+        results = iter(backend.fit_many(lineshape, [window[0] for _, window in fitted],
+                                        [window[1] for _, window in fitted], initials, bounds))
+        for record, window, keep, reason in zip(batch, windows, fit, reasons):
+            yield dict(record, window=window if keep else None, result=next(results) if keep else None, reason=reason)
+
+    for record in records:
+        batch.append(record)
+        if len(batch) == batch_size:
+            yield from fit_batch()
+            batch = []
+    if batch:
+        yield from fit_batch()
+
+
+def csv_sink(records, directory, columns=CONVERSION_COLUMNS, compact=None):
+    # Write every record as directory/<name>.csv and pass it on; with float32 precision in the
+    # compact mode
+    float_format = compact_float_format(compact)
+    os.makedirs(directory, exist_ok=True)
+    for record in records:
+        df = pd.DataFrame({columns[0]: record["x"], columns[1]: record["y"]})
+        if columns[2] is not None and "imag" in record:
+            df[columns[2]] = record["imag"]
+        df.to_csv(os.path.join(directory, record["name"] + ".csv"), index=False, float_format=float_format)
+        yield record
+
+
+def threaded(records, maxsize=8):
+    # Run the stage feeding records in a background thread, at most maxsize records ahead of the
+    # consumer. Errors of the stage are raised in the consumer; closing the consumer stops the stage.
+    buffer = queue.Queue(maxsize)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for record in records:
+                if not put((True, record)):
+                    return
+            put((False, None))
+        except BaseException as error:
+            put((False, error))
+        finally:
+            close = getattr(records, "close", None)
+            if close is not None:
+                close()
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            is_record, item = buffer.get()
+            if is_record:
+                yield item
+            elif item is None:
+                return
+            else:
+                raise item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def field_domain_fits(input_directory, step_size, lineshape, backend, initial, bounds=None, delta_x=150,
+                      write_csv=True, batch_size=32, queue_size=8, screen_policy="off"):
+    # Traces of input_directory -> field domain records -> dS21/dH records -> fit records, each stage in
+    # its own thread. With write_csv the conversion and derivative CSV files are written on the way,
+    # to the same folders as the separate steps ("field domain data" and "field domain data/ds21").
+    field_domain_directory = os.path.join(input_directory, "field domain data")
+    records = sweep_records(input_directory, step_size)
+    if write_csv:
+        records = csv_sink(records, field_domain_directory, CONVERSION_COLUMNS)
+    records = derivative_records(threaded(records, queue_size))
+    if write_csv:
+        records = csv_sink(records, os.path.join(field_domain_directory, "ds21"), DERIVATIVE_COLUMNS)
+    return fit_records(threaded(records, queue_size), lineshape, backend, initial, bounds, delta_x,
+                       batch_size=batch_size, screen_policy=screen_policy)
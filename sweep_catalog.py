@@ -0,0 +1,127 @@
+#-------------------------------------------------
+# Author:      Suraj Joshi
+# Created:     21-08-2024
+# Copyright:   (c) Suraj Joshi 2024
+#--------------------------------------------------
+# Index of the data files of a sweep directory, stored next to the data as sweep_catalog.json.
+# Every file is named by its numeric value (field for the raw .txt traces, frequency for the
+# per-frequency .csv spectra). The catalog records value, size, mtime, shape, dtype and a checksum
+# of the first column (the frequency or field axis) of each file, so later steps can list, sort
+# and validate a sweep from the index; only new or modified files are read again.
+import os
+import json
+import fnmatch
+import zlib
+import numpy as np
+import pandas as pd
+from trace_reader import read_trace
+
+CATALOG_FILE = "sweep_catalog.json"
+
+
+def value_from_name(file_name):
+    # Numeric value of a data file name such as "250.txt" or "5000000000.0.csv", None otherwise
+    try:
+        return float(os.path.splitext(file_name)[0])
+    except ValueError:
+        return None
+
+
+def read_data_file(file_path):
+    if file_path.endswith(".csv"):
+        return pd.read_csv(file_path).to_numpy()
+    return read_trace(file_path)
+
+
+def inspect_file(file_path, stat):
+    data = read_data_file(file_path)
+    return {
+        "value": value_from_name(os.path.basename(file_path)),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "shape": list(data.shape),
+        "dtype": str(data.dtype),
+        "axis_crc": zlib.crc32(np.ascontiguousarray(data[:, 0]).tobytes()) if data.size else 0,
+    }
+
+
+class SweepCatalog:
+    def __init__(self, directory, pattern, entries, axis):
+        self.directory = directory
+        self.pattern = pattern
+        self.entries = entries  # {file name: entry dict}
+        self.axis = axis  # first column of the lowest-valued file
+
+    @classmethod
+    def load(cls, directory, pattern="*.txt"):
+        catalog_path = os.path.join(directory, CATALOG_FILE)
+        try:
+            with open(catalog_path) as catalog_file:
+                stored = json.load(catalog_file)
+        except (OSError, ValueError):
+            stored = {}
+        stored_section = stored.get(pattern, {})
+        stored_entries = stored_section.get("entries", {})
+
+        entries = {}
+        changed = False
+        with os.scandir(directory) as scan:
+            for dir_entry in scan:
+                if not dir_entry.is_file() or not fnmatch.fnmatch(dir_entry.name, pattern):
+                    continue
+                if value_from_name(dir_entry.name) is None:
+                    continue
+                stat = dir_entry.stat()
+                old = stored_entries.get(dir_entry.name)
+                if old is not None and old["size"] == stat.st_size and old["mtime"] == stat.st_mtime:
+                    entries[dir_entry.name] = old
+                else:
+                    entries[dir_entry.name] = inspect_file(dir_entry.path, stat)
+                    changed = True
+        changed = changed or set(entries) != set(stored_entries)
+
+        catalog = cls(directory, pattern, entries, None)
+        names = catalog.names()
+        if not changed and "axis" in stored_section:
+            catalog.axis = np.array(stored_section["axis"])
+        elif names:
+            catalog.axis = read_data_file(os.path.join(directory, names[0]))[:, 0]
+            changed = True
+
+        if changed:
+            stored[pattern] = {"entries": entries,
+                               "axis": catalog.axis.tolist() if catalog.axis is not None else []}
+            # Written under a private name and renamed, so steps indexing the same directory in
+            # parallel never read a half-written catalog
+            temporary_path = f"{catalog_path}.{os.getpid()}.tmp"
+            try:
+                with open(temporary_path, "w") as catalog_file:
+                    json.dump(stored, catalog_file)
+                os.replace(temporary_path, catalog_path)
+            except OSError:
+                pass  # Read-only data directories still get the in-memory catalog
+        return catalog
+
+    def names(self):
+        # File names sorted by their numeric value
+        return sorted(self.entries, key=lambda name: self.entries[name]["value"])
+
+    def paths(self):
+        return [os.path.join(self.directory, name) for name in self.names()]
+
+    def values(self):
+        return np.array([self.entries[name]["value"] for name in self.names()])
+
+    def validate(self):
+        # All files must share the shape and first-column axis of the lowest-valued file
+        names = self.names()
+        if not names:
+            raise ValueError(f"No {self.pattern} files found in {self.directory}.")
+        reference = self.entries[names[0]]
+        mismatched = [name for name in names
+                      if self.entries[name]["shape"] != reference["shape"]
+                      or self.entries[name]["axis_crc"] != reference["axis_crc"]]
+        if mismatched:
+            raise ValueError(f"{len(mismatched)} files differ in shape or axis from {names[0]}: "
+                             f"{', '.join(mismatched[:5])}")
+        return self
@@ -0,0 +1,63 @@
+#-------------------------------------------------
+# Author:      Suraj Joshi
+# Created:     21-08-2024
+# Copyright:   (c) Suraj Joshi 2024
+#--------------------------------------------------
+# Loading of a VNA sweep (one .txt trace per field step, named by the field value) into a
+# field x frequency array, so every trace is read once instead of once per frequency.
+import os
+import numpy as np
+from trace_reader import iter_traces, check_trace_axis
+
+
+def field_from_path(file_path):
+    # The trace files are named by their magnetic field value, e.g. "250.txt"
+    return float(os.path.splitext(os.path.basename(file_path))[0])
+
+
+def load_sweep_cube(file_paths, complex_values=False, max_workers=None, dtype=np.float64):
+    # Returns (fields, freq_values, values, times) with rows sorted by ascending field:
+    # values[i, j] is column 1 of the trace at fields[i] and freq_values[j], times[i] its file mtime.
+    # With complex_values, columns 1 and 2 are read as the real and imaginary part of S21
+    # (traces with a single data column get a zero imaginary part). Traces are read by max_workers threads
+    # and copied straight into their row, so only a few of them are held at a time. dtype is the
+    # precision of values (np.float32 for the compact mode of sweep_store.py); the axes stay float64.
+    if not file_paths:
+        raise ValueError("No trace files found.")
+    fields = np.array([field_from_path(file_path) for file_path in file_paths])
+    times = np.array([os.path.getmtime(file_path) for file_path in file_paths])
+    return build_sweep_cube(fields, iter_traces(file_paths, max_workers), times, complex_values, file_paths, dtype)
+
+
+def build_sweep_cube(fields, traces, times, complex_values=False, labels=None, dtype=np.float64):
+    # Same result as load_sweep_cube from traces that are already read (or acquired): traces is an
+    # iterable of (n_freq, 2 or 3) arrays in the order of fields and times, consumed one at a time and
+    # copied straight into its row of the field-sorted array. labels name the traces in errors.
+    fields = np.asarray(fields, dtype=float)
+    order = np.argsort(fields, kind="stable")
+    rows = np.empty_like(order)
+    rows[order] = np.arange(order.size)
+    if labels is None:
+        labels = [f"trace at {field:g} Oe" for field in fields]
+
+    values = None
+    for i, trace in enumerate(traces):
+        if values is None:
+            freq_values = trace[:, 0].copy()
+            values = np.empty((fields.size, freq_values.size),
+                              dtype=np.result_type(dtype, np.complex64) if complex_values else dtype)
+        check_trace_axis(labels[i], trace, freq_values)
+        values[rows[i]] = trace[:, 1]
+        if complex_values and trace.shape[1] > 2:
+            values.imag[rows[i]] = trace[:, 2]
+    if values is None:
+        raise ValueError("No traces found.")
+    return fields[order], freq_values, values, np.asarray(times, dtype=float)[order]
+
+
+def frequency_columns(freq_values, index_freq_values):
+    # Column of each requested frequency in freq_values (exact match as before), -1 where absent
+    order = np.argsort(freq_values, kind="stable")
+    positions = np.clip(np.searchsorted(freq_values[order], index_freq_values), 0, freq_values.size - 1)
+    columns = order[positions]
+    return np.where(freq_values[columns] == index_freq_values, columns, -1)
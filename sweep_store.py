@@ -0,0 +1,312 @@
+#-------------------------------------------------
+# Author:      Suraj Joshi
+# Created:     21-08-2024
+# Copyright:   (c) Suraj Joshi 2024
+#--------------------------------------------------
+# Compact storage of a sweep: the field x frequency array in one chunked, compressed binary file
+# (sweep_cube.fmrz next to the traces) and S21 as float32 in memory. The compact mode is opt-in with
+# FMR_COMPACT=1 (or compact=True): the steps then read the .txt traces once, keep S21 as float32 /
+# complex64 (7 significant digits, far below the noise of a VNA trace), write the store and read it
+# instead of the traces until a trace is added or modified; the CSV outputs are written with float32
+# precision. Fields, frequencies and times stay float64 (frequencies in Hz do not fit a float32), and
+# the derivative and the fits convert every spectrum to float64, so only the S21 values are rounded.
+# A store written by "pack" is also read outside the compact mode, so the traces can be archived.
+# File layout:
+#   b"FMRZ", header length (uint32), JSON header (shape, dtype, codec, rows per chunk, compressed
+#   chunk sizes, number and newest mtime of the traces it was built from), then fields, freq_values
+#   and times as float64, then the chunks. A chunk is chunk_rows field rows, byte-shuffled (the first
+#   bytes of all values, then the second bytes, ... as blosc does, so signs, exponents and high
+#   mantissa bytes sit together and compress well) and compressed with zlib, or zstd when the
+#   zstandard package is installed. Chunks are compressed and decompressed by a pool of threads (both
+#   codecs release the GIL), straight into the rows of the output array.
+#
+# Command line:
+#   python sweep_store.py pack D:/data/sample [--float64] [--codec zlib] [--level 3]
+#   python sweep_store.py report D:/data/sample [--step-size 1e9] [--backend varpro]
+import os
+import sys
+import json
+import time
+import zlib
+import struct
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from sweep_catalog import SweepCatalog, value_from_name
+from sweep_cube import load_sweep_cube
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+STORE_FILE = "sweep_cube.fmrz"
+MAGIC = b"FMRZ"
+PREFIX = struct.Struct("<4sI")
+COMPACT_DTYPE = np.float32
+# Shortest format that writes every float32 value back exactly
+COMPACT_FLOAT_FORMAT = "%.9g"
+
+
+def zlib_compress(data, level=None):
+    return zlib.compress(data, 1 if level is None else level)
+
+
+def zstd_compress(data, level=None):
+    return zstandard.ZstdCompressor(level=3 if level is None else level).compress(data)
+
+
+def zstd_decompress(data):
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+# name: (compress(data, level), decompress(data))
+CODECS = {"zlib": (zlib_compress, zlib.decompress)}
+if zstandard is not None:
+    CODECS["zstd"] = (zstd_compress, zstd_decompress)
+DEFAULT_CODEC = "zstd" if zstandard is not None else "zlib"
+
+
+def compact_mode():
+    return os.environ.get("FMR_COMPACT", "0").lower() not in ("", "0", "false", "no")
+
+
+def compact_float_format(compact=None):
+    # float_format of the CSV outputs: float32 precision in the compact mode, full repr otherwise
+    return COMPACT_FLOAT_FORMAT if (compact_mode() if compact is None else compact) else None
+
+
+def shuffle(block):
+    return np.ascontiguousarray(block).view(np.uint8).reshape(-1, block.itemsize).T.tobytes()
+
+
+def unshuffle(data, out):
+    # Inverse of shuffle into the contiguous array out
+    out.view(np.uint8).reshape(-1, out.itemsize)[:] = np.frombuffer(data, dtype=np.uint8).reshape(out.itemsize, -1).T
+
+
+def trace_sources(directory):
+    # Number of .txt traces in directory and their newest mtime, to tell whether a store is current
+    n_traces, newest = 0, 0.0
+    with os.scandir(directory) as scan:
+        for entry in scan:
+            if entry.is_file() and entry.name.endswith(".txt") and value_from_name(entry.name) is not None:
+                n_traces += 1
+                newest = max(newest, entry.stat().st_mtime)
+    return dict(n_traces=n_traces, newest=newest)
+
+
+def save_cube(path, fields, freq_values, values, times, dtype=None, codec=DEFAULT_CODEC, level=None, chunk_rows=64,
+              max_workers=None, sources=None):
+    # Write the array as dtype (default its own precision) to path; returns the file size in bytes
+    if codec not in CODECS:
+        raise ValueError(f"Codec '{codec}' is not available. Available: {', '.join(CODECS)}")
+    compress = CODECS[codec][0]
+    dtype = np.dtype(values.dtype if dtype is None else dtype)
+    if np.iscomplexobj(values):
+        dtype = np.result_type(dtype, np.complex64)
+
+    def encode(start):
+        return compress(shuffle(np.asarray(values[start:start + chunk_rows], dtype=dtype)), level)
+
+    with ThreadPoolExecutor(max_workers or os.cpu_count() or 1) as executor:
+        chunks = list(executor.map(encode, range(0, values.shape[0], chunk_rows)))
+    header = dict(version=1, shape=list(values.shape), dtype=dtype.str, codec=codec, chunk_rows=chunk_rows,
+                  chunks=[len(chunk) for chunk in chunks], **(sources or {}))
+    header_bytes = json.dumps(header).encode()
+
+    # Written under a private name and renamed, so a step reading the store never sees half a file
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, "wb") as store_file:
+        store_file.write(PREFIX.pack(MAGIC, len(header_bytes)))
+        store_file.write(header_bytes)
+        for axis in (fields, freq_values, times):
+            store_file.write(np.asarray(axis, dtype="<f8").tobytes())
+        for chunk in chunks:
+            store_file.write(chunk)
+    os.replace(temporary_path, path)
+    return os.path.getsize(path)
+
+
+def read_header(store_file):
+    magic, header_size = PREFIX.unpack(store_file.read(PREFIX.size))
+    if magic != MAGIC:
+        raise ValueError(f"{store_file.name} is not a sweep store.")
+    return json.loads(store_file.read(header_size))
+
+
+def load_cube(path, complex_values=False, dtype=None, max_workers=None):
+    # (fields, freq_values, values, times) as load_sweep_cube returns them; values in the precision
+    # dtype (default the stored one), the real part only unless complex_values
+    with open(path, "rb") as store_file:
+        header = read_header(store_file)
+        n_fields, n_freq = header["shape"]
+        fields, freq_values, times = (np.frombuffer(store_file.read(8 * n), dtype="<f8").astype(float)
+                                      for n in (n_fields, n_freq, n_fields))
+        data = memoryview(store_file.read())
+    if header["codec"] not in CODECS:
+        raise ValueError(f"{path} is compressed with {header['codec']}, which needs the zstandard package.")
+    decompress = CODECS[header["codec"]][1]
+    stored = np.dtype(header["dtype"])
+    precision = np.dtype(dtype) if dtype is not None else np.empty(0, dtype=stored).real.dtype
+    values = np.empty((n_fields, n_freq), dtype=np.result_type(precision, np.complex64) if complex_values else precision)
+    offsets = np.concatenate([[0], np.cumsum(header["chunks"])]).astype(int)
+    chunk_rows = header["chunk_rows"]
+
+    def decode(k):
+        start = k * chunk_rows
+        block = np.empty((min(chunk_rows, n_fields - start), n_freq), dtype=stored)
+        unshuffle(decompress(data[offsets[k]:offsets[k + 1]]), block)
+        values[start:start + block.shape[0]] = block if complex_values else block.real
+
+    with ThreadPoolExecutor(max_workers or os.cpu_count() or 1) as executor:
+        list(executor.map(decode, range(len(header["chunks"]))))
+    return fields, freq_values, values, times
+
+
+def store_is_current(directory, dtype=None):
+    # The store exists and no trace was added, removed or modified since it was written (a store
+    # without traces next to it is current, the traces were archived). With dtype, a store rounded
+    # to a lower precision is not current either while the traces are there to read.
+    try:
+        with open(os.path.join(directory, STORE_FILE), "rb") as store_file:
+            header = read_header(store_file)
+    except (OSError, ValueError):
+        return False
+    sources = trace_sources(directory)
+    if sources["n_traces"] == 0:
+        return True
+    if dtype is not None and np.empty(0, dtype=header["dtype"]).real.dtype.itemsize < np.dtype(dtype).itemsize:
+        return False
+    return sources["n_traces"] == header.get("n_traces") and sources["newest"] <= header.get("newest", 0.0)
+
+
+def pack_sweep(directory, dtype=COMPACT_DTYPE, codec=DEFAULT_CODEC, level=None, max_workers=None):
+    # Read the .txt traces of directory (with the imaginary part when they have one) and write the
+    # store; returns the array as load_sweep_cube does
+    sources = trace_sources(directory)
+    catalog = SweepCatalog.load(directory, "*.txt").validate()
+    has_imaginary = catalog.entries[catalog.names()[0]]["shape"][1] > 2
+    cube = load_sweep_cube(catalog.paths(), has_imaginary, max_workers, dtype)
+    save_cube(os.path.join(directory, STORE_FILE), *cube, codec=codec, level=level, max_workers=max_workers,
+              sources=sources)
+    return cube
+
+
+def load_sweep(directory, complex_values=False, compact=None, dtype=None, max_workers=None):
+    # Field x frequency array of the sweep in directory, from the store while it is current and from
+    # the .txt traces otherwise. In the compact mode the values are rounded to float32 (kept as
+    # float32 unless dtype asks for more) and the store is written after reading the traces; outside
+    # it a float32 store is only read when its traces are gone.
+    compact = compact_mode() if compact is None else compact
+    dtype = np.dtype(dtype or (COMPACT_DTYPE if compact else np.float64))
+    if store_is_current(directory, None if compact else dtype):
+        return load_cube(os.path.join(directory, STORE_FILE), complex_values, dtype, max_workers)
+    if not compact:
+        file_paths_sorted = SweepCatalog.load(directory, "*.txt").validate().paths()
+        return load_sweep_cube(file_paths_sorted, complex_values, max_workers, dtype)
+    try:
+        fields, freq_values, values, times = pack_sweep(directory, max_workers=max_workers)
+    except OSError:
+        # Read-only data directories are read in the compact precision without a store
+        file_paths_sorted = SweepCatalog.load(directory, "*.txt").validate().paths()
+        fields, freq_values, values, times = load_sweep_cube(file_paths_sorted, complex_values, max_workers,
+                                                             COMPACT_DTYPE)
+    if np.iscomplexobj(values) and not complex_values:
+        return fields, freq_values, values.real.astype(dtype), times
+    return fields, freq_values, values.astype(np.result_type(dtype, np.complex64) if complex_values else dtype,
+                                              copy=False), times
+
+
+def derivative_lorentzian_initial(window):
+    # Start values from the two extrema of a dS21/dH window, which lie at H_res -+ LW / (2 sqrt(3))
+    # with the values +-9 A / (2 sqrt(3) pi LW^2)
+    x, y = window
+    left, right = sorted((int(np.argmax(y)), int(np.argmin(y))), key=lambda i: x[i])
+    LW = max(np.sqrt(3) * abs(x[right] - x[left]), np.min(np.abs(np.diff(x))) if x.size > 1 else 1.0)
+    A = (y[left] - y[right]) * np.sqrt(3) * np.pi * LW ** 2 / 9
+    return dict(A=float(A), H_res=float(x[left] + x[right]) / 2, LW=float(LW))
+
+
+def fit_cube(fields, freq_values, values, step_size, backend_name="varpro", delta_x=150):
+    # Derivative Lorentzian fit of every frequency of the array, through the streaming stages of the
+    # conversion, derivative and fitting steps: {frequency name: FitResult}
+    from fit_backends import get_backend
+    from lineshapes import LINESHAPES
+    from streaming import cube_records, derivative_records, fit_records
+    records = derivative_records(cube_records(fields, freq_values, values, step_size))
+    fits = fit_records(records, LINESHAPES["derivative_lorentzian"], get_backend(backend_name),
+                       derivative_lorentzian_initial, {"LW": (0, None)}, delta_x)
+    return {record["name"]: record["result"] for record in fits if record["result"] is not None}
+
+
+def precision_report(directory, step_size=1e9, backend_name="varpro", delta_x=150, codec=DEFAULT_CODEC):
+    # Sizes, load times and fitted parameters of the float64 array of the traces versus the compact
+    # float32 store; returns the report as lines of text
+    file_paths = SweepCatalog.load(directory, "*.txt").validate().paths()
+    txt_bytes = sum(os.path.getsize(file_path) for file_path in file_paths)
+    start = time.perf_counter()
+    fields, freq_values, values, times = load_sweep_cube(file_paths)
+    txt_time = time.perf_counter() - start
+
+    lines = [f"Sweep {directory}: {values.shape[0]} fields x {values.shape[1]} frequencies",
+             f"  .txt traces       {txt_bytes / 1e6:9.2f} MB on disk, {txt_time:.2f} s to read, "
+             f"{values.nbytes / 1e6:.2f} MB float64 in memory"]
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        path = os.path.join(temporary_directory, STORE_FILE)
+        for label, dtype in (("store float64", np.float64), ("store float32", COMPACT_DTYPE)):
+            size = save_cube(path, fields, freq_values, values, times, dtype, codec)
+            start = time.perf_counter()
+            stored = load_cube(path)
+            load_time = time.perf_counter() - start
+            lines.append(f"  {label}     {size / 1e6:9.2f} MB on disk ({codec}, {txt_bytes / size:.1f}x smaller), "
+                         f"{load_time:.2f} s to read, {stored[2].nbytes / 1e6:.2f} MB in memory")
+        compact_values = stored[2]
+    lines.append(f"  max |S21 float32 - float64| {np.max(np.abs(compact_values - values)):.2e} "
+                 f"(max |S21| {np.max(np.abs(values)):.3g})")
+
+    reference = fit_cube(fields, freq_values, values, step_size, backend_name, delta_x)
+    compact = fit_cube(fields, freq_values, compact_values, step_size, backend_name, delta_x)
+    names = [name for name in reference if name in compact and reference[name].success and compact[name].success]
+    lines.append(f"  fitted parameters ({backend_name}, {len(names)} of {len(reference)} frequencies converged in both):")
+    for param in ("A", "H_res", "LW"):
+        difference = np.array([abs(compact[name].params[param] - reference[name].params[param]) for name in names])
+        stderr = np.array([reference[name].stderr.get(param) or np.nan for name in names])
+        if difference.size:
+            lines.append(f"    {param:6s} max |float32 - float64| {difference.max():.3g}, "
+                         f"max {np.nanmax(difference / stderr) if np.isfinite(stderr).any() else np.nan:.2g} "
+                         f"standard errors")
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compact compressed storage of FMR sweeps.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    pack = commands.add_parser("pack", help=f"write the traces of a sweep directory to {STORE_FILE}")
+    pack.add_argument("directory")
+    pack.add_argument("--float64", action="store_true", help="store the values without rounding to float32")
+    pack.add_argument("--codec", choices=list(CODECS), default=DEFAULT_CODEC)
+    pack.add_argument("--level", type=int, help="compression level of the codec")
+    report = commands.add_parser("report", help="compare the compact store with the float64 traces")
+    report.add_argument("directory")
+    report.add_argument("--step-size", type=float, default=1e9, help="frequency step of the fitted spectra (Hz)")
+    report.add_argument("--backend", default="varpro")
+    report.add_argument("--codec", choices=list(CODECS), default=DEFAULT_CODEC)
+    args = parser.parse_args(argv)
+
+    if args.command == "pack":
+        start = time.perf_counter()
+        pack_sweep(args.directory, np.float64 if args.float64 else COMPACT_DTYPE, args.codec, args.level)
+        txt_bytes = sum(os.path.getsize(file_path)
+                        for file_path in SweepCatalog.load(args.directory, "*.txt").paths())
+        store_bytes = os.path.getsize(os.path.join(args.directory, STORE_FILE))
+        print(f"Packed {txt_bytes / 1e6:.2f} MB of traces into {store_bytes / 1e6:.2f} MB "
+              f"({txt_bytes / store_bytes:.1f}x smaller) in {time.perf_counter() - start:.2f} s")
+    else:
+        print("\n".join(precision_report(args.directory, args.step_size, args.backend, codec=args.codec)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,64 @@
+#-------------------------------------------------
+# Author:      Suraj Joshi
+# Created:     21-08-2024
+# Copyright:   (c) Suraj Joshi 2024
+#--------------------------------------------------
+# Reader for the numeric VNA exports (.txt traces: frequency followed by one or more S21 columns,
+# separated by whitespace or commas). A trace is parsed by np.loadtxt, which has been a C parser since
+# NumPy 1.23 and is as fast as parsing the bytes directly; many traces are read concurrently so disk
+# and network-share latency overlap.
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+
+def read_trace(file_path):
+    # np.loadtxt(file_path, ndmin=2) with the delimiter of the file; the text is read once
+    with open(file_path) as trace_file:
+        data = trace_file.read()
+    return np.loadtxt(data.splitlines(), delimiter="," if "," in data else None, ndmin=2)
+
+
+def read_traces(file_paths, max_workers=None):
+    # Traces in the order of file_paths, read by a pool of threads
+    if max_workers is None:
+        max_workers = min(32, (os.cpu_count() or 1) + 4)
+    if max_workers <= 1 or len(file_paths) <= 1:
+        return [read_trace(file_path) for file_path in file_paths]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(read_trace, file_paths))
+
+
+def iter_traces(file_paths, max_workers=None):
+    # Traces in the order of file_paths, read ahead by a pool of threads. At most 2 * max_workers
+    # traces are in memory at a time, so a caller that copies each one into an array and drops it
+    # never holds the whole sweep twice.
+    if max_workers is None:
+        max_workers = min(32, (os.cpu_count() or 1) + 4)
+    if max_workers <= 1 or len(file_paths) <= 1:
+        for file_path in file_paths:
+            yield read_trace(file_path)
+        return
+    remaining = iter(file_paths)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque(executor.submit(read_trace, file_path) for _, file_path in zip(range(2 * max_workers), remaining))
+        while pending:
+            trace = pending.popleft().result()
+            file_path = next(remaining, None)
+            if file_path is not None:
+                pending.append(executor.submit(read_trace, file_path))
+            yield trace
+
+
+def check_trace_axis(file_path, trace, freq_values):
+    if trace.shape[0] != freq_values.size or not np.array_equal(trace[:, 0], freq_values):
+        raise ValueError(f"Frequency axis of {os.path.basename(file_path)} differs from the first trace.")
+
+
+def check_frequency_axis(file_paths, traces):
+    # All traces must share the frequency column of the first one; returns that axis
+    freq_values = traces[0][:, 0]
+    for file_path, trace in zip(file_paths, traces):
+        check_trace_axis(file_path, trace, freq_values)
+    return freq_values
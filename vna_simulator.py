@@ -0,0 +1,106 @@
+#-------------------------------------------------
+# Author:      Suraj Joshi
+# Created:     21-08-2024
+# Copyright:   (c) Suraj Joshi 2024
+#--------------------------------------------------
+# Simulated VNA-FMR instrument for developing and timing the acquisition without hardware. Every
+# connection receives one field sweep in the frame format of acquisition.py, at a fixed trace rate.
+# The traces follow an in-plane Kittel film with Gilbert damping:
+#   H_res(f) = (sqrt(M_eff^2 + 4 (f / gamma)^2) - M_eff) / 2 - H_k        (T, f in GHz, gamma in GHz/T)
+#   LW(f)    = DH0 + 2 alpha f / gamma                                    (full width, T)
+#   S21      = baseline(f) * (1 - depth * (LW / 2) / (LW / 2 - i (H - H_res)))  + noise
+# so the real part has a Lorentzian absorption dip and the imaginary part the dispersive shape;
+# the baseline falls with frequency and drifts slowly over the sweep.
+#
+# Command line:
+#   python vna_simulator.py [--port 5025] [--fields 301] [--freqs 2001] [--rate 100] [--complex]
+import sys
+import asyncio
+import argparse
+import numpy as np
+from acquisition import DEFAULT_PORT, pack_frame, end_frame
+
+
+class SimulatedSweep:
+    def __init__(self, fields=None, freq_values=None, M_eff=1.0, H_k=0.0, gamma=29.0, alpha=0.003, DH0=0.0022,
+                 depth=0.3, noise=1e-3, drift=0.01, complex_values=False, seed=0):
+        self.fields = np.arange(0, 3010, 10.0) if fields is None else np.asarray(fields, dtype=float)
+        self.freq_values = np.linspace(1e9, 20e9, 2001) if freq_values is None else np.asarray(freq_values, dtype=float)
+        f_GHz = 1e-9 * self.freq_values
+        self.H_res = 1e4 * ((np.sqrt(M_eff ** 2 + 4 * (f_GHz / gamma) ** 2) - M_eff) / 2 - H_k)  # Oe
+        self.LW = 1e4 * (DH0 + 2 * alpha * f_GHz / gamma)  # Oe
+        self.baseline = 0.9 - 0.02 * f_GHz
+        self.depth = depth
+        self.noise = noise
+        self.drift = drift
+        self.complex_values = complex_values
+        self.rng = np.random.default_rng(seed)
+
+    def trace(self, i):
+        # (n_freq, 2 or 3) trace at fields[i]: frequency, Re S21 (, Im S21)
+        H = self.fields[i]
+        half_width = self.LW / 2
+        s21 = self.baseline * (1 + self.drift * i / self.fields.size) * \
+            (1 - self.depth * half_width / (half_width - 1j * (H - self.H_res)))
+        s21 = s21 + self.noise * (self.rng.standard_normal(s21.size) + 1j * self.rng.standard_normal(s21.size))
+        columns = [self.freq_values, s21.real] + ([s21.imag] if self.complex_values else [])
+        return np.column_stack(columns)
+
+
+async def send_sweep(writer, sweep, rate=None):
+    # Frames at rate traces/s (None: as fast as the connection takes them); the send time in each
+    # header is taken when the frame is written
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    for i, field in enumerate(sweep.fields):
+        if rate:
+            delay = start + i / rate - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        writer.write(pack_frame(field, sweep.trace(i)))
+        await writer.drain()
+    writer.write(end_frame())
+    await writer.drain()
+
+
+async def serve(host="127.0.0.1", port=DEFAULT_PORT, rate=None, **sweep_settings):
+    # Server that sends a new SimulatedSweep(**sweep_settings) to every connection; returns the
+    # asyncio server (port 0 picks a free port, see server.sockets[0].getsockname())
+    async def handle(reader, writer):
+        try:
+            await send_sweep(writer, SimulatedSweep(**sweep_settings), rate)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulated VNA-FMR instrument sending field sweeps.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--fields", type=int, default=301, help="field steps of 10 Oe from 0 Oe")
+    parser.add_argument("--freqs", type=int, default=2001, help="frequency points from 1 to 20 GHz")
+    parser.add_argument("--rate", type=float, default=100, help="traces per second, 0 for unlimited")
+    parser.add_argument("--complex", action="store_true", help="send the imaginary part as a third column")
+    args = parser.parse_args(argv)
+
+    async def run():
+        server = await serve(args.host, args.port, args.rate or None, fields=np.arange(args.fields) * 10.0,
+                             freq_values=np.linspace(1e9, 20e9, args.freqs), complex_values=args.complex)
+        print(f"Simulated VNA on {args.host}:{args.port}, {args.fields} fields x {args.freqs} frequencies "
+              f"at {args.rate or 'unlimited'} traces/s")
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())